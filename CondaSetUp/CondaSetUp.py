@@ -22,10 +22,29 @@ import platform
 import subprocess
 import shutil
 import urllib
+import urllib.request
+import urllib.error
+import urllib.parse
+import http.client
+import re
+import glob
+import hashlib
+import tarfile
 import multiprocessing
 from qt import (QFileDialog,QSettings,QDialogButtonBox,QComboBox,QVBoxLayout,QDialog,QLabel,QWidget,QApplication,QListWidget,QPushButton,QLineEdit,QMessageBox,QHBoxLayout,QTimer)
 import threading
 import tempfile
+import json
+import queue
+import collections
+import signal
+import locale
+import concurrent.futures
+import contextlib
+import functools
+import inspect
+import sqlite3
+import shlex
 #
 # CondaSetUp
 #
@@ -570,6 +589,8 @@ class CondaSetUpWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     def cleanup(self) -> None:
         """Called when the application closes and the module widget is destroyed."""
         self.removeObservers()
+        CondaWorker.stopAll()
+        CondaExecutionBackend.closeAll()
 
     def enter(self) -> None:
         """Called each time the user opens this module."""
@@ -681,73 +702,78 @@ class CondaSetUpWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     def installMiniconda(self):
         '''
         Initiates the installation of Miniconda in the selected folder. It handles both WSL and standard environments, displays installation progress, and updates the UI elements accordingly.
+        The installation runs in a thread which reports its progress in a CondaProgressChannel, read by a QTimer so the UI isn't blocked.
+        The remaining time is estimated from the previous installations (see CondaOperationHistory).
         '''
         if os.path.isdir(self.ui.folderInstallLineEdit.text) or self.ui.checkBoxWsl.isChecked():
             self.ui.timeInstallation.setHidden(False)
             self.ui.timeInstallation.setText("time : 0s")
-            dir_path = os.path.dirname(os.path.realpath(__file__))
-            name_file = os.path.join(dir_path, "tempo.txt")
-            with open(name_file, "w") as fichier:
-                    fichier.write("0\n")
+            self.ui.installButton.setEnabled(False)
 
-            original_stdin = sys.stdin
+            self.original_stdin = sys.stdin
             sys.stdin = DummyFile()
-            original_stdin = sys.stdin
-            sys.stdin = DummyFile()
-            if self.ui.checkBoxWsl.isChecked() :
-                process = threading.Thread(target=self.conda_wsl.installConda, args=(self.ui.folderInstallLineEdit.text,name_file,True))
-            else :
-                process = threading.Thread(target=self.conda.installConda, args=(self.ui.folderInstallLineEdit.text,name_file,True))
-            process.start()
-            line = "Start"
+            self.installChannel = CondaProgressChannel()
+            self.installResult = None
+            installConda = self.conda_wsl.installConda if self.ui.checkBoxWsl.isChecked() else self.conda.installConda
+            folder = self.ui.folderInstallLineEdit.text
+            def install():
+                self.installResult = installConda(folder, progress=self.installChannel)
+            self.installProcess = threading.Thread(target=install)
+            self.installProcess.start()
             self.ui.progressBarInstallation.setHidden(False)
-            start_time = time.time()
-            previous_time = time.time()
-            current_time = time.time()
-
-            while process.is_alive():
-                    with open(name_file, "r") as fichier:
-                        line = fichier.read()
-                    if "end" in line:
-                        print("line : ",line)
-                        break
-                    else:
-                        slicer.app.processEvents()
-                        line.replace("\n","")
-                        try :
-                            self.ui.progressBarInstallation.setValue(int(line))
-                            self.ui.progressBarInstallation.setFormat(f"{int(line)}%")
-                        except :
-                            pass
-                    current_time = time.time()
-                    if current_time-previous_time > 0.3 :
-                        previous_time = current_time
-                        self.ui.timeInstallation.setText(f"time : {current_time-start_time:.1f}s")
-
-            with open(name_file, "r") as fichier:
-                line = fichier.read()
-            if "end" in line:
-                print("line : ",line)
-                os.remove(name_file)
+            self.installStartTime = time.time()
+            operation = ("CondaSetUpCallWsl" if self.ui.checkBoxWsl.isChecked() else "CondaSetUpCall") + ".installConda"
+            self.installEstimate = CondaOperationHistory().estimate(operation)
 
-            folder = self.ui.folderInstallLineEdit.text
-            if self.ui.checkBoxWsl.isChecked() :
-                self.conda_wsl.setConda(folder+"/miniconda3")
-            else :
-                # print("os.path.join(folder,miniconda3) : ",os.path.join(folder,"miniconda3"))
-                # self.conda.setConda(os.path.join(folder,"miniconda3"))
-                self.conda.setConda(folder+"/miniconda3")
+            self.installTimer = QTimer()
+            self.installTimer.timeout.connect(self.updateInstallMiniconda)
+            self.installTimer.start(200)
+
+    def updateInstallMiniconda(self):
+        '''
+        Called by the timer of installMiniconda : displays the progress of the installation and finishes it when the thread is done.
+        '''
+        for line in self.installChannel.drain():
+            percent = CondaProgressChannel.percent(line)
+            if percent is not None:
+                self.ui.progressBarInstallation.setValue(percent)
+                self.ui.progressBarInstallation.setFormat(f"{percent}%")
+            elif line == CondaProgressChannel.END:
+                print("line : ",line)
+        elapsed = time.time()-self.installStartTime
+        estimate = ""
+        if self.installEstimate :
+            estimate = f" (about {CondaOperationHistory.formatDuration(max(0.0, self.installEstimate - elapsed))} left)"
+        self.ui.timeInstallation.setText(f"time : {elapsed:.1f}s{estimate}")
+
+        if self.installProcess.is_alive():
+            return
+
+        self.installTimer.stop()
+        folder = self.ui.folderInstallLineEdit.text
+        if not self.installResult :
+            # The prefix may be half installed : the current conda is kept
+            print("Error : the installation of Miniconda failed")
+        elif self.ui.checkBoxWsl.isChecked() :
+            self.conda_wsl.setConda(folder+"/miniconda3")
+        else :
+            # print("os.path.join(folder,miniconda3) : ",os.path.join(folder,"miniconda3"))
+            # self.conda.setConda(os.path.join(folder,"miniconda3"))
+            self.conda.setConda(folder+"/miniconda3")
 
-            self.restoreCondaPath()
+        self.restoreCondaPath()
 
-            sys.stdin = original_stdin
-            QTimer.singleShot(10000,lambda: self.hideResultLabel("installMiniconda"))
+        sys.stdin = self.original_stdin
+        self.ui.installButton.setEnabled(True)
+        QTimer.singleShot(10000,lambda: self.hideResultLabel("installMiniconda"))
 
 
 
     def createEnv(self):
         '''
         Creates a new Conda environment with specified parameters (like Python version and libraries). It updates the progress bar and handles both WSL and non-WSL environments.
+        The creation runs in a thread which reports its progress in a CondaProgressChannel, read by a QTimer so the UI isn't blocked.
+        The remaining time is estimated from the previous creations with the same libraries (see CondaOperationHistory).
         '''
         name = self.ui.lineEdit_nameEnv.text
         if name :
@@ -759,67 +785,67 @@ class CondaSetUpWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                 else :
                     lib_list = []
                 print("lib_list : ",lib_list)
-                name_file = "tempo.txt"
-                original_stdin = sys.stdin
+                self.original_stdin = sys.stdin
                 sys.stdin = DummyFile()
+                self.createChannel = CondaProgressChannel()
                 if self.ui.checkBoxWsl.isChecked() :
-                    process = threading.Thread(target=self.conda_wsl.condaCreateEnv, args=(name,"3.9",lib_list,name_file,True,))
+                    self.createProcess = threading.Thread(target=self.conda_wsl.condaCreateEnv, args=(name,"3.9",lib_list,), kwargs={"progress": self.createChannel})
                 else :
-                    process = threading.Thread(target=self.conda.condaCreateEnv, args=(name,"3.9",lib_list,name_file,True,))
-                with open(name_file, "w") as fichier:
-                    fichier.write("0\n")
-                line = "Start"
-                progress = 0
-                process.start()
+                    self.createProcess = threading.Thread(target=self.conda.condaCreateEnv, args=(name,"3.9",lib_list,), kwargs={"progress": self.createChannel})
+                self.createProcess.start()
+                self.ui.CreateEnvButton.setEnabled(False)
                 self.ui.CreateEnvprogressBar.setHidden(False)
-                start_time = time.time()
-                previous_time = time.time()
-                current_time = time.time()
+                self.ui.CreateEnvprogressBar.setValue(0)
                 self.ui.CreateEnvprogressBar.setFormat("0% time : 0s")
-                work = False
-                while process.is_alive():
-                    with open(name_file, "r") as fichier:
-                        line = fichier.read()
-                    if "end" in line:
-                        print("line : ",line)
-                        # os.remove(name_file)
-                        work = True
-                        break
-                    elif "Path to conda no setup" in line:
-                        print("line : ",line)
-                        os.remove(name_file)
-                        break
-                    else:
-                        slicer.app.processEvents()
-                        line.replace("\n","")
-                        try :
-                            self.ui.CreateEnvprogressBar.setValue(int(line))
-                            progress = int(line)
-                            self.ui.CreateEnvprogressBar.setFormat(f"{progress}% time : {current_time-start_time:.1f}s")
-                        except :
-                            pass
-                    current_time = time.time()
-                    if current_time-previous_time > 0.3 :
-                        self.ui.CreateEnvprogressBar.setFormat(f"{progress}% time : {current_time-start_time:.1f}s")
-                        previous_time = current_time
-
-
-                with open(name_file, "r") as fichier:
-                        line = fichier.read()
-                if "end" in line:
-                    print("line : ",line)
-                    os.remove(name_file)
-                    work = True
-
-                if work :
-                    self.ui.CreateEnvprogressBar.setValue(100)
-                    self.ui.CreateEnvprogressBar.setFormat(f"100%")
-                else :
-                    self.ui.CreateEnvprogressBar.setValue(0)
-                    self.ui.CreateEnvprogressBar.setFormat(f"Path to conda no setup")
-                    slicer.util.infoDisplay("Enter a path into 'Miniconda/Anaconda Path'",windowTitle="Can't found conda path")
-                sys.stdin = original_stdin
-                QTimer.singleShot(10000,lambda: self.hideResultLabel("createEnv"))
+                self.createStartTime = time.time()
+                operation = ("CondaSetUpCallWsl" if self.ui.checkBoxWsl.isChecked() else "CondaSetUpCall") + ".condaCreateEnv"
+                self.createEstimate = CondaOperationHistory().estimate(operation, env=name, requirements=CondaOperationHistory.requirementsKey("3.9", lib_list))
+                self.createProgress = 0
+                self.createWork = False
+                self.createNoPath = False
+
+                self.createTimer = QTimer()
+                self.createTimer.timeout.connect(self.updateCreateEnv)
+                self.createTimer.start(200)
+
+    def updateCreateEnv(self):
+        '''
+        Called by the timer of createEnv : displays the progress of the creation and finishes it when the thread is done.
+        '''
+        for line in self.createChannel.drain():
+            percent = CondaProgressChannel.percent(line)
+            if percent is not None:
+                self.createProgress = percent
+                self.ui.CreateEnvprogressBar.setValue(percent)
+            elif line == CondaProgressChannel.END:
+                print("line : ",line)
+                self.createWork = True
+            elif line == CondaProgressChannel.NO_CONDA_PATH:
+                print("line : ",line)
+                self.createNoPath = True
+        elapsed = time.time()-self.createStartTime
+        estimate = ""
+        if self.createEstimate :
+            estimate = f" - about {CondaOperationHistory.formatDuration(max(0.0, self.createEstimate - elapsed))} left"
+        self.ui.CreateEnvprogressBar.setFormat(f"{self.createProgress}% time : {elapsed:.1f}s{estimate}")
+
+        if self.createProcess.is_alive():
+            return
+
+        self.createTimer.stop()
+        if self.createWork :
+            self.ui.CreateEnvprogressBar.setValue(100)
+            self.ui.CreateEnvprogressBar.setFormat(f"100%")
+        elif self.createNoPath :
+            self.ui.CreateEnvprogressBar.setValue(0)
+            self.ui.CreateEnvprogressBar.setFormat(f"Path to conda no setup")
+            slicer.util.infoDisplay("Enter a path into 'Miniconda/Anaconda Path'",windowTitle="Can't found conda path")
+        else :
+            self.ui.CreateEnvprogressBar.setValue(0)
+            self.ui.CreateEnvprogressBar.setFormat(f"Error creating environment")
+        sys.stdin = self.original_stdin
+        self.ui.CreateEnvButton.setEnabled(True)
+        QTimer.singleShot(10000,lambda: self.hideResultLabel("createEnv"))
 
 
     def deleteEnv(self):
@@ -927,20 +953,21 @@ class CondaSetUpCallWsl():
         Checks if WSL is available on the system.
         '''
         try:
-            result = subprocess.run(["wsl", "--status"], capture_output=True, text=True, check=True)
-            return True
-        except subprocess.CalledProcessError as e:
-            return False
-        except FileNotFoundError:
+            result = runProcess(["wsl", "--status"], timeout=self.getTimeout("query"), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            return result.returncode == 0
+        except OSError:
             return False
 
     def testUbuntuAvailable(self):
         '''
         Verifies if Ubuntu is installed on WSL.
         '''
-        result = subprocess.run(['wsl', '--list'], capture_output=True, text=True)
-        output = result.stdout.encode('utf-16-le').decode('utf-8')
-        clean_output = output.replace('\x00', '')
+        try:
+            result = runProcess(['wsl', '--list'], timeout=self.getTimeout("query"), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError:
+            return False
+        # wsl.exe writes UTF-16-LE : the names of the distributions are ASCII once the null bytes are removed
+        clean_output = result.stdout.replace(b'\x00', b'').decode('utf-8', errors='replace')
 
         return 'Ubuntu' in clean_output
 
@@ -1001,53 +1028,100 @@ class CondaSetUpCallWsl():
         with open(name_file, "w") as file:
             file.write(f"{text}\n")
 
-    def installConda(self,folder:str,file_name:str="tempo.txt",writeProgress:bool=False):
+    def reportProgress(self,progress,name_file,text,writeProgress):
+        '''
+        Reports a progress message : in the CondaProgressChannel progress if one is given, else in the file name_file if writeProgress is True.
+        '''
+        if progress is not None:
+            progress.put(text)
+        elif writeProgress:
+            self.writeFile(name_file,text)
+
+    def getTimeout(self,kind:str):
+        '''
+        Returns the timeout in seconds of a kind of command from the settings of the class (see readTimeout).
+        '''
+        return readTimeout(self.settings, kind)
+
+    def getBackend(self):
+        '''
+        Returns the CondaExecutionBackend running the commands in WSL, from the QSettings "backend/type" : "process" (a wsl.exe per command, by default)
+        or "session" (long-lived bash sessions in WSL, "backend/maxSessions" of them at most).
+        '''
+        user = self.getUser()
+        if self.settings.value("backend/type", "process") == "session":
+            return CondaExecutionBackend.getBackend(f"wsl-session:{user}", lambda: CondaBashSessionBackend(
+                ["wsl", "--user", user, "--", "bash", "--norc", "--noprofile"], int(self.settings.value("backend/maxSessions", 2)), forward_env=False))
+        return CondaExecutionBackend.getBackend(f"wsl:{user}", lambda: CondaWslBackend(user))
+
+
+    def installConda(self,folder:str,file_name:str="tempo.txt",writeProgress:bool=False,progress=None):
         '''
-        Installs Miniconda in a specified folder in WSL.
+        Installs Miniconda in a specified folder in WSL. Returns True, or False if the installer couldn't be obtained or failed.
         '''
         try:
 
             user = self.getUser()
             print("user : ",user)
-            command = ["wsl", "--user", user, "--" ,"bash", "-c", f"wget https://repo.anaconda.com/miniconda/Miniconda3-latest-Linux-x86_64.sh -O /home/{user}/miniconda.sh && chmod +x /home/{user}/miniconda.sh && bash /home/{user}/miniconda.sh -b -p {folder}/miniconda3 && rm /home/{user}/miniconda.sh && echo 'export PATH=\"{folder}/miniconda3/bin:\\$PATH\"' >> /home/{user}/.bashrc"]
+            # The installer is taken on the Windows side (local installer, mirror or cache of CondaInstallerDownloader) and run from WSL
+            source = self.settings.value("installer/source", "") or None
+            path_installer = CondaInstallerDownloader().getInstaller("Miniconda3-latest-Linux-x86_64.sh", sha256=self.settings.value("installer/sha256", "") or None,
+                                                                      source=source, progress=progress)
+            result = self.getBackend().run(["wslpath", "-a", path_installer], timeout=self.getTimeout("query"))
+            if result.returncode != 0:
+                raise subprocess.CalledProcessError(result.returncode, result.args, result.stdout, result.stderr)
+            path_wsl = result.stdout.strip()
+            self.reportProgress(progress,file_name,"50",writeProgress)
+            command = f"bash '{path_wsl}' -b -p {folder}/miniconda3 && echo 'export PATH=\"{folder}/miniconda3/bin:\\$PATH\"' >> /home/{user}/.bashrc"
             print("command : ", command)
 
-            subprocess.check_call(command)
-            if writeProgress : self.writeFile(file_name,"100")
+            result = self.getBackend().run(command, timeout=self.getTimeout("install"))
+            if result.returncode != 0:
+                raise subprocess.CalledProcessError(result.returncode, result.args)
+            self.reportProgress(progress,file_name,"100",writeProgress)
 
             print ("Miniconda has been successfully installed on WSL.")
-            if writeProgress : self.writeFile(file_name,"end")
+            self.reportProgress(progress,file_name,"end",writeProgress)
+            return True
 
-        except subprocess.CalledProcessError as e:
+        except (subprocess.CalledProcessError, OSError, ValueError, urllib.error.URLError) as e:
             print (f"An error occurred when installing Miniconda on WSL: {e}")
+            self.reportProgress(progress,file_name,"Error installing conda",writeProgress)
+            return False
 
-    def condaCreateEnv(self,name,python_version,list_lib=[],tempo_file="tempo.txt",writeProgress=False):
+    def condaCreateEnv(self,name,python_version,list_lib=[],tempo_file="tempo.txt",writeProgress=False,progress=None,cancel=None,conda_lib=[]):
         '''
         Creates a new Conda environment with the given name and Python version, and installs specified libraries.
+        The conda packages (conda_lib) are installed by conda create, the pip packages (list_lib) by a single pip call.
+        Returns True, or False if the creation or the installation failed ("end" is only reported after a success).
         '''
-        user = self.getUser()
         conda_path = self.getCondaExecutable()
-        command_to_execute = ["wsl", "--user", user,"--","bash","-c", f"{conda_path} create -y -n {name} python={python_version} pip numpy-base"]
-        if writeProgress : self.writeFile(tempo_file,"20")
+        conda_packages = " ".join(lib for lib in conda_lib if lib not in ("pip", "numpy-base"))
+        command_to_execute = f"{conda_path} create -y -n {name} python={python_version} pip numpy-base {conda_packages}".strip()
+        self.reportProgress(progress,tempo_file,"20",writeProgress)
         print("command to execute : ",command_to_execute)
-        result = subprocess.run(command_to_execute, text=True,stdout=subprocess.PIPE, stderr=subprocess.PIPE,env = slicer.util.startupEnvironment())
-        if result.returncode==0:
-            print("Execution Successfull")
-            self.condaInstallLibEnv(name,list_lib)
-        else :
+        result = self.getBackend().run(command_to_execute, cancel=cancel, timeout=self.getTimeout("install"))
+        if result.returncode!=0:
             print("error : ",result.stderr)
+            self.reportProgress(progress,tempo_file,"Error creating environment",writeProgress)
+            return False
+        print("Execution Successfull")
+        installed = self.condaInstallLibEnv(name,list_lib,cancel=cancel)
+        if installed.startswith(("Error", "Path to conda")):
+            self.reportProgress(progress,tempo_file,"Error installing the pip packages",writeProgress)
+            return False
 
-        if writeProgress : self.writeFile(tempo_file,"100")
-        if writeProgress : self.writeFile(tempo_file,"end")
+        self.reportProgress(progress,tempo_file,"100",writeProgress)
+        self.reportProgress(progress,tempo_file,CondaProgressChannel.END,writeProgress)
+        return True
 
-    def condaInstallLibEnv(self,name,requirements: list[str]):
+    def condaInstallLibEnv(self,name,requirements: list[str],cancel=None):
         '''
         Installs a list of libraries in a specified Conda environment.
         '''
         print("requirements : ",requirements)
         path_activate = self.getActivateExecutable()
         path_conda = self.getCondaPath()
-        user = self.getUser()
         if path_activate=="None":
                 return "Path to conda no setup"
         else :
@@ -1057,9 +1131,8 @@ class CondaSetUpCallWsl():
 
                 for lib in requirements :
                     command = command+ " "+lib
-                command_to_execute = ["wsl", "--user", user,"--","bash","-c", command]
-                print("command to execute in intsallLib wsl : ",command_to_execute)
-                result = subprocess.run(command_to_execute, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8', errors='replace', env=slicer.util.startupEnvironment())
+                print("command to execute in intsallLib wsl : ",command)
+                result = self.getBackend().run(command, cancel=cancel, timeout=self.getTimeout("install"))
                 if result.returncode==0:
                     print(f"Result : {result.stdout}")
                     return (f"Result : {result.stdout}")
@@ -1068,20 +1141,18 @@ class CondaSetUpCallWsl():
                     return (f"Error : {result.stderr}")
             return "Nothing to install"
 
-    def condaDeleteEnv(self,name:str):
+    def condaDeleteEnv(self,name:str,cancel=None):
         '''
         Deletes a specified Conda environment.
         '''
         exist = self.condaTestEnv(name)
-        user = self.getUser()
         if exist:
             path_conda = self.getCondaExecutable()
             if path_conda=="None":
                 return "Path to conda no setup"
             command = f"{path_conda} env remove --name {name}"
-            command_to_execute = ["wsl", "--user", user,"--","bash","-c", command]
-            print("command_to_execute : ",command_to_execute)
-            result = subprocess.run(command_to_execute, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, env=slicer.util.startupEnvironment())
+            print("command_to_execute : ",command)
+            result = self.getBackend().run(command, cancel=cancel, timeout=self.getTimeout("install"))
             if result.returncode == 0:
                 return "Delete"
             else :
@@ -1095,16 +1166,14 @@ class CondaSetUpCallWsl():
         '''
 
         path_conda = self.getCondaExecutable()
-        user = self.getUser()
         if path_conda=="None":
                 return "Path to conda no setup"
 
         command = f"{path_conda} info --envs"
-        command_to_execute = ["wsl", "--user", user,"--","bash","-c", command]
-        print("command_to_execute : ",command_to_execute)
-        result = subprocess.run(command_to_execute, stdout=subprocess.PIPE, stderr=subprocess.PIPE,env = slicer.util.startupEnvironment())
+        print("command_to_execute : ",command)
+        result = self.getBackend().run(command, timeout=self.getTimeout("query"))
         if result.returncode == 0:
-            output = result.stdout.decode("utf-8")
+            output = result.stdout
             env_lines = output.strip().split("\n")
 
             for line in env_lines:
@@ -1127,13 +1196,14 @@ class CondaSetUpCallWsl():
 
         return path
 
-    def condaRunFilePython(self, file_path,env_name="None",args=[]):
+    def condaRunFilePython(self, file_path,env_name="None",args=[],cancel=None,timeout=None):
         '''
         Runs a Python script in a specified Conda environment within WSL.
         '''
+        if timeout is None:
+            timeout = self.getTimeout("script")
         path_condaexe = self.getCondaExecutable()
         path_conda = self.getCondaPath()
-        user = self.getUser()
 
         if env_name!="None":
             if not self.condaTestEnv(env_name):
@@ -1152,21 +1222,21 @@ class CondaSetUpCallWsl():
         for arg in args :
             command2 = command2 +" "+"\""+arg+"\""
 
-        command_to_execute = ["wsl", "--user", user,"--","bash","-c", command2]
-        print("command_to_execute : ",command_to_execute)
+        print("command_to_execute : ",command2)
 
-        result = subprocess.run(command_to_execute, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, env=slicer.util.startupEnvironment())
+        result = self.getBackend().run(command2, cancel=cancel, timeout=timeout)
         if result.returncode == 0:
             return (f"Result: {result.stdout}")
         else :
             return (f"Error: {result.stderr}")
 
-    def condaRunCommand(self, command: list[str],env_name="None"):
+    def condaRunCommand(self, command: list[str],env_name="None",cancel=None,timeout=None):
         '''
         Executes a command in a specified Conda environment within WSL.
         '''
+        if timeout is None:
+            timeout = self.getTimeout("script")
         path_activate = self.getActivateExecutable()
-        user = self.getUser()
         if path_activate=="None":
             return "Path to conda no setup"
 
@@ -1177,9 +1247,8 @@ class CondaSetUpCallWsl():
         for com in command :
             command_execute = command_execute+ " "+com
 
-        command_to_execute = ["wsl", "--user", user,"--","bash","-c", command_execute]
-        print("command_to_execute in condaRunCommand : ",command_to_execute)
-        result = subprocess.run(command_to_execute, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8', errors='replace', env=slicer.util.startupEnvironment())
+        print("command_to_execute in condaRunCommand : ",command_execute)
+        result = self.getBackend().run(command_execute, cancel=cancel, timeout=timeout)
         if result.returncode == 0:
             return (f"Result: {result.stdout}")
         else :
@@ -1240,20 +1309,46 @@ class CondaSetUpCall():
             return (condaPath)
         return "None"
 
-    def condaTestEnv(self,name:str)->bool:
+    def invalidateEnvs(self):
+        '''
+        Forces the environment registry of the current installation to be rebuilt, called after creating or deleting an environment.
+        '''
+        registry = CondaEnvRegistry.getRegistry(self.getCondaPath())
+        if registry is not None:
+            registry.invalidate()
+
+    def condaListEnvs(self)->dict:
+        '''
+        Returns the environments of the current installation : name -> {"prefix", "python_version", "mtime"}.
+        '''
+        registry = CondaEnvRegistry.getRegistry(self.getCondaPath())
+        if registry is None:
+            return {}
+        return registry.listEnvs()
+
+    def condaTestEnv(self,name:str,lock=None)->bool:
         '''
        Checks if a specified Conda environment exists and returns a boolean indicating the result.
+        The environments are looked up in CondaEnvRegistry, 'conda info --envs' is only used if the installation folder can't be scanned.
+        If lock (a lockfile or its text) is given, the environment must also have been created from the same packages.
         '''
 
         path_conda = self.getCondaExecutable()
         if path_conda=="None":
                 return "Path to conda no setup"
 
+        if lock is not None:
+            return self.condaTestEnv(name) and self.getEnvLockHash(name) == self.getLockHash(lock)
+
+        registry = CondaEnvRegistry.getRegistry(self.getCondaPath())
+        if registry is not None:
+            return registry.hasEnv(name)
+
         command_to_execute = [path_conda, "info", "--envs"]
 
-        result = subprocess.run(command_to_execute, stdout=subprocess.PIPE, stderr=subprocess.PIPE,env = slicer.util.startupEnvironment())
+        result = self.getBackend().run(command_to_execute, timeout=self.getTimeout("query"), env=slicer.util.startupEnvironment())
         if result.returncode == 0:
-            output = result.stdout.decode("utf-8")
+            output = result.stdout
             env_lines = output.strip().split("\n")
 
             for line in env_lines:
@@ -1262,16 +1357,15 @@ class CondaSetUpCall():
                     return True
         return False
 
-    def installConda(self,path_install:str,name_tempo:str="tempo.txt",writeProgress:bool=False)->None:
+    def installConda(self,path_install:str,name_tempo:str="tempo.txt",writeProgress:bool=False,progress=None)->bool:
         '''
         Installs Conda in a specified path, handling different operating systems and architectures, and optionally updates the installation progress.
+        Returns True, or False if the installer couldn't be obtained, failed or was stopped by the "install" timeout.
         '''
         path_install = os.path.join(path_install,"miniconda3")
         system = platform.system()
         machine = platform.machine()
 
-        miniconda_base_url = "https://repo.anaconda.com/miniconda/"
-
         # Construct the filename based on the operating system and architecture
         if system == "Windows":
             if machine.endswith("64"):
@@ -1291,10 +1385,7 @@ class CondaSetUpCall():
         else:
             raise NotImplementedError(f"Unsupported system: {system} {machine}")
 
-        miniconda_url = miniconda_base_url + filename
 
-
-        path_sh = os.path.join(path_install,"miniconda.sh")
         path_conda = os.path.join(path_install,"bin","conda")
 
 
@@ -1302,19 +1393,16 @@ class CondaSetUpCall():
             os.makedirs(path_install)
 
 
-        if writeProgress : self.writeFile(name_tempo,"20")
+        self.reportProgress(progress,name_tempo,"20",writeProgress)
+
+        sha256 = self.settings.value("installer/sha256", "") or None
 
         if system == "Windows":
             try:
                 path_install = self.convert_path(path_install)
-                path_exe = os.path.join(os.path.expanduser("~"), "tempo")
-
-                os.makedirs(path_exe, exist_ok=True)
-                # Define paths for the installer and conda executable
-                path_installer = os.path.join(path_exe, filename)
                 path_conda = os.path.join(path_install, "Scripts", "conda.exe")
-                # Download the Anaconda installer
-                urllib.request.urlretrieve(miniconda_url, path_installer)
+                # Download the Anaconda installer, or reuse the one of the cache
+                path_installer = CondaInstallerDownloader().getInstaller(filename, sha256=sha256, progress=progress)
                 print("Installer downloaded successfully.")
                 print("Installing Miniconda...")
 
@@ -1324,51 +1412,61 @@ class CondaSetUpCall():
 
                 install_command = f'"{path_installer}" /InstallationType=JustMe /AddToPath=1 /RegisterPython=0 /S /D={path_install}'
 
-                if writeProgress : self.writeFile(name_tempo,"50")
+                self.reportProgress(progress,name_tempo,"50",writeProgress)
 
-                subprocess.run(install_command, shell=True)
+                result = runProcess(install_command, timeout=self.getTimeout("install"), shell=True)
+                if result.returncode != 0:
+                    raise RuntimeError(f"the installer has been stopped after {self.getTimeout('install')}s" if result.timed_out
+                                       else f"the installer failed ({result.returncode})")
 
-                if writeProgress : self.writeFile(name_tempo,"70")
-                subprocess.run(f"{path_conda} init cmd.exe", shell=True)
+                self.reportProgress(progress,name_tempo,"70",writeProgress)
+                runProcess(f"{path_conda} init cmd.exe", timeout=self.getTimeout("query"), shell=True)
                 print("Miniconda installed successfully.")
-                if writeProgress : self.writeFile(name_tempo,"90")
-
-                try:
-                    shutil.rmtree(path_exe)
-                    print(f"Folder {path_exe} and its contebt has been successfully deleted.")
-                    if writeProgress : self.writeFile(name_tempo,"100")
-                except Exception as e:
-                    print(f"An Error has occured when deleting folder : {str(e)}")
-                    return True
+                self.reportProgress(progress,name_tempo,"90",writeProgress)
+                self.reportProgress(progress,name_tempo,"100",writeProgress)
             except Exception as e:
                 print(f"An error occurred: {str(e)}")
+                self.reportProgress(progress,name_tempo,"Error installing conda",writeProgress)
                 return False
 
         else :
-            subprocess.run(f"mkdir -p {path_install}",capture_output=True, shell=True)
-            if writeProgress : self.writeFile(name_tempo,"30")
-            urllib.request.urlretrieve(miniconda_url,path_sh)
-            if writeProgress : self.writeFile(name_tempo,"50")
-            subprocess.run(f"chmod +x {path_sh}",capture_output=True, shell=True)
-            if writeProgress : self.writeFile(name_tempo,"60")
+            self.reportProgress(progress,name_tempo,"20",writeProgress)
+            try:
+                # A downloaded installer is kept in the cache of CondaInstallerDownloader for the next installations
+                path_sh = CondaInstallerDownloader().getInstaller(filename, sha256=sha256, progress=progress)
+            except Exception as e:
+                print(f"An error occurred when getting the installer {filename}: {str(e)}")
+                self.reportProgress(progress,name_tempo,"Error downloading the installer",writeProgress)
+                return False
+            self.reportProgress(progress,name_tempo,"50",writeProgress)
+            os.chmod(path_sh, os.stat(path_sh).st_mode | 0o111)
+            self.reportProgress(progress,name_tempo,"60",writeProgress)
 
             try:
                 print(f"bash {path_sh} -b -u -p {path_install}")
-                result =subprocess.run(f"bash {path_sh} -b -u -p {path_install}",capture_output=True, shell=True)
+                result = runProcess(["bash", path_sh, "-b", "-u", "-p", path_install], timeout=self.getTimeout("install"), capture_output=True, text=True)
                 print(result.stdout)
                 print(result.stderr)
-
-                if writeProgress : self.writeFile(name_tempo,"80")
-                subprocess.run(f"rm -rf {path_sh}",shell=True)
-                if writeProgress : self.writeFile(name_tempo,"90")
-                subprocess.run(f"{path_conda} init bash",shell=True)
-                subprocess.run(f"{path_conda} tos accept",shell=True)
-                if writeProgress : self.writeFile(name_tempo,"100")
+                if result.returncode != 0:
+                    # The prefix is broken : it mustn't be used as the conda of the module
+                    if result.timed_out:
+                        print(f"Error : the installer has been stopped after {self.getTimeout('install')}s")
+                    else:
+                        print(f"Error : the installer failed ({result.returncode}) : {result.stderr}")
+                    self.reportProgress(progress,name_tempo,"Error installing conda",writeProgress)
+                    return False
+
+                self.reportProgress(progress,name_tempo,"80",writeProgress)
+                self.reportProgress(progress,name_tempo,"90",writeProgress)
+                runProcess([path_conda, "init", "bash"], timeout=self.getTimeout("query"))
+                runProcess([path_conda, "tos", "accept"], timeout=self.getTimeout("query"))
+                self.reportProgress(progress,name_tempo,"100",writeProgress)
                 return True
             except:
                 return (False)
 
-        if writeProgress : self.writeFile(name_tempo,"end")
+        self.reportProgress(progress,name_tempo,"end",writeProgress)
+        return True
 
 
     def writeFile(self,name_file,text):
@@ -1378,10 +1476,41 @@ class CondaSetUpCall():
         with open(name_file, "w") as file:
             file.write(f"{text}\n")
 
-    def condaCreateEnv(self, name, python_version, list_lib, tempo_file="tempo.txt", writeProgress=False):
+    def reportProgress(self,progress,name_file,text,writeProgress):
+        '''
+        Reports a progress message : in the CondaProgressChannel progress if one is given, else in the file name_file if writeProgress is True.
+        '''
+        if progress is not None:
+            progress.put(text)
+        elif writeProgress:
+            self.writeFile(name_file,text)
+
+    def getTimeout(self,kind:str):
+        '''
+        Returns the timeout in seconds of a kind of command from the settings of the class (see readTimeout).
+        '''
+        return readTimeout(self.settings, kind)
+
+    def getBackend(self):
+        '''
+        Returns the CondaExecutionBackend running the commands, from the QSettings "backend/type" : "process" (a process per command, by default)
+        or "session" (long-lived bash sessions, "backend/maxSessions" of them at most, not on Windows).
+        '''
+        if self.settings.value("backend/type", "process") == "session" and platform.system() != "Windows":
+            return CondaExecutionBackend.getBackend("session", lambda: CondaBashSessionBackend(max_sessions=int(self.settings.value("backend/maxSessions", 2))))
+        return CondaExecutionBackend.getBackend("process", CondaLocalBackend)
+
+
+    def condaCreateEnv(self, name, python_version, list_lib, tempo_file="tempo.txt", writeProgress=False, progress=None, cancel=None, conda_lib=[], use_template=None):
         """
         Crée un env conda à un emplacement connu (prefix) et y installe des libs.
         Robuste pour Linux/Slicer (évite les surprises de HOME/envs_dirs).
+        The conda packages (conda_lib) are solved with python by conda create, and the pip packages (list_lib) are installed by a single pip call,
+        so each set of requirements is resolved once.
+        If use_template (QSettings "templates/enabled", false by default), the environment is cloned from a template environment
+        created with the same python version and requirements, and a new template is saved after a full creation.
+        A template older than the QSettings "templates/maxAge" (in days, 30 by default, 0 for no limit) is deleted and rebuilt, so unpinned requirements are solved again.
+        Returns True, or False if the creation or the installation of the pip packages failed (the environment is then kept without them).
         """
         channels = [
         "https://repo.anaconda.com/pkgs/main",
@@ -1390,83 +1519,363 @@ class CondaSetUpCall():
         
         path_conda = self.getCondaExecutable()
         if not path_conda or path_conda == "None":
-            if writeProgress: self.writeFile(tempo_file, "Path to conda not set up")
+            self.reportProgress(progress,tempo_file,CondaProgressChannel.NO_CONDA_PATH,writeProgress)
             print("❌ Conda executable not found.")
             return False
 
-        for ch in channels:
-            cmd = [path_conda, "tos", "accept", "--override-channels", "--channel", ch]
-            print("🔧 Accept TOS command:", " ".join(cmd))
-            result = subprocess.run(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                env=slicer.util.startupEnvironment()
-            )
-            if result.returncode == 0:
-                print(f"✅ TOS accepted for {ch}")
-                if writeProgress:
-                    self.writeFile(tempo_file, f"TOS accepted for {ch}")
-            else:
-                print(f"⚠️ Failed to accept TOS for {ch}\n{result.stderr}")
-                if writeProgress:
-                    self.writeFile(tempo_file, f"Failed to accept TOS for {ch}")
-
         miniconda_root = os.path.abspath(os.path.join(os.path.dirname(path_conda), ".."))
         env_prefix = os.path.join(miniconda_root, "envs", name)
 
         os.makedirs(os.path.dirname(env_prefix), exist_ok=True)
+        cache = CondaPackageCache()
+
+        if use_template is None:
+            use_template = str(self.settings.value("templates/enabled", "false")).lower() == "true"
+        template_name = self.getTemplateName(python_version, list_lib, conda_lib)
+        if use_template and name != template_name and self.isTemplateExpired(template_name):
+            print(f"⚠️ template {template_name} expired, full creation")
+            self.condaDeleteEnv(template_name, cancel=cancel)
+        if use_template and name != template_name and self.condaTestEnv(template_name):
+            self.reportProgress(progress,tempo_file,"10",writeProgress)
+            self.reportProgress(progress,tempo_file,"Cloning the template environment",writeProgress)
+            if self.condaCloneEnv(template_name, name, cancel=cancel):
+                self.reportProgress(progress,tempo_file,"100",writeProgress)
+                self.reportProgress(progress,tempo_file,"end",writeProgress)
+                print(f"✅ Env cloné depuis {template_name}: {env_prefix}")
+                return True
+            if cancel is not None and cancel.isCancelled():
+                self.reportProgress(progress,tempo_file,"Cancelled",writeProgress)
+                return False
+            print(f"⚠️ clone of {template_name} failed, full creation")
+            if os.path.isdir(env_prefix):
+                shutil.rmtree(env_prefix, ignore_errors=True)
+
+        cmd = [path_conda, "tos", "accept", "--override-channels"]
+        for ch in channels:
+            cmd += ["--channel", ch]
+        print("🔧 Accept TOS command:", " ".join(cmd))
+        result = self.getBackend().run(cmd, cancel=cancel, timeout=self.getTimeout("query"), env=slicer.util.startupEnvironment())
+        if result.returncode == 0:
+            print(f"✅ TOS accepted for {', '.join(channels)}")
+            self.reportProgress(progress,tempo_file,"TOS accepted",writeProgress)
+        else:
+            print(f"⚠️ Failed to accept TOS\n{result.stderr}")
+            self.reportProgress(progress,tempo_file,"Failed to accept TOS",writeProgress)
 
-        if writeProgress: self.writeFile(tempo_file, "10")
+        self.reportProgress(progress,tempo_file,"10",writeProgress)
+        self.reportProgress(progress,tempo_file,"Creating the environment",writeProgress)
 
+        conda_packages = list(conda_lib)
+        if list_lib and not any(re.split(r"[<>=!~ ]", lib.strip())[0] == "pip" for lib in conda_packages):
+            conda_packages.append("pip")
         cmd_create = [
             path_conda, "create",
             "-p", env_prefix,      
             f"python={python_version}",
-            "-y"
-        ]
+        ] + conda_packages + ["-y"]
         print("🔧 conda create:", " ".join(cmd_create))
-        result = subprocess.run(
-            cmd_create,
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
-            env=slicer.util.startupEnvironment()
-        )
+        result = self.getBackend().run(cmd_create, cancel=cancel, timeout=self.getTimeout("install"), env=cache.condaEnvironment(conda_root=miniconda_root))
+        self.invalidateEnvs()
         if result.returncode != 0:
             print("❌ create failed:\n", result.stderr or result.stdout)
-            if writeProgress: self.writeFile(tempo_file, "Error creating environment")
+            self.reportProgress(progress,tempo_file,"Error creating environment",writeProgress)
             return False
 
-        if writeProgress: self.writeFile(tempo_file, "40")
-
-        # 2) (facultatif mais utile) test rapide de l'env
-        cmd_test = [path_conda, "run", "-p", env_prefix, "python", "-c", "import sys; print(sys.version)"]
-        test = subprocess.run(cmd_test, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
-                            env=slicer.util.startupEnvironment())
-        if test.returncode != 0:
-            print("⚠️ test env failed:\n", test.stderr or test.stdout)
+        self.reportProgress(progress,tempo_file,"40",writeProgress)
 
-        def conda_run_p(args):
-            return subprocess.run(
-                [path_conda, "run", "-p", env_prefix] + args,
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
-                env=slicer.util.startupEnvironment()
-            )
+        # 2) (facultatif mais utile) test rapide de l'env, sans lancer conda
+        env_python = os.path.join(env_prefix, "python.exe") if platform.system()=="Windows" else os.path.join(env_prefix, "bin", "python3")
+        if not os.path.isfile(env_python):
+            print("⚠️ test env failed: no python in", env_prefix)
 
+        pip_failed = False
         if list_lib:
-            for pkg in list_lib:
-                r = conda_run_p(["pip", "install", pkg])
-                if r.returncode != 0:
-                    print(f"⚠️ install {pkg} failed:\n", r.stderr or r.stdout)
+            self.reportProgress(progress,tempo_file,"Installing the pip packages",writeProgress)
+            cmd_pip = [path_conda, "run", "-p", env_prefix, "python", "-m", "pip", "install"] + cache.pipArguments() + list(list_lib)
+            print("🔧 pip install:", " ".join(cmd_pip))
+            r = self.getBackend().run(cmd_pip, cancel=cancel, timeout=self.getTimeout("install"), env=slicer.util.startupEnvironment())
+            pip_failed = r.returncode != 0
+            if pip_failed:
+                print(f"⚠️ install {' '.join(list_lib)} failed:\n", r.stderr or r.stdout)
+                self.reportProgress(progress,tempo_file,"Error installing the pip packages",writeProgress)
+            self.invalidateEnvs()
+            self.reportProgress(progress,tempo_file,"90",writeProgress)
+
+        if cancel is not None and cancel.isCancelled():
+            print(f"❌ Creation of {env_prefix} cancelled")
+            self.reportProgress(progress,tempo_file,"Cancelled",writeProgress)
+            return False
+
+        if cache.isEnabled():
+            cache.markEnvUsed(env_prefix)
+            cache.evictIfDue()
+
+        if pip_failed:
+            # The environment is kept (its conda packages are installed) but the creation failed : no template, and no "end" which means a success
+            print(f"❌ Env {env_prefix} created without its pip packages")
+            return False
+
+        if use_template and name != template_name:
+            self.reportProgress(progress,tempo_file,"Saving the template environment",writeProgress)
+            if not self.condaCloneEnv(name, template_name, cancel=cancel):
+                print(f"⚠️ the template {template_name} couldn't be saved")
+            else:
+                # The age of the template starts now, whatever conda copied
+                history = os.path.join(self.getEnvPrefix(template_name), "conda-meta", "history")
+                with open(history, "a"):
+                    pass
+                os.utime(history)
 
-        if writeProgress:
-            self.writeFile(tempo_file, "100")
-            self.writeFile(tempo_file, "end")
+        self.reportProgress(progress,tempo_file,"100",writeProgress)
+        self.reportProgress(progress,tempo_file,"end",writeProgress)
 
         print(f"✅ Env créé: {env_prefix}")
         return True
 
-    def condaInstallLibEnv(self,name,requirements: list[str]):
+    def getTemplateName(self, python_version, list_lib=[], conda_lib=[]):
+        '''
+        Returns the name of the template environment of a python version and a list of requirements (the order of the requirements doesn't matter).
+        '''
+        key = json.dumps({"version": CONDA_TEMPLATE_VERSION, "python": str(python_version).strip(),
+                          "pip": sorted(lib.strip() for lib in list_lib), "conda": sorted(lib.strip() for lib in conda_lib)})
+        return "slicerconda-template-" + hashlib.sha256(key.encode("utf-8")).hexdigest()[:12]
+
+    def isTemplateExpired(self, name:str)->bool:
+        '''
+        Returns True if the template environment name exists and is older than the QSettings "templates/maxAge" (in days, 30 by default, 0 for no limit).
+        Its age is the one of its conda-meta/history, touched when the template is saved and not modified afterwards.
+        '''
+        max_age = float(self.settings.value("templates/maxAge", 30))
+        if max_age <= 0:
+            return False
+        history = os.path.join(self.getEnvPrefix(name), "conda-meta", "history")
+        if not os.path.exists(history):
+            return False
+        return time.time() - os.path.getmtime(history) > max_age * 24 * 3600
+
+    def condaCloneEnv(self, source:str, name:str, cancel=None)->bool:
+        '''
+        Creates the environment name as a copy of the environment source with conda create --clone.
+        The packages are hard-linked from the package folders when possible, nothing is solved or downloaded.
+        '''
+        path_conda = self.getCondaExecutable()
+        if path_conda=="None":
+            return False
+        miniconda_root = os.path.abspath(os.path.join(os.path.dirname(path_conda), ".."))
+        command = [path_conda, "create", "-p", os.path.join(miniconda_root, "envs", name), "--clone", self.getEnvPrefix(source), "--offline", "-y"]
+        print("command in condaCloneEnv : ",command)
+        result = self.getBackend().run(command, cancel=cancel, timeout=self.getTimeout("install"), env=CondaPackageCache().condaEnvironment(conda_root=miniconda_root))
+        self.invalidateEnvs()
+        if result.returncode != 0:
+            print(f"Error : {result.stderr or result.stdout}")
+            return False
+        return True
+
+    def condaListTemplates(self)->list[str]:
+        '''
+        Returns the names of the template environments.
+        '''
+        return [name for name in self.condaListEnvs() if name.startswith("slicerconda-template-")]
+
+    def condaDeleteTemplates(self, cancel=None):
+        '''
+        Deletes every template environment, e.g. to free disk space or to rebuild them.
+        '''
+        for name in self.condaListTemplates():
+            self.condaDeleteEnv(name, cancel=cancel)
+
+    def readLock(self, lock:str)->str:
+        '''
+        Returns the text of a lockfile given by its path or its text.
+        '''
+        if "\n" not in lock and os.path.isfile(lock):
+            with open(lock) as file:
+                return file.read()
+        return lock
+
+    def getLockHash(self, lock:str)->str:
+        '''
+        Returns the content hash of a lockfile : the sha256 of its sorted package URLs (with their md5) and pip pins, comments and order ignored.
+        '''
+        lines = []
+        for line in self.readLock(lock).splitlines():
+            line = line.strip()
+            if line.startswith(CONDA_LOCK_PIP):
+                lines.append("pip:" + line[len(CONDA_LOCK_PIP):].strip().lower())
+            elif line and not line.startswith(("#", "@")):
+                lines.append(line)
+        return hashlib.sha256("\n".join(sorted(lines)).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def getPackagesHash(prefix:str)->str:
+        '''
+        Returns the hash of the package records of an environment (conda-meta/*.json and *.dist-info, whose names hold the versions) :
+        it changes with every installation, upgrade or removal, by conda, pip or the user.
+        '''
+        try:
+            records = [name for name in os.listdir(os.path.join(prefix, "conda-meta")) if name.endswith(".json")]
+        except OSError:
+            records = []
+        records += [os.path.basename(path) for path in CondaPackageCache.listDistInfo(prefix)]
+        return hashlib.sha256("\n".join(sorted(records)).encode("utf-8")).hexdigest()
+
+    def getEnvLockHash(self, name:str):
+        '''
+        Returns the hash of the lockfile an environment has been created from (or locked with condaLockEnv), None if there is none
+        or if its packages have changed since.
+        '''
+        prefix = self.getEnvPrefix(name)
+        try:
+            with open(os.path.join(prefix, "conda-meta", CONDA_LOCK_MARKER)) as file:
+                lock_hash, _, packages_hash = file.read().strip().partition(" ")
+        except OSError:
+            return None
+        if not lock_hash or packages_hash != self.getPackagesHash(prefix):
+            return None
+        return lock_hash
+
+    def writeEnvLockHash(self, name:str, lock_hash:str):
+        # The marker has no .json extension : conda reads every conda-meta/*.json file as a package record
+        prefix = self.getEnvPrefix(name)
+        with open(os.path.join(prefix, "conda-meta", CONDA_LOCK_MARKER), "w") as file:
+            file.write(f"{lock_hash} {self.getPackagesHash(prefix)}\n")
+
+    def condaFindEnvByLock(self, lock:str):
+        '''
+        Returns the name of an environment created from the same packages as a lockfile, or None.
+        '''
+        lock_hash = self.getLockHash(lock)
+        for name in self.condaListEnvs():
+            if self.getEnvLockHash(name) == lock_hash:
+                return name
+        return None
+
+    def condaLockEnv(self, name:str, lockfile_path:str=None, cancel=None):
+        '''
+        Returns the lockfile of an environment : the exact URLs and md5 of its conda packages (conda list --explicit --md5)
+        followed by its pip packages as "# pip: name==version" lines. It is written in lockfile_path if given.
+        The environment is marked with the hash of the lockfile, so it is reused by condaCreateEnvFromLock.
+        '''
+        path_conda = self.getCondaExecutable()
+        if path_conda=="None" or not self.condaTestEnv(name):
+            return None
+        prefix = self.getEnvPrefix(name)
+        result = self.getBackend().run([path_conda, "list", "--explicit", "--md5", "-p", prefix], cancel=cancel, timeout=self.getTimeout("query"), env=slicer.util.startupEnvironment())
+        if result.returncode != 0:
+            print(f"Error : {result.stderr}")
+            return None
+
+        pins = []
+        for dist_info in CondaPackageCache.listDistInfo(prefix):
+            try:
+                with open(os.path.join(dist_info, "INSTALLER")) as file:
+                    if file.read().strip() != "pip":
+                        continue
+                with open(os.path.join(dist_info, "METADATA"), encoding="utf-8", errors="replace") as file:
+                    metadata = dict(line.rstrip("\n").split(": ", 1) for line in file if line.startswith(("Name: ", "Version: ")))
+            except (OSError, ValueError):
+                continue
+            if "Name" in metadata and "Version" in metadata:
+                pins.append(f"{metadata['Name']}=={metadata['Version']}")
+
+        lock = result.stdout.rstrip("\n") + "\n" + "".join(f"{CONDA_LOCK_PIP} {pin}\n" for pin in sorted(pins, key=str.lower))
+        self.writeEnvLockHash(name, self.getLockHash(lock))
+        if lockfile_path:
+            with open(lockfile_path, "w") as file:
+                file.write(lock)
+        return lock
+
+    def condaCreateEnvFromLock(self, name:str, lock:str, progress=None, cancel=None):
+        '''
+        Creates an environment with exactly the packages of a lockfile (path or text) : conda installs the listed URLs without solving,
+        and the pip pins are installed in one pip call without dependency resolution.
+        Nothing is created if an environment with the same lock hash already exists : its name is returned and can be used instead of name.
+        Returns the name of the environment to use, or None if the creation failed.
+        '''
+        path_conda = self.getCondaExecutable()
+        if path_conda=="None":
+            self.reportProgress(progress,"",CondaProgressChannel.NO_CONDA_PATH,False)
+            return None
+        text = self.readLock(lock)
+        lock_hash = self.getLockHash(text)
+        existing = name if self.getEnvLockHash(name) == lock_hash else self.condaFindEnvByLock(text)
+        if existing is not None:
+            print(f"Environment {existing} already created from this lockfile")
+            self.reportProgress(progress,"","100",False)
+            self.reportProgress(progress,"","end",False)
+            return existing
+        if self.condaTestEnv(name):
+            print(f"Error : the environment {name} already exists with other packages")
+            self.reportProgress(progress,"","Error creating environment",False)
+            return None
+
+        miniconda_root = os.path.abspath(os.path.join(os.path.dirname(path_conda), ".."))
+        env_prefix = os.path.join(miniconda_root, "envs", name)
+        cache = CondaPackageCache()
+        self.reportProgress(progress,"","10",False)
+        self.reportProgress(progress,"","Creating the environment",False)
+        with tempfile.TemporaryDirectory(prefix="slicerconda_lock_") as folder:
+            lock_path = os.path.join(folder, "conda.lock")
+            with open(lock_path, "w") as file:
+                file.write(text)
+            command = [path_conda, "create", "-p", env_prefix, "--file", lock_path, "-y"]
+            print("command in condaCreateEnvFromLock : ",command)
+            result = self.getBackend().run(command, cancel=cancel, timeout=self.getTimeout("install"), env=cache.condaEnvironment(conda_root=miniconda_root))
+        self.invalidateEnvs()
+        if result.returncode != 0:
+            print(f"Error : {result.stderr or result.stdout}")
+            self.reportProgress(progress,"","Error creating environment",False)
+            return None
+
+        pins = [line.strip()[len(CONDA_LOCK_PIP):].strip() for line in text.splitlines() if line.strip().startswith(CONDA_LOCK_PIP)]
+        if pins:
+            self.reportProgress(progress,"","60",False)
+            self.reportProgress(progress,"","Installing the pip packages",False)
+            command = [path_conda, "run", "-p", env_prefix, "python", "-m", "pip", "install", "--no-deps"] + cache.pipArguments() + pins
+            result = self.getBackend().run(command, cancel=cancel, timeout=self.getTimeout("install"), env=slicer.util.startupEnvironment())
+            if result.returncode != 0:
+                print(f"Error : {result.stderr or result.stdout}")
+                self.reportProgress(progress,"","Error installing the pip packages",False)
+                return None
+
+        self.writeEnvLockHash(name, lock_hash)
+        self.reportProgress(progress,"","100",False)
+        self.reportProgress(progress,"","end",False)
+        return name
+
+    def condaExportEnv(self, name:str, archive_path:str, progress=None, cancel=None)->bool:
+        '''
+        Writes an environment in a relocatable archive (CondaEnvArchive), to install it on other computers with condaImportEnv.
+        '''
+        if not self.condaTestEnv(name):
+            print(f"Error : the environment {name} doesn't exist")
+            return False
+        result = CondaEnvArchive.export(self.getEnvPrefix(name), archive_path, progress=progress, cancel=cancel)
+        if progress is not None:
+            progress.put("100" if result else "Error exporting environment")
+            progress.put("end")
+        return result
+
+    def condaImportEnv(self, archive_path:str, name:str, progress=None, cancel=None)->bool:
+        '''
+        Installs the environment of an archive written by condaExportEnv under the name name, without solving nor downloading anything.
+        '''
+        path_conda = self.getCondaPath()
+        if path_conda=="None" or not path_conda:
+            return False
+        if self.condaTestEnv(name):
+            print(f"Error : the environment {name} already exists")
+            return False
+        prefix = os.path.join(path_conda, "envs", name)
+        result = CondaEnvArchive.extract(archive_path, prefix, progress=progress, cancel=cancel)
+        self.invalidateEnvs()
+        CondaActivatedEnv.invalidate(prefix)
+        if progress is not None:
+            progress.put("100" if result else "Error importing environment")
+            progress.put("end")
+        return result
+
+    def condaInstallLibEnv(self,name,requirements: list[str],cancel=None):
         '''
         Installs a list of specified libraries in a given Conda environment.
         '''
@@ -1483,20 +1892,63 @@ class CondaSetUpCall():
                     command = f"{path_conda_exe} run pip install"
                 else :
                     command = f"{path_conda_exe} run -n {name} pip install"
+                for argument in CondaPackageCache().pipArguments():
+                    command = command+ " "+f'"{argument}"'
 
                 for lib in requirements :
                     command = command+ " "+lib
-                result = subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8', errors='replace', env=slicer.util.startupEnvironment())
+                result = self.getBackend().run(command, cancel=cancel, timeout=self.getTimeout("install"), env=slicer.util.startupEnvironment())
                 if result.returncode==0:
                     print(f"Result : {result.stdout}")
+                    cache = CondaPackageCache()
+                    if cache.isEnabled():
+                        cache.markEnvUsed(self.getEnvPrefix(name))
+                        cache.evictIfDue()
                     return (f"Result : {result.stdout}")
                 else :
                     print(f"Error : {result.stderr}")
                     return (f"Error : {result.stderr}")
             return "Nothing to install"
 
+    def condaPrefetchPackages(self,python_version:str,list_lib=[],conda_lib=[],cancel=None):
+        '''
+        Downloads in the package cache (CondaPackageCache) the packages of an environment without creating it,
+        so it can then be created offline : conda packages with conda create --download-only, pip wheels with pip download.
+        Returns an error without downloading anything if the cache is disabled (QSettings "cache/enabled").
+        '''
+        path_conda = self.getCondaExecutable()
+        if path_conda=="None":
+            return "Path to conda no setup"
+        cache = CondaPackageCache()
+        if not cache.isEnabled():
+            print("Error : the package cache is disabled (cache/enabled)")
+            return "Error : the package cache is disabled, set the QSettings cache/enabled to true to prefetch packages"
+        miniconda_root = os.path.abspath(os.path.join(os.path.dirname(path_conda), ".."))
+
+        conda_packages = list(conda_lib)
+        if list_lib and "pip" not in conda_packages:
+            conda_packages.append("pip")
+        with tempfile.TemporaryDirectory(prefix="slicerconda_prefetch_") as folder:
+            command = [path_conda, "create", "--download-only", "-p", os.path.join(folder, "env"), f"python={python_version}"] + conda_packages + ["-y"]
+            print("command in condaPrefetchPackages : ",command)
+            result = self.getBackend().run(command, cancel=cancel, timeout=self.getTimeout("install"), env=cache.condaEnvironment(conda_root=miniconda_root))
+        if result.returncode != 0:
+            print(f"Error : {result.stderr}")
+            return (f"Error : {result.stderr}")
 
-    def condaDeleteEnv(self,name:str):
+        if list_lib:
+            command = [path_conda, "run", "-p", miniconda_root, "python", "-m", "pip", "download", "-d", cache.wheelDirectory(),
+                       "--python-version", python_version, "--only-binary=:all:"] + list(list_lib)
+            print("command in condaPrefetchPackages : ",command)
+            result = self.getBackend().run(command, cancel=cancel, timeout=self.getTimeout("install"), env=slicer.util.startupEnvironment())
+            if result.returncode != 0:
+                print(f"Error : {result.stderr}")
+                return (f"Error : {result.stderr}")
+        cache.evictIfDue()
+        return (f"Result : {result.stdout}")
+
+
+    def condaDeleteEnv(self,name:str,cancel=None):
         '''
         Deletes a specified Conda environment and returns the status of the operation.
         '''
@@ -1505,9 +1957,13 @@ class CondaSetUpCall():
             path_conda = self.getCondaExecutable()
             if path_conda=="None":
                 return "Path to conda no setup"
+            # The prefix is resolved while the environment is still listed : it can be outside of <conda>/envs (envs_dirs, ~/.conda/envs)
+            prefix = self.getEnvPrefix(name)
             command_to_execute = [path_conda, "env", "remove","--name", name,"-y"]
             print(command_to_execute)
-            result = subprocess.run(command_to_execute, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, env=slicer.util.startupEnvironment())
+            result = self.getBackend().run(command_to_execute, cancel=cancel, timeout=self.getTimeout("install"), env=slicer.util.startupEnvironment())
+            self.invalidateEnvs()
+            CondaActivatedEnv.invalidate(prefix)
             if result.returncode == 0:
                 return "Delete"
             else :
@@ -1515,12 +1971,118 @@ class CondaSetUpCall():
                 return "Error"
         return "Not exist"
 
-    def condaRunFilePython(self,file_path:str,args=[],env_name="None"):
+    def condaListPackages(self,env_name="None")->dict:
+        '''
+        Returns the packages installed in an environment : normalized name -> {"name", "version", "source"}.
+        The files of the environment are read directly (CondaPackageList), without starting conda.
+        '''
+        if self.getCondaPath()=="None" or (env_name != "None" and not self.condaTestEnv(env_name)):
+            return {}
+        return CondaPackageList.get(self.getEnvPrefix(env_name))
+
+    def missingRequirements(self,env_name,requirements:list[str])->list[str]:
+        '''
+        Returns the requirements (e.g. "SimpleITK", "numpy>=1.24,<2") which aren't satisfied by the packages of an environment.
+        '''
+        return CondaPackageList.missing(self.condaListPackages(env_name), requirements)
+
+    def condaSyncEnv(self,env_name,requirements:list[str],cancel=None)->dict:
+        '''
+        Installs or upgrades in one pip call only the requirements which aren't satisfied by an environment, nothing if they all are.
+        Returns what changed : {"status": "Unchanged"/"Synced"/"Error : ...", "missing": requirements installed,
+        "installed": {name: version}, "changed": {name: [old, new]}, "removed": [name]}.
+        '''
+        report = {"status": "Unchanged", "missing": [], "installed": {}, "changed": {}, "removed": []}
+        path_conda = self.getCondaExecutable()
+        if path_conda=="None":
+            report["status"] = "Path to conda no setup"
+            return report
+        if not self.condaTestEnv(env_name):
+            report["status"] = f"Error : the environment {env_name} doesn't exist"
+            return report
+
+        before = dict(self.condaListPackages(env_name))
+        missing = CondaPackageList.missing(before, requirements)
+        report["missing"] = missing
+        if not missing:
+            print(f"The requirements of {env_name} are already satisfied")
+            return report
+
+        prefix = self.getEnvPrefix(env_name)
+        cache = CondaPackageCache()
+        command = [path_conda, "run", "-p", prefix, "python", "-m", "pip", "install"] + cache.pipArguments() + missing
+        print("command in condaSyncEnv : ",command)
+        result = self.getBackend().run(command, cancel=cancel, timeout=self.getTimeout("install"), env=slicer.util.startupEnvironment())
+        CondaActivatedEnv.invalidate(prefix)
+
+        after = self.condaListPackages(env_name)
+        for name, package in after.items():
+            if name not in before:
+                report["installed"][package["name"]] = package["version"]
+            elif before[name]["version"] != package["version"]:
+                report["changed"][package["name"]] = [before[name]["version"], package["version"]]
+        report["removed"] = [package["name"] for name, package in before.items() if name not in after]
+
+        if result.returncode != 0:
+            print(f"Error : {result.stderr}")
+            report["status"] = f"Error : {result.stderr}"
+        else:
+            report["status"] = "Synced"
+            if cache.isEnabled():
+                cache.markEnvUsed(prefix)
+                cache.evictIfDue()
+        print(f"Sync of {env_name} : {len(report['installed'])} installed, {len(report['changed'])} changed, {len(report['removed'])} removed")
+        return report
+
+    def getEnvPrefix(self,env_name="None"):
+        '''
+        Returns the folder of an environment ("None" is the base environment).
+        '''
+        path_conda = self.getCondaPath()
+        if env_name == "None":
+            return path_conda
+        registry = CondaEnvRegistry.getRegistry(path_conda)
+        if registry is not None:
+            info = registry.getEnv(env_name)
+            if info is not None:
+                return info["prefix"]
+        return os.path.join(path_conda,"envs",env_name)
+
+    def getEnvPython(self,env_name="None"):
+        '''
+        Returns the path of the python interpreter of an environment.
+        '''
+        prefix = self.getEnvPrefix(env_name)
+        if platform.system()=="Windows":
+            return os.path.join(prefix,"python.exe")
+        return os.path.join(prefix,"bin","python3")
+
+    def getActivatedEnvironment(self,env_name="None"):
+        '''
+        Returns the environment variables of the activated environment (captured once and cached by CondaActivatedEnv), or None if they can't be captured.
+        '''
+        path_condaexe = self.getCondaExecutable()
+        if path_condaexe=="None":
+            return None
+        prefix = self.getEnvPrefix(env_name)
+        info = CondaEnvRegistry.readEnv(prefix)
+        if info is None:
+            return None
+        return CondaActivatedEnv.get(path_condaexe, prefix, info["mtime"])
+
+    def condaRunFilePython(self,file_path:str,args=[],env_name="None",warm:bool=False,direct:bool=False,callback=None,cancel=None,timeout=None):
         '''
         Executes a Python script in a specified Conda environment, compatible with both Windows and Unix-like systems.
+        If warm is True, the script is executed by a persistent worker of the environment (see CondaWorker) :
+        the first call starts it, the next ones don't pay conda startup and the imports already done.
+        If direct is True, the interpreter of the environment is executed directly with the variables of the activated environment
+        instead of going through 'conda run'. 'conda run' is still used if the activation can't be captured.
+        If callback is given, the output is streamed : callback is called with a CondaOutputEvent for every line (see condaStreamFilePython).
+        timeout is in seconds (QSettings timeout/script if None, no limit if 0) : the script and its children are killed after it.
         '''
+        if timeout is None:
+            timeout = self.getTimeout("script")
         path_condaexe = self.getCondaExecutable()
-        path_conda = self.getCondaPath()
 
         if path_condaexe=="None":
             return "Path to conda no setup"
@@ -1528,7 +2090,58 @@ class CondaSetUpCall():
             if not self.condaTestEnv(env_name) :
                 return "Env doesn't exist"
 
-        
+        command, launch_env, direct = self.getFilePythonCommand(file_path,env_name,direct)
+
+        # print("args : ",args)
+        if warm :
+            if direct :
+                worker_command = command[:-1]
+            else :
+                worker_command = command[:2] + ["--no-capture-output"] + command[2:-1]
+            worker = CondaWorker.getWorker(env_name, worker_command, env=launch_env, idle_timeout=float(self.settings.value("worker/idleTimeout", 600)))
+            with CondaTracer.span("worker", "worker", argv=[file_path] + [str(arg) for arg in args], env=env_name) as span:
+                returncode, stdout, stderr = worker.run(file_path, args, cancel=cancel, timeout=timeout)
+                span.set(returncode=returncode, stdout_bytes=len(stdout.encode("utf-8")), stderr_bytes=len(stderr.encode("utf-8")))
+            if callback is not None:
+                # The worker answers once the script is finished, the events are replayed from its output
+                for kind, text in (("stdout", stdout), ("stderr", stderr)):
+                    for line in text.splitlines():
+                        callback(CondaOutputEvent.fromLine(kind, line))
+                callback(CondaOutputEvent("exit", returncode=returncode))
+            if returncode == 0:
+                print(f"Result: {stdout}")
+                return (f"Result: {stdout}")
+            else :
+                print(f"Error: {stderr}")
+                return (f"Error: {stderr}")
+
+        for arg in args:
+            # command.append("\""+str(arg)+"\"")
+            command.append(str(arg))
+
+        if callback is not None:
+            if not direct:
+                command.insert(2, "--no-capture-output")
+            print("command in condaRunFilePython : ",command)
+            return self.consumeStream(streamProcess(command, env=launch_env, cancel=cancel, timeout=timeout), callback)
+
+        print("command in condaRunFilePython : ",command)
+        result = self.getBackend().run(command, cancel=cancel, timeout=timeout, env=launch_env)
+        if result.returncode == 0:
+            print(f"Result: {result.stdout}")
+            return (f"Result: {result.stdout}")
+        else :
+            print(f"Error: {result.stderr}")
+            return (f"Error: {result.stderr}")
+
+    def getFilePythonCommand(self,file_path:str,env_name="None",direct:bool=False):
+        '''
+        Builds the command running a python file in an environment, without its arguments.
+        Returns (command, environment variables to launch it with, True if the interpreter is executed directly).
+        '''
+        path_condaexe = self.getCondaExecutable()
+        path_conda = self.getCondaPath()
+
         # file_path = "\""+file_path+"\""
         file_path = file_path
         if platform.system()=="Windows" :
@@ -1547,28 +2160,110 @@ class CondaSetUpCall():
                 path_python = os.path.join(path_conda,"bin","python3")
                 command = [path_condaexe, 'run',  path_python,file_path]
 
-        # print("args : ",args)
-        for arg in args:
-            # command.append("\""+str(arg)+"\"")
-            command.append(str(arg))
-
-
-        # command.append(argument)
-
+        launch_env = slicer.util.startupEnvironment()
+        if direct :
+            activated = self.getActivatedEnvironment(env_name)
+            if activated is not None:
+                command = [self.getEnvPython(env_name), file_path]
+                launch_env = activated
+            else :
+                print(f"The activation of {env_name} can't be captured, conda run is used")
+                direct = False
+        return command, launch_env, direct
 
-        print("command in condaRunFilePython : ",command)
-        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, env=slicer.util.startupEnvironment())
-        if result.returncode == 0:
-            print(f"Result: {result.stdout}")
-            return (f"Result: {result.stdout}")
-        else :
-            print(f"Error: {result.stderr}")
-            return (f"Error: {result.stderr}")
+    def condaRunFilePythonBatch(self,file_path:str,args_list:list,env_name="None",max_workers:int=0,direct:bool=True,callback=None,cancel=None,timeout=None)->list:
+        '''
+        Runs the same python file once per element of args_list (a list of argument lists), several processes at the same time.
+        The environment is checked and resolved once for the whole batch (with direct=True, the interpreter is executed directly, see condaRunFilePython).
+        max_workers is the number of processes running at the same time : QSettings jobs/maxConcurrent, or the number of CPUs, if it is 0.
+        Returns a list of CondaBatchResult in the order of args_list. callback, if given, is called with each CondaBatchResult when it is finished (in a thread of the pool).
+        '''
+        if timeout is None:
+            timeout = self.getTimeout("script")
+        args_list = [list(args) for args in args_list]
+        path_condaexe = self.getCondaExecutable()
+        if path_condaexe=="None":
+            return [CondaBatchResult(args, 1, "", "Path to conda no setup", 0.0) for args in args_list]
+        if env_name != "None" and not self.condaTestEnv(env_name):
+            return [CondaBatchResult(args, 1, "", "Env doesn't exist", 0.0) for args in args_list]
+
+        command, launch_env, direct = self.getFilePythonCommand(file_path,env_name,direct)
+        if max_workers <= 0:
+            max_workers = int(self.settings.value("jobs/maxConcurrent", 0) or 0) or os.cpu_count() or 1
+        max_workers = max(1, min(max_workers, len(args_list)))
+        print(f"command in condaRunFilePythonBatch : {command} x {len(args_list)} ({max_workers} processes)")
+
+        def runItem(args):
+            start = time.perf_counter()
+            result = self.getBackend().run(command + [str(arg) for arg in args], cancel=cancel, timeout=timeout, env=launch_env)
+            item = CondaBatchResult(args, result.returncode, result.stdout, result.stderr, time.perf_counter()-start)
+            if callback is not None:
+                callback(item)
+            return item
+
+        if not args_list:
+            return []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="CondaBatch") as executor:
+            return list(executor.map(runItem, args_list))
+
+    def condaStreamFilePython(self,file_path:str,args=[],env_name="None",direct:bool=False,cancel=None,timeout=None):
+        '''
+        Executes a Python script like condaRunFilePython but yields CondaOutputEvent objects while it runs :
+        one per line of stdout/stderr, one per progress line printed by the script (see utils/conda_progress.py) and a last "exit" event.
+        Closing the generator before the end kills the script.
+        '''
+        if timeout is None:
+            timeout = self.getTimeout("script")
+        path_condaexe = self.getCondaExecutable()
+        if path_condaexe=="None":
+            yield CondaOutputEvent("stderr", "Path to conda no setup")
+            yield CondaOutputEvent("exit", returncode=1)
+            return
+        if env_name != "None" and not self.condaTestEnv(env_name):
+            yield CondaOutputEvent("stderr", "Env doesn't exist")
+            yield CondaOutputEvent("exit", returncode=1)
+            return
+
+        command, launch_env, direct = self.getFilePythonCommand(file_path,env_name,direct)
+        if not direct:
+            command.insert(2, "--no-capture-output")
+        command += [str(arg) for arg in args]
+        print("command in condaStreamFilePython : ",command)
+        yield from streamProcess(command, env=launch_env, cancel=cancel, timeout=timeout)
+
+    def consumeStream(self,events,callback,tail_lines:int=1000):
+        '''
+        Calls callback on every event of a stream and returns "Result: ..." or "Error: ..." like condaRunFilePython.
+        Only the last tail_lines lines of stdout/stderr are kept for the returned string.
+        '''
+        stdout = collections.deque(maxlen=tail_lines)
+        stderr = collections.deque(maxlen=tail_lines)
+        returncode = 1
+        for event in events:
+            if event.kind == "stdout":
+                stdout.append(event.text)
+            elif event.kind == "stderr":
+                stderr.append(event.text)
+            elif event.kind == "exit":
+                returncode = event.returncode
+            callback(event)
+        if returncode == 0:
+            return "Result: " + "".join(line + "\n" for line in stdout)
+        return "Error: " + "".join(line + "\n" for line in stderr)
+
+    def condaStopWorker(self,env_name="None"):
+        '''
+        Stops the persistent worker started by condaRunFilePython(..., warm=True) for an environment.
+        '''
+        CondaWorker.stopWorker(env_name)
 
-    def condaRunCommand(self,command: list[str],env_name="None"):
+    def condaRunCommand(self,command: list[str],env_name="None",callback=None,cancel=None,timeout=None):
         '''
         Runs a command in a specified Conda environment, handling different operating systems.
+        If callback is given, it is called with a CondaOutputEvent for every line of output while the command runs.
         '''
+        if timeout is None:
+            timeout = self.getTimeout("script")
         path_activate = self.getActivateExecutable()
         if path_activate=="None":
             return "Path to conda no setup"
@@ -1579,11 +2274,15 @@ class CondaSetUpCall():
             command_execute = f"{path_conda_exe} run -n {env_name}"
         else :
             command_execute = f"{path_conda_exe} run"
+        if callback is not None:
+            command_execute = command_execute + " --no-capture-output"
         for com in command :
             command_execute = command_execute+ " "+com
 
         print("command_execute dans conda run : ",command_execute)
-        result = subprocess.run(command_execute, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8', errors='replace', env=slicer.util.startupEnvironment(),executable="/bin/bash")
+        if callback is not None:
+            return self.consumeStream(streamProcess(command_execute, env=slicer.util.startupEnvironment(), shell=True, executable="/bin/bash", cancel=cancel, timeout=timeout), callback)
+        result = self.getBackend().run(command_execute, cancel=cancel, timeout=timeout, env=slicer.util.startupEnvironment())
         if result.returncode == 0:
             print(f"Result: {result.stdout}")
             return (f"Result: {result.stdout}")
@@ -1592,12 +2291,2839 @@ class CondaSetUpCall():
             return (f"Error: {result.stderr}")
 
 
+class CondaBatchResult():
+    '''
+    Result of one execution of condaRunFilePythonBatch : its arguments, return code, output and duration in seconds.
+    '''
+    def __init__(self, args:list, returncode:int, stdout:str, stderr:str, duration:float) -> None:
+        self.args = args
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.duration = duration
 
+    def succeeded(self)->bool:
+        return self.returncode == 0
 
+    def __repr__(self) -> str:
+        return f"CondaBatchResult({self.args}, returncode={self.returncode}, duration={self.duration:.3f}s)"
 
 
-class DummyFile(io.IOBase):
-        def close(self):
+class CondaProgressChannel():
+    '''
+    Thread-safe channel through which installConda and condaCreateEnv report their progress ("20", "end", error messages, ...) in memory.
+    The thread doing the work puts messages, the UI thread drains them periodically (e.g. from a QTimer).
+    The other messages are free text, so END and NO_CONDA_PATH must be compared to the whole message.
+    '''
+    END = "end" # The operation has succeeded
+    NO_CONDA_PATH = "Path to conda not set up"
+
+    def __init__(self) -> None:
+        self.messages = queue.Queue()
+        self.last = None
+
+    def put(self, message):
+        self.messages.put(str(message))
+
+    def drain(self)->list[str]:
+        '''
+        Returns the messages received since the last call, without blocking.
+        '''
+        messages = []
+        while True:
+            try:
+                messages.append(self.messages.get_nowait())
+            except queue.Empty:
+                break
+        if messages:
+            self.last = messages[-1]
+        return messages
+
+    @staticmethod
+    def percent(message:str):
+        '''
+        Returns the percentage of a message, or None if it isn't a percentage.
+        '''
+        try:
+            return int(message.strip())
+        except ValueError:
+            return None
+
+
+class CondaInstallerDownloader():
+    '''
+    Downloads the Miniconda installer by chunks in a cache folder (QSettings "installer/cacheDirectory", ~/.slicerconda/installers by default),
+    from repo.anaconda.com or the mirror or the local installer of the QSettings "installer/source".
+    An interrupted download is resumed with an HTTP range request, the file is checked against its SHA-256 when it is known,
+    and an installer already downloaded is reused. The progress is reported in bytes to a CondaProgressChannel.
+    '''
+    def __init__(self, cache_directory:str=None, chunk_size:int=1024*1024, retries:int=3, timeout:float=30) -> None:
+        self.settings = QSettings("SlicerConda")
+        if cache_directory is None:
+            cache_directory = self.settings.value("installer/cacheDirectory", "") or os.path.join(os.path.expanduser("~"), ".slicerconda", "installers")
+        self.cache_directory = cache_directory
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.timeout = timeout
+
+    OFFICIAL_URL = "https://repo.anaconda.com/miniconda/"
+
+    def getInstaller(self, filename:str, sha256:str=None, source:str=None, progress=None, cancel=None, percent_range=(20, 50))->str:
+        '''
+        Returns the path of the installer filename, taken from source (QSettings "installer/source" by default) :
+        a local installer or a folder of installers (the network isn't used), or the URL of a mirror of repo.anaconda.com/miniconda.
+        A local installer can be a pinned version (Miniconda3-py311_24.1.2-0-Linux-x86_64.sh) but must be for the platform of filename.
+        It is copied in the cache folder under the name filename, so the caller can change the permissions of the copy.
+        '''
+        if source is None:
+            source = self.settings.value("installer/source", "")
+        source = source.strip() if source else ""
+        if source and not re.match(r"^(https?|ftp|file)://", source, re.IGNORECASE):
+            suffix = CondaInstallerDownloader.platformSuffix(filename)
+            if os.path.isdir(source):
+                path = os.path.join(source, filename)
+                if not os.path.isfile(path):
+                    candidates = sorted(name for name in os.listdir(source) if name.endswith(suffix) and os.path.isfile(os.path.join(source, name)))
+                    if len(candidates) > 1:
+                        raise ValueError(f"Several installers for {suffix[1:]} in {source}, set installer/source to one of them : {', '.join(candidates)}")
+                    if candidates:
+                        path = os.path.join(source, candidates[0])
+            else:
+                path = source
+            if not os.path.isfile(path):
+                raise FileNotFoundError(f"The installer {path} doesn't exist")
+            if not os.path.basename(path).endswith(suffix):
+                raise ValueError(f"The installer {path} isn't an installer for {suffix[1:]}")
+            actual = CondaInstallerDownloader.fileSha256(path).hexdigest()
+            if sha256 and actual != sha256.lower():
+                raise ValueError(f"The SHA-256 of {path} isn't {sha256}")
+            print(f"Local installer : {path}")
+            os.makedirs(self.cache_directory, exist_ok=True)
+            copy = os.path.join(self.cache_directory, filename)
+            if os.path.abspath(copy) != os.path.abspath(path):
+                shutil.copyfile(path, copy)
+                with open(copy + ".sha256", "w") as file:
+                    file.write(actual + "\n")
+            if progress is not None:
+                progress.put(str(percent_range[1]))
+            return copy
+        base_url = source or CondaInstallerDownloader.OFFICIAL_URL
+        return self.download(base_url.rstrip("/") + "/" + filename, filename, sha256=sha256, progress=progress, cancel=cancel, percent_range=percent_range)
+
+    @staticmethod
+    def platformSuffix(filename:str)->str:
+        '''
+        Returns the end of an installer name giving its platform : "-Linux-x86_64.sh" for Miniconda3-latest-Linux-x86_64.sh.
+        '''
+        parts = filename.split("-", 2)
+        return "-" + parts[2] if len(parts) == 3 else filename
+
+    @staticmethod
+    def fileSha256(path:str, digest=None):
+        digest = digest if digest is not None else hashlib.sha256()
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest
+
+    def reportBytes(self, progress, done:int, total:int, percent_range):
+        if progress is None:
+            return
+        if total:
+            low, high = percent_range
+            progress.put(str(low + int((high - low) * done / total)))
+            progress.put(f"Downloaded {done/(1024*1024):.1f}/{total/(1024*1024):.1f} MB")
+        else:
+            progress.put(f"Downloaded {done/(1024*1024):.1f} MB")
+
+    def download(self, url:str, filename:str=None, sha256:str=None, progress=None, cancel=None, percent_range=(20, 50))->str:
+        '''
+        Returns the path of the downloaded file in the cache folder. Raises an exception if it can't be downloaded or if its SHA-256 is wrong.
+        '''
+        os.makedirs(self.cache_directory, exist_ok=True)
+        filename = filename or os.path.basename(urllib.parse.urlparse(url).path)
+        path = os.path.join(self.cache_directory, filename)
+        path_part = path + ".part"
+        path_sha = path + ".sha256"
+        sha256 = sha256.lower() if sha256 else None
+
+        if os.path.isfile(path):
+            try:
+                with open(path_sha) as file:
+                    known = file.read().strip()
+            except OSError:
+                known = None
+            actual = CondaInstallerDownloader.fileSha256(path).hexdigest()
+            if actual == (sha256 or known):
+                print(f"Installer {path} already downloaded")
+                if progress is not None:
+                    progress.put(str(percent_range[1]))
+                return path
+            print(f"The installer {path} in the cache is outdated or corrupted, it is downloaded again")
+            os.remove(path)
+
+        for attempt in range(self.retries + 1):
+            if cancel is not None and cancel.isCancelled():
+                raise InterruptedError("Cancelled")
+            try:
+                self.downloadPart(url, path_part, progress, cancel, percent_range)
+                break
+            except (urllib.error.URLError, OSError, http.client.HTTPException) as e:
+                if isinstance(e, urllib.error.HTTPError) and e.code not in (408, 429, 500, 502, 503, 504):
+                    raise
+                if attempt == self.retries or isinstance(e, InterruptedError):
+                    raise
+                print(f"Download interrupted ({e}), resuming")
+                time.sleep(min(2 ** attempt, 10))
+
+        actual = CondaInstallerDownloader.fileSha256(path_part).hexdigest()
+        if sha256 and actual != sha256:
+            os.remove(path_part)
+            raise ValueError(f"The SHA-256 of {filename} is {actual}, {sha256} was expected")
+        os.replace(path_part, path)
+        with open(path_sha, "w") as file:
+            file.write(actual + "\n")
+        return path
+
+    def downloadPart(self, url:str, path_part:str, progress, cancel, percent_range):
+        '''
+        Downloads url in path_part, continuing the bytes already there when the server accepts range requests.
+        '''
+        done = os.path.getsize(path_part) if os.path.isfile(path_part) else 0
+        request = urllib.request.Request(url, headers={"Range": f"bytes={done}-"} if done else {})
+        try:
+            response = urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            if e.code != 416:
+                raise
+            # The part is already complete (or bigger than the file) : download it again from the start
+            os.remove(path_part)
+            done = 0
+            response = urllib.request.urlopen(urllib.request.Request(url), timeout=self.timeout)
+
+        with response:
+            status = getattr(response, "status", None) or response.getcode()
+            if done and status != 206:
+                done = 0
+            length = response.headers.get("Content-Length")
+            total = done + int(length) if length is not None else 0
+            with open(path_part, "ab" if done else "wb") as file:
+                last_report = 0
+                while True:
+                    if cancel is not None and cancel.isCancelled():
+                        raise InterruptedError("Cancelled")
+                    chunk = response.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    file.write(chunk)
+                    done += len(chunk)
+                    if done - last_report >= self.chunk_size or done == total:
+                        self.reportBytes(progress, done, total, percent_range)
+                        last_report = done
+        if total and done < total:
+            raise http.client.IncompleteRead(b"", total - done)
+
+
+CONDA_PROGRESS_TAG = "[SlicerConda:progress]"
+CONDA_LOCK_MARKER = "slicerconda-lock" # File of conda-meta holding the hash of the lockfile of an environment and of its package records
+CONDA_LOCK_PIP = "# pip:" # Prefix of the pip packages in a lockfile, a comment for conda
+CONDA_TEMPLATE_VERSION = 1 # Increase to stop using the template environments created by the previous versions
+
+
+class CondaOutputEvent():
+    '''
+    Event produced while a command is running :
+    - "stdout" / "stderr" : a line of output, in text
+    - "progress" : a line "[SlicerConda:progress] <percent> <message>" printed by the child, parsed in percent and message
+    - "exit" : the end of the command, with its returncode
+    '''
+    def __init__(self, kind:str, text:str="", percent=None, message:str="", returncode=None) -> None:
+        self.kind = kind
+        self.text = text
+        self.percent = percent
+        self.message = message
+        self.returncode = returncode
+
+    def __repr__(self) -> str:
+        if self.kind == "progress":
+            return f"CondaOutputEvent(progress, {self.percent}, {self.message!r})"
+        if self.kind == "exit":
+            return f"CondaOutputEvent(exit, {self.returncode})"
+        return f"CondaOutputEvent({self.kind}, {self.text!r})"
+
+    @staticmethod
+    def fromLine(kind:str, line:str):
+        '''
+        Builds the event of a line of output, recognizing the progress lines.
+        '''
+        if line.startswith(CONDA_PROGRESS_TAG):
+            parts = line[len(CONDA_PROGRESS_TAG):].strip().split(None, 1)
+            if parts:
+                try:
+                    percent = float(parts[0])
+                    return CondaOutputEvent("progress", line, percent=percent, message=parts[1] if len(parts) > 1 else "")
+                except ValueError:
+                    pass
+        return CondaOutputEvent(kind, line)
+
+
+def streamProcess(command, env=None, shell:bool=False, executable=None, cancel=None, timeout=None):
+    '''
+    Runs a command and yields a CondaOutputEvent for each line of stdout/stderr as soon as it is written, then an "exit" event.
+    The output isn't kept in memory. If the generator is closed before the end, cancel (a CondaCancelToken) is cancelled
+    or the command runs longer than timeout seconds, the process tree is killed. The run is recorded as a "process" span of CondaTracer.
+    '''
+    if cancel is not None and cancel.isCancelled():
+        yield CondaOutputEvent("stderr", "Cancelled")
+        yield CondaOutputEvent("exit", returncode=CondaCancelToken.CANCELLED_RETURNCODE)
+        return
+    env = dict(env if env is not None else slicer.util.startupEnvironment())
+    env["PYTHONUNBUFFERED"] = "1"
+    span = CondaTracer.startSpan(CondaTracer.commandName(command), "process", argv=command if isinstance(command, str) else [str(word) for word in command])
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8', errors='replace',
+                                   env=env, shell=shell, executable=executable, start_new_session=platform.system()!="Windows")
+    except OSError as e:
+        CondaTracer.endSpan(span, error=f"{type(e).__name__} : {e}")
+        raise
+    if cancel is not None:
+        cancel.attach(process)
+    lines = queue.Queue()
+    output_bytes = {"stdout": 0, "stderr": 0}
+
+    def read(pipe, kind):
+        for line in pipe:
+            output_bytes[kind] += len(line.encode("utf-8", "replace"))
+            lines.put((kind, line.rstrip("\r\n")))
+        pipe.close()
+        lines.put((kind, None))
+
+    readers = [threading.Thread(target=read, args=(process.stdout, "stdout"), daemon=True),
+               threading.Thread(target=read, args=(process.stderr, "stderr"), daemon=True)]
+    for reader in readers:
+        reader.start()
+
+    deadline = time.time() + timeout if timeout else None
+    try:
+        open_pipes = 2
+        while open_pipes:
+            try:
+                kind, line = lines.get(timeout=max(0.0, deadline - time.time()) if deadline else None)
+            except queue.Empty:
+                CondaCancelToken.killProcessTree(process)
+                process.wait()
+                span.set(timed_out=True)
+                yield CondaOutputEvent("stderr", f"Timeout : the command has been stopped after {timeout}s")
+                yield CondaOutputEvent("exit", returncode=CondaProcessResult.TIMEOUT_RETURNCODE)
+                return
+            if line is None:
+                open_pipes -= 1
+                continue
+            yield CondaOutputEvent.fromLine(kind, line)
+        yield CondaOutputEvent("exit", returncode=process.wait())
+    finally:
+        if process.poll() is None:
+            CondaCancelToken.killProcessTree(process)
+            process.wait()
+        if cancel is not None:
+            cancel.detach(process)
+        span.set(returncode=process.returncode, stdout_bytes=output_bytes["stdout"], stderr_bytes=output_bytes["stderr"])
+        CondaTracer.endSpan(span)
+
+
+class CondaProcessResult(subprocess.CompletedProcess):
+    '''
+    Result of runProcess : a subprocess.CompletedProcess with the duration of the command and the reason why it stopped.
+    When truncated is True, stdout and stderr only hold the last bytes written by the command (QSettings "process/maxOutput", in KB).
+    '''
+    TIMEOUT_RETURNCODE = 124
+
+    def __init__(self, args, returncode, stdout=None, stderr=None, duration:float=0.0, timed_out:bool=False, cancelled:bool=False, truncated:bool=False,
+                 stdout_bytes:int=0, stderr_bytes:int=0) -> None:
+        super().__init__(args, returncode, stdout, stderr)
+        self.duration = duration
+        self.timed_out = timed_out
+        self.cancelled = cancelled
+        self.truncated = truncated
+        # Bytes written by the command, including the ones dropped by the truncation
+        self.stdout_bytes = stdout_bytes
+        self.stderr_bytes = stderr_bytes
+
+    def succeeded(self)->bool:
+        return self.returncode == 0
+
+    def __repr__(self) -> str:
+        return (f"CondaProcessResult(returncode={self.returncode}, duration={self.duration:.2f}, timed_out={self.timed_out}, "
+                f"cancelled={self.cancelled}, truncated={self.truncated})")
+
+
+class CondaOutputBuffer():
+    '''
+    Ring buffer keeping the last max_bytes bytes read from a pipe (everything if max_bytes is 0).
+    '''
+    def __init__(self, max_bytes:int=0) -> None:
+        self.max_bytes = max_bytes
+        self.chunks = collections.deque()
+        self.size = 0
+        self.total = 0
+
+    def read(self, pipe):
+        read = getattr(pipe, "read1", pipe.read)
+        try:
+            for chunk in iter(lambda: read(65536), b""):
+                self.chunks.append(chunk)
+                self.size += len(chunk)
+                self.total += len(chunk)
+                while self.max_bytes and self.size - len(self.chunks[0]) >= self.max_bytes:
+                    self.size -= len(self.chunks.popleft())
+        except (OSError, ValueError):
+            pass
+        finally:
+            pipe.close()
+
+    def getvalue(self)->bytes:
+        data = b"".join(self.chunks)
+        if self.max_bytes and len(data) > self.max_bytes:
+            data = data[-self.max_bytes:]
+        return data
+
+    def truncated(self)->bool:
+        return self.total > len(self.getvalue())
+
+
+def readTimeout(settings, kind:str):
+    '''
+    Returns the timeout in seconds of a kind of command, from the QSettings "timeout/<kind>" (0 or None : no timeout) :
+    "query" (short conda commands, 120s by default), "install" (creation and installations, 3600s) and "script" (scripts and commands, none).
+    '''
+    defaults = {"query": 120, "install": 3600, "script": 0}
+    timeout = float(settings.value(f"timeout/{kind}", defaults.get(kind, 0)) or 0)
+    return timeout if timeout > 0 else None
+
+
+def runProcess(command, cancel=None, timeout=None, max_output=None, **kwargs):
+    '''
+    Runs a command like subprocess.run(command, **kwargs) and returns a CondaProcessResult (a subprocess.CompletedProcess).
+    The process is started in its own process group, so that cancel (a CondaCancelToken) or the timeout (in seconds, None or 0 for none)
+    kill it with all its children. The captured output is bounded to the last max_output bytes of each stream
+    (QSettings "process/maxOutput" in KB, 4096 by default). If cancel is already cancelled, the command isn't started.
+    Each run is recorded as a "process" span of CondaTracer.
+    '''
+    with CondaTracer.span(CondaTracer.commandName(command), "process", argv=command if isinstance(command, str) else [str(word) for word in command]) as span:
+        result = executeProcess(command, cancel, timeout, max_output, **kwargs)
+        span.set(returncode=result.returncode, stdout_bytes=result.stdout_bytes, stderr_bytes=result.stderr_bytes,
+                 timed_out=result.timed_out, cancelled=result.cancelled)
+        return result
+
+
+def executeProcess(command, cancel=None, timeout=None, max_output=None, **kwargs):
+    # runProcess without its span
+    # Both keys are removed : the pipes are always read as bytes by CondaOutputBuffer
+    text = kwargs.pop("text", False)
+    universal_newlines = kwargs.pop("universal_newlines", False)
+    text = bool(text or universal_newlines or kwargs.get("encoding") is not None)
+    encoding = kwargs.pop("encoding", None) or locale.getpreferredencoding(False)
+    errors = kwargs.pop("errors", None) or "strict"
+    if max_output is None:
+        max_output = int(float(QSettings("SlicerConda").value("process/maxOutput", 4096))) * 1024
+
+    def decode(data:bytes, truncated:bool):
+        if not text:
+            return data
+        # The first character may have been cut by the ring buffer
+        value = data.decode(encoding, "replace" if truncated else errors)
+        return value.replace("\r\n", "\n").replace("\r", "\n")
+
+    if cancel is not None and cancel.isCancelled():
+        return CondaProcessResult(command, CondaCancelToken.CANCELLED_RETURNCODE, decode(b"", False), decode(b"Cancelled", False), cancelled=True)
+
+    if kwargs.pop("capture_output", False):
+        kwargs["stdout"] = subprocess.PIPE
+        kwargs["stderr"] = subprocess.PIPE
+    own_group = platform.system() != "Windows" and kwargs.setdefault("start_new_session", True)
+    start = time.time()
+    process = subprocess.Popen(command, **kwargs)
+    if cancel is not None:
+        cancel.attach(process)
+
+    buffers = {}
+    readers = []
+    for name in ("stdout", "stderr"):
+        pipe = getattr(process, name)
+        if pipe is not None:
+            buffers[name] = CondaOutputBuffer(max_output)
+            readers.append(threading.Thread(target=buffers[name].read, args=(pipe,), daemon=True))
+    for reader in readers:
+        reader.start()
+
+    deadline = start + timeout if timeout else None
+    timed_out = False
+    try:
+        try:
+            process.wait(timeout=timeout if timeout else None)
+        except subprocess.TimeoutExpired:
+            timed_out = True
+            CondaCancelToken.killProcessTree(process)
+            process.wait()
+        for reader in readers:
+            reader.join(max(0.0, deadline - time.time()) if deadline and not timed_out else (5 if timed_out else None))
+        if any(reader.is_alive() for reader in readers):
+            # A child of the command still holds the pipes after the deadline
+            timed_out = True
+            if own_group:
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            for reader in readers:
+                reader.join(1)
+    finally:
+        if process.poll() is None:
+            CondaCancelToken.killProcessTree(process)
+            process.wait()
+        if cancel is not None:
+            cancel.detach(process)
+
+    cancelled = cancel is not None and cancel.isCancelled()
+    returncode = process.returncode
+    if cancelled:
+        returncode = CondaCancelToken.CANCELLED_RETURNCODE
+    elif timed_out:
+        returncode = CondaProcessResult.TIMEOUT_RETURNCODE
+    outputs = {}
+    truncated = False
+    for name in ("stdout", "stderr"):
+        if name in buffers:
+            truncated = truncated or buffers[name].truncated()
+            outputs[name] = decode(buffers[name].getvalue(), buffers[name].truncated())
+        else:
+            outputs[name] = None
+    if timed_out and outputs["stderr"] is not None:
+        message = f"\nTimeout : the command has been stopped after {timeout}s\n"
+        outputs["stderr"] += message if text else message.encode(encoding)
+    return CondaProcessResult(command, returncode, outputs["stdout"], outputs["stderr"], duration=time.time() - start,
+                              timed_out=timed_out, cancelled=cancelled, truncated=truncated,
+                              stdout_bytes=buffers["stdout"].total if "stdout" in buffers else 0,
+                              stderr_bytes=buffers["stderr"].total if "stderr" in buffers else 0)
+
+
+class CondaCancelToken():
+    '''
+    Cancellation shared between a job and the processes it launches (see runProcess and streamProcess).
+    cancel() kills the whole process tree of every attached process, and the processes started afterwards aren't launched.
+    '''
+    CANCELLED_RETURNCODE = -9
+
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.processes = set()
+        self.lock = threading.Lock()
+
+    def isCancelled(self)->bool:
+        return self.event.is_set()
+
+    def cancel(self):
+        with self.lock:
+            self.event.set()
+            processes = list(self.processes)
+        for process in processes:
+            CondaCancelToken.killProcessTree(process)
+
+    def attach(self, process):
+        with self.lock:
+            self.processes.add(process)
+            cancelled = self.event.is_set()
+        if cancelled:
+            CondaCancelToken.killProcessTree(process)
+
+    def detach(self, process):
+        with self.lock:
+            self.processes.discard(process)
+
+    @staticmethod
+    def killProcessTree(process):
+        '''
+        Kills a process and its children : the process group on Linux/MacOS, taskkill /T on Windows.
+        '''
+        if process.poll() is not None:
+            return
+        try:
+            if platform.system() == "Windows":
+                subprocess.run(["taskkill", "/F", "/T", "/PID", str(process.pid)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            else:
+                group = os.getpgid(process.pid)
+                # Never kill the group of Slicer itself if the process wasn't started in its own session
+                if group != os.getpgid(0):
+                    os.killpg(group, signal.SIGKILL)
+        except (OSError, ProcessLookupError):
+            pass
+        try:
+            process.kill()
+        except OSError:
+            pass
+
+
+class CondaSpan():
+    '''
+    One timed step of a conda operation : a call of a CondaSetUpCall/CondaSetUpCallWsl method ("call"), a process it launched ("process")
+    or a job run by a CondaWorker ("worker"). attributes holds env, argv, returncode, stdout_bytes, stderr_bytes... when they are known.
+    '''
+    def __init__(self, span_id:int, name:str, category:str, parent_id=None, attributes=None) -> None:
+        self.id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.category = category
+        self.attributes = dict(attributes or {})
+        self.start = time.time()
+        self.perf_start = time.perf_counter()
+        self.duration = None
+        self.error = None
+        self.thread_id = threading.get_ident()
+        self.thread_name = threading.current_thread().name
+        self.stack = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def finished(self)->bool:
+        return self.duration is not None
+
+    def toDict(self)->dict:
+        return {"id": self.id, "parent_id": self.parent_id, "name": self.name, "category": self.category, "start": self.start,
+                "duration": self.duration, "error": self.error, "thread": self.thread_name, "attributes": self.attributes}
+
+    def toTraceEvent(self, pid:int)->dict:
+        '''
+        Complete event ("ph": "X") of the Chrome trace-event format, times in microseconds.
+        '''
+        args = dict(self.attributes, span_id=self.id)
+        if self.parent_id is not None:
+            args["parent_id"] = self.parent_id
+        if self.error is not None:
+            args["error"] = self.error
+        return {"name": self.name, "cat": self.category, "ph": "X", "ts": self.start * 1e6, "dur": (self.duration or 0.0) * 1e6,
+                "pid": pid, "tid": self.thread_id, "args": args}
+
+    def __repr__(self) -> str:
+        duration = "running" if self.duration is None else f"{self.duration*1000:.1f}ms"
+        return f"CondaSpan({self.name!r}, {self.category}, {duration}, {self.attributes})"
+
+
+class CondaTracer():
+    '''
+    In-process tracing of the conda operations : every operation of CondaSetUpCall/CondaSetUpCallWsl and every process launched
+    by runProcess/streamProcess records a CondaSpan, nested in the span running in the same thread.
+    The last spans are kept in memory (QSettings "trace/maxSpans", 10000) and can be exported in the Chrome trace-event format
+    (chrome://tracing, https://ui.perfetto.dev). Other modules can follow the spans with addListener. Tracing is disabled with
+    QSettings "trace/enabled" false.
+    '''
+    _spans = None
+    _listeners = []
+    _lock = threading.Lock()
+    _local = threading.local()
+    _ids = 0
+    _enabled = None
+
+    @classmethod
+    def isEnabled(cls)->bool:
+        if cls._enabled is None:
+            cls._enabled = str(QSettings("SlicerConda").value("trace/enabled", "true")).lower() == "true"
+        return cls._enabled
+
+    @classmethod
+    def setEnabled(cls, enabled:bool):
+        QSettings("SlicerConda").setValue("trace/enabled", "true" if enabled else "false")
+        cls._enabled = bool(enabled)
+
+    @classmethod
+    def addListener(cls, listener):
+        '''
+        listener(event, span) is called with event "start" when a span starts and "end" when it is finished,
+        in the thread running the operation (a job thread for the operations of CondaJobManager).
+        '''
+        with cls._lock:
+            if listener not in cls._listeners:
+                cls._listeners.append(listener)
+
+    @classmethod
+    def removeListener(cls, listener):
+        with cls._lock:
+            if listener in cls._listeners:
+                cls._listeners.remove(listener)
+
+    @classmethod
+    def notify(cls, event:str, span:CondaSpan):
+        for listener in list(cls._listeners):
+            try:
+                listener(event, span)
+            except Exception as e:
+                print(f"Error in the CondaTracer listener {listener} : {e}")
+
+    @classmethod
+    def startSpan(cls, name:str, category:str="call", **attributes)->CondaSpan:
+        '''
+        Starts a span in the current thread. It must be finished by endSpan, prefer the span context manager.
+        '''
+        stack = getattr(cls._local, "stack", None)
+        if stack is None:
+            stack = cls._local.stack = []
+        with cls._lock:
+            cls._ids += 1
+            span_id = cls._ids
+        span = CondaSpan(span_id, name, category, stack[-1].id if stack else None, attributes)
+        span.stack = stack
+        stack.append(span)
+        if cls.isEnabled():
+            cls.notify("start", span)
+        return span
+
+    @classmethod
+    def endSpan(cls, span:CondaSpan, error=None):
+        if span.finished():
+            return
+        span.duration = time.perf_counter() - span.perf_start
+        span.error = error
+        if span in span.stack:
+            span.stack.remove(span)
+        span.stack = None
+        if not cls.isEnabled():
+            return
+        with cls._lock:
+            if cls._spans is None:
+                cls._spans = collections.deque(maxlen=max(1, int(QSettings("SlicerConda").value("trace/maxSpans", 10000))))
+            cls._spans.append(span)
+        cls.notify("end", span)
+
+    @classmethod
+    @contextlib.contextmanager
+    def span(cls, name:str, category:str="call", **attributes):
+        '''
+        Context manager recording a span around a block : with CondaTracer.span("name", env=env_name) as span: ... span.set(returncode=0)
+        '''
+        span = cls.startSpan(name, category, **attributes)
+        try:
+            yield span
+        except Exception as e:
+            cls.endSpan(span, error=f"{type(e).__name__} : {e}")
+            raise
+        finally:
+            cls.endSpan(span)
+
+    @classmethod
+    def spans(cls)->list:
+        with cls._lock:
+            return list(cls._spans or [])
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            if cls._spans is not None:
+                cls._spans.clear()
+
+    @classmethod
+    def exportChromeTrace(cls, path:str=None, spans=None)->dict:
+        '''
+        Returns the spans (the recorded ones by default) in the Chrome trace-event JSON format, and writes them in path if it is given.
+        '''
+        spans = cls.spans() if spans is None else list(spans)
+        pid = os.getpid()
+        events = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": "Slicer (SlicerConda)"}}]
+        threads = {}
+        for span in spans:
+            threads.setdefault(span.thread_id, span.thread_name)
+        for thread_id, thread_name in threads.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": thread_id, "args": {"name": thread_name}})
+        events += [span.toTraceEvent(pid) for span in spans if span.finished()]
+        trace = {"traceEvents": events, "displayTimeUnit": "ms"}
+        if path:
+            with open(path, "w") as file:
+                json.dump(trace, file)
+        return trace
+
+    @staticmethod
+    def commandName(command)->str:
+        '''
+        Short name of a command for its span : the executable, with the subcommand for conda (e.g. "conda create").
+        '''
+        words = command.split() if isinstance(command, str) else [str(word) for word in command]
+        if not words:
+            return "process"
+        name = os.path.basename(words[0].strip("\"'"))
+        if name.lower() in ("conda", "conda.exe", "mamba", "mamba.exe") and len(words) > 1 and not words[1].startswith("-"):
+            name += " " + words[1]
+        return name
+
+    @staticmethod
+    def summarizeResult(result):
+        if result is None or isinstance(result, (bool, int, float)):
+            return result
+        if isinstance(result, str):
+            return result[:200]
+        if isinstance(result, dict) and "status" in result:
+            return result["status"]
+        if isinstance(result, (list, tuple, dict)):
+            return f"{type(result).__name__} of {len(result)} items"
+        return type(result).__name__
+
+    @staticmethod
+    def traceMethod(class_name:str, function):
+        '''
+        Returns function wrapped to record a "call" span named ClassName.method, with the environment it works on.
+        '''
+        signature = inspect.signature(function)
+        span_name = f"{class_name}.{function.__name__}"
+
+        def attributes(args, kwargs):
+            try:
+                arguments = signature.bind_partial(*args, **kwargs).arguments
+            except TypeError:
+                return {}
+            env = arguments.get("env_name", arguments.get("name"))
+            span_attributes = {} if env in (None, "None") else {"env": str(env)}
+            requirements = CondaOperationHistory.requirementsKey(arguments.get("python_version"), arguments.get("list_lib") or [],
+                                                                 arguments.get("conda_lib") or [], arguments.get("requirements") or [])
+            if requirements:
+                span_attributes["requirements"] = requirements
+            if arguments.get("file_path"):
+                span_attributes["file"] = str(arguments["file_path"])
+            return span_attributes
+
+        if inspect.isgeneratorfunction(function):
+            @functools.wraps(function)
+            def generator(*args, **kwargs):
+                with CondaTracer.span(span_name, "call", **attributes(args, kwargs)):
+                    yield from function(*args, **kwargs)
+            return generator
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with CondaTracer.span(span_name, "call", **attributes(args, kwargs)) as span:
+                result = function(*args, **kwargs)
+                span.set(result=CondaTracer.summarizeResult(result))
+                return result
+        return wrapper
+
+    @staticmethod
+    def traceOperations(cls):
+        '''
+        Traces the operations of a class : its methods named conda*, installConda and missingRequirements.
+        The accessors (get*, set*...) used inside the operations aren't traced.
+        '''
+        for name, function in list(vars(cls).items()):
+            if inspect.isfunction(function) and (name.startswith("conda") or name in ("installConda", "missingRequirements")):
+                setattr(cls, name, CondaTracer.traceMethod(cls.__name__, function))
+        return cls
+
+
+class CondaOperationHistory():
+    '''
+    Persistent history of the long conda operations (creations, installations, runs...) in a SQLite file
+    (QSettings "history/path", ~/.slicerconda/history.sqlite by default) : outcome and duration of each operation, keyed by
+    operation, environment, requirement set and machine. It is fed by the "call" spans of CondaTracer, so tracing must be enabled,
+    and gives duration statistics, ETA estimates for the UI and the slowdown of an operation after a conda or package update.
+    The runs of scripts and commands (RUN_OPERATIONS) are only saved when they last at least "history/minDuration" seconds (1 by default),
+    and only the last "history/maxRows" operations (10000) are kept.
+    '''
+    OPERATIONS = ("installConda", "condaCreateEnv", "condaCreateEnvFromLock", "condaCloneEnv", "condaInstallLibEnv", "condaSyncEnv",
+                  "condaDeleteEnv", "condaPrefetchPackages", "condaLockEnv", "condaExportEnv", "condaImportEnv",
+                  "condaRunFilePython", "condaRunFilePythonBatch", "condaRunCommand")
+    RUN_OPERATIONS = ("condaRunFilePython", "condaRunFilePythonBatch", "condaRunCommand")
+    SCHEMA_VERSION = 2
+    _lock = threading.Lock()
+    # Databases whose schema is up to date and versions of conda, so recording an operation doesn't check them again
+    _ready = set()
+    _condaVersions = {}
+
+    def __init__(self, path:str=None) -> None:
+        settings = QSettings("SlicerConda")
+        self.path = path or settings.value("history/path", "") or os.path.join(os.path.expanduser("~"), ".slicerconda", "history.sqlite")
+        self.machine = f"{platform.node()}|{platform.system()}|{platform.machine()}"
+
+    @staticmethod
+    def isEnabled()->bool:
+        return str(QSettings("SlicerConda").value("history/enabled", "true")).lower() == "true"
+
+    @staticmethod
+    def requirementsKey(python_version=None, list_lib=(), conda_lib=(), requirements=()):
+        '''
+        Key of a requirement set, independent of the order of the requirements, or None if there is no requirement.
+        '''
+        parts = [f"python={str(python_version).strip()}"] if python_version else []
+        parts += sorted(str(lib).strip() for lib in list(list_lib) + list(requirements) if str(lib).strip())
+        parts += sorted("conda:" + str(lib).strip() for lib in conda_lib if str(lib).strip())
+        return " ".join(parts) or None
+
+    @staticmethod
+    def condaVersion(conda_path:str):
+        '''
+        Version of conda in an installation, read from its conda-meta folder, or None.
+        '''
+        if not conda_path or conda_path == "None":
+            return None
+        if conda_path not in CondaOperationHistory._condaVersions:
+            version = None
+            for record in glob.glob(os.path.join(conda_path, "conda-meta", "conda-[0-9]*.json")):
+                version = os.path.basename(record)[len("conda-"):].split("-")[0]
+                break
+            CondaOperationHistory._condaVersions[conda_path] = version
+        return CondaOperationHistory._condaVersions[conda_path]
+
+    def connect(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        ready = self.path in CondaOperationHistory._ready and os.path.exists(self.path)
+        connection = sqlite3.connect(self.path, timeout=10)
+        connection.row_factory = sqlite3.Row
+        if ready:
+            return connection
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+        if version < self.SCHEMA_VERSION:
+            connection.executescript('''
+                CREATE TABLE IF NOT EXISTS operations (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    operation TEXT NOT NULL,
+                    env TEXT,
+                    requirements TEXT,
+                    file TEXT,
+                    machine TEXT NOT NULL,
+                    conda_version TEXT,
+                    start REAL NOT NULL,
+                    duration REAL NOT NULL,
+                    success INTEGER NOT NULL,
+                    status TEXT
+                );
+                CREATE INDEX IF NOT EXISTS operations_key ON operations (operation, machine, requirements, start);
+            ''')
+            if version == 1:
+                # The version 1 stored the script of the runs in requirements
+                connection.executescript('''
+                    ALTER TABLE operations ADD COLUMN file TEXT;
+                    UPDATE operations SET file = requirements, requirements = NULL
+                        WHERE operation LIKE '%.condaRunFilePython' OR operation LIKE '%.condaRunFilePythonBatch';
+                ''')
+            connection.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+            connection.commit()
+        CondaOperationHistory._ready.add(self.path)
+        return connection
+
+    def record(self, operation:str, duration:float, success:bool, env=None, requirements=None, status=None, start=None, conda_version=None, file=None):
+        '''
+        Adds an operation to the history and deletes the oldest ones beyond "history/maxRows". Errors of the database are printed and ignored.
+        '''
+        max_rows = int(float(QSettings("SlicerConda").value("history/maxRows", 10000) or 0))
+        try:
+            with CondaOperationHistory._lock:
+                connection = self.connect()
+                try:
+                    with connection:
+                        connection.execute("INSERT INTO operations (operation, env, requirements, file, machine, conda_version, start, duration, success, status) "
+                                           "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                           (operation, env, requirements, file, self.machine, conda_version, start if start is not None else time.time() - duration,
+                                            duration, 1 if success else 0, None if status is None else str(status)[:500]))
+                        if max_rows > 0:
+                            connection.execute("DELETE FROM operations WHERE id <= (SELECT id FROM operations ORDER BY id DESC LIMIT 1 OFFSET ?)", (max_rows,))
+                finally:
+                    connection.close()
+        except (sqlite3.Error, OSError) as e:
+            print(f"The operation {operation} can't be saved in the history {self.path} : {e}")
+
+    @classmethod
+    def onSpan(cls, event:str, span):
+        '''
+        Listener of CondaTracer recording the finished operations of OPERATIONS (the runs only if they are long enough).
+        '''
+        if event != "end" or span.category != "call" or not cls.isEnabled():
+            return
+        class_name, _, operation = span.name.rpartition(".")
+        if operation not in cls.OPERATIONS:
+            return
+        if operation in cls.RUN_OPERATIONS and span.duration < float(QSettings("SlicerConda").value("history/minDuration", 1.0) or 0):
+            return
+        result = span.attributes.get("result")
+        success = span.error is None and result is not False and not (isinstance(result, str) and result.startswith(
+            ("Error", "Path to conda", "Env doesn't exist", "Not exist")))
+        conda_version = cls.condaVersion(QSettings("SlicerConda").value("condaPath", "")) if class_name == "CondaSetUpCall" else None
+        cls().record(span.name, span.duration, success, env=span.attributes.get("env"), requirements=span.attributes.get("requirements"),
+                     status=span.error or result, start=span.start, conda_version=conda_version, file=span.attributes.get("file"))
+
+    def query(self, operation:str=None, env:str=None, requirements:str=None, success=None, since:float=None, all_machines:bool=False, limit:int=100,
+              file:str=None)->list:
+        '''
+        Returns the recorded operations matching the filters, the most recent first, as dicts.
+        '''
+        conditions, values = [], []
+        for column, value in (("operation", operation), ("env", env), ("requirements", requirements), ("file", file)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                values.append(value)
+        if success is not None:
+            conditions.append("success = ?")
+            values.append(1 if success else 0)
+        if since is not None:
+            conditions.append("start >= ?")
+            values.append(since)
+        if not all_machines:
+            conditions.append("machine = ?")
+            values.append(self.machine)
+        sql = "SELECT * FROM operations" + (" WHERE " + " AND ".join(conditions) if conditions else "") + " ORDER BY start DESC LIMIT ?"
+        try:
+            connection = self.connect()
+            try:
+                return [dict(row) for row in connection.execute(sql, values + [int(limit)])]
+            finally:
+                connection.close()
+        except (sqlite3.Error, OSError) as e:
+            print(f"Can't read the history {self.path} : {e}")
+            return []
+
+    @staticmethod
+    def median(values:list):
+        values = sorted(values)
+        if not values:
+            return None
+        middle = len(values) // 2
+        return values[middle] if len(values) % 2 else (values[middle-1] + values[middle]) / 2
+
+    def stats(self, operation:str, env:str=None, requirements:str=None, last:int=20)->dict:
+        '''
+        Duration statistics (seconds) of the last runs of an operation on this machine : count, success_rate, and p50, p95, mean, min, max of the successful ones.
+        '''
+        rows = self.query(operation, env, requirements, limit=last)
+        durations = sorted(row["duration"] for row in rows if row["success"])
+        return {
+            "count": len(rows),
+            "success_rate": (sum(row["success"] for row in rows) / len(rows)) if rows else None,
+            "p50": self.median(durations),
+            "p95": durations[min(len(durations)-1, int(round(0.95 * (len(durations)-1))))] if durations else None,
+            "mean": sum(durations) / len(durations) if durations else None,
+            "min": durations[0] if durations else None,
+            "max": durations[-1] if durations else None,
+            "last": rows[0]["duration"] if rows else None,
+        }
+
+    def estimate(self, operation:str, env:str=None, requirements:str=None, samples:int=10):
+        '''
+        Expected duration in seconds of an operation : median of its last successful runs with the same requirement set,
+        else in the same environment, else of any run of the operation on this machine. None if it has never been run.
+        '''
+        candidates = []
+        if requirements is not None:
+            candidates.append({"requirements": requirements})
+        if env is not None:
+            candidates.append({"env": env})
+        candidates.append({})
+        for filters in candidates:
+            rows = self.query(operation, success=True, limit=samples, **filters)
+            if rows:
+                return self.median([row["duration"] for row in rows])
+        return None
+
+    def remaining(self, operation:str, elapsed:float, env:str=None, requirements:str=None):
+        '''
+        Estimated remaining time in seconds of an operation running for elapsed seconds (0 if it is late), None without history.
+        '''
+        expected = self.estimate(operation, env, requirements)
+        if expected is None:
+            return None
+        return max(0.0, expected - elapsed)
+
+    def slowdown(self, operation:str, requirements:str=None, recent:int=5):
+        '''
+        Ratio between the median duration of the last recent successful runs and of the runs before them (1.5 : 50% slower),
+        None without enough history.
+        '''
+        rows = self.query(operation, requirements=requirements, success=True, limit=recent * 5)
+        if len(rows) < recent + 1:
+            return None
+        before = self.median([row["duration"] for row in rows[recent:]])
+        if not before:
+            return None
+        return self.median([row["duration"] for row in rows[:recent]]) / before
+
+    def clear(self, before:float=None):
+        '''
+        Deletes the history, or only the operations started before a timestamp.
+        '''
+        try:
+            with CondaOperationHistory._lock:
+                connection = self.connect()
+                try:
+                    with connection:
+                        if before is None:
+                            connection.execute("DELETE FROM operations")
+                        else:
+                            connection.execute("DELETE FROM operations WHERE start < ?", (before,))
+                finally:
+                    connection.close()
+        except (sqlite3.Error, OSError) as e:
+            print(f"Can't clear the history {self.path} : {e}")
+
+    @staticmethod
+    def formatDuration(seconds:float)->str:
+        seconds = int(round(seconds))
+        if seconds < 60:
+            return f"{seconds}s"
+        return f"{seconds // 60}min {seconds % 60:02d}s"
+
+
+# The operations of both classes record their spans (CondaTracer is defined after them), saved in the history by CondaOperationHistory.onSpan
+CondaTracer.traceOperations(CondaSetUpCallWsl)
+CondaTracer.traceOperations(CondaSetUpCall)
+CondaTracer.addListener(CondaOperationHistory.onSpan)
+
+
+class CondaExecutionBackend():
+    '''
+    How the commands of CondaSetUpCall/CondaSetUpCallWsl are launched. run(command) takes a list of arguments (executed without shell)
+    or a bash command line, and returns a CondaProcessResult with the text output. The backends are shared (see getBackend) :
+    CondaLocalBackend starts a process per command, CondaWslBackend a 'wsl bash -c' per command and CondaBashSessionBackend
+    sends the commands to long-lived bash sessions, local or in WSL.
+    '''
+    _backends = {}
+    _backendsLock = threading.Lock()
+
+    @classmethod
+    def getBackend(cls, key:str, factory):
+        '''
+        Returns the backend registered under key, created by factory() the first time.
+        '''
+        with cls._backendsLock:
+            backend = cls._backends.get(key)
+            if backend is None:
+                backend = factory()
+                cls._backends[key] = backend
+            return backend
+
+    @classmethod
+    def closeAll(cls):
+        '''
+        Closes every backend (the bash sessions are stopped), called when Slicer closes.
+        '''
+        with cls._backendsLock:
+            backends = list(cls._backends.values())
+            cls._backends.clear()
+        for backend in backends:
+            backend.close()
+
+    @staticmethod
+    def toShell(command)->str:
+        if isinstance(command, str):
+            return command
+        return " ".join(shlex.quote(str(word)) for word in command)
+
+    def run(self, command, cancel=None, timeout=None, env=None, max_output=None)->CondaProcessResult:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class CondaLocalBackend(CondaExecutionBackend):
+    '''
+    A new process per command (a bash -c for the command lines, cmd on Windows), launched by runProcess.
+    '''
+    def run(self, command, cancel=None, timeout=None, env=None, max_output=None)->CondaProcessResult:
+        kwargs = {}
+        if isinstance(command, str):
+            kwargs["shell"] = True
+            if platform.system() != "Windows":
+                kwargs["executable"] = "/bin/bash"
+        return runProcess(command, cancel=cancel, timeout=timeout, max_output=max_output, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          text=True, encoding='utf-8', errors='replace', env=env if env is not None else slicer.util.startupEnvironment(), **kwargs)
+
+
+class CondaWslBackend(CondaExecutionBackend):
+    '''
+    A 'wsl --user <user> -- bash -c <command>' per command. env is the environment of wsl.exe, it isn't passed to Linux.
+    '''
+    def __init__(self, user:str) -> None:
+        self.user = user
+
+    def run(self, command, cancel=None, timeout=None, env=None, max_output=None)->CondaProcessResult:
+        return runProcess(["wsl", "--user", self.user, "--", "bash", "-c", self.toShell(command)], cancel=cancel, timeout=timeout, max_output=max_output,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8', errors='replace',
+                          env=env if env is not None else slicer.util.startupEnvironment())
+
+
+class CondaBashSession():
+    '''
+    A long-lived bash reading commands on its stdin. Each command runs in a subshell (so 'cd' or 'exit' don't change the session)
+    with its stdin closed, followed by a sentinel line on stdout (with the return code) and on stderr : the output of a command
+    is everything before its sentinels. Only one command runs at a time in a session.
+    '''
+    def __init__(self, launcher:list, env=None) -> None:
+        self.launcher = launcher
+        self.env = dict(env) if env is not None else None
+        self.token = os.urandom(8).hex()
+        self.count = 0
+        self.process = subprocess.Popen(launcher, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=self.env,
+                                        start_new_session=platform.system()!="Windows")
+        self.output = queue.Queue()
+        for name in ("stdout", "stderr"):
+            threading.Thread(target=self.read, args=(getattr(self.process, name), name), daemon=True, name=f"CondaBashSession-{name}").start()
+
+    def read(self, pipe, name):
+        read = getattr(pipe, "read1", pipe.read)
+        try:
+            for chunk in iter(lambda: read(65536), b""):
+                self.output.put((name, chunk))
+        except (OSError, ValueError):
+            pass
+        pipe.close()
+        self.output.put((name, None))
+
+    def isAlive(self)->bool:
+        return self.process.poll() is None
+
+    def environmentScript(self, env)->list:
+        '''
+        export/unset lines giving env to a command, from the differences with the environment of the session.
+        '''
+        if env is None or self.env is None:
+            return []
+        lines = [f"export {key}={shlex.quote(value)}" for key, value in env.items() if self.env.get(key) != value and re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", key)]
+        lines += [f"unset {key}" for key in self.env if key not in env and re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", key)]
+        return lines
+
+    def run(self, command:str, cancel=None, timeout=None, env=None, max_output=0):
+        '''
+        Runs a bash command line in the session and returns (returncode, stdout bytes, stderr bytes, timed_out, truncated, output bytes).
+        The session is killed on cancel or timeout (a new one is started for the next command).
+        '''
+        self.count += 1
+        marker = f"__SLICERCONDA_{self.token}_{self.count}__"
+        # The command is given to eval as one quoted word : a syntax error (unbalanced quotes, ')') stays in the subshell
+        script = "\n".join(["("] + self.environmentScript(env) + ["eval " + shlex.quote(command), ") </dev/null", "__slicerconda_status=$?",
+                            f"printf '\\n%s %d\\n' '{marker}' \"$__slicerconda_status\"", f"printf '\\n%s\\n' '{marker}' >&2", ""])
+        outputs = {"stdout": CondaSessionOutput(marker, max_output), "stderr": CondaSessionOutput(marker, max_output)}
+        if cancel is not None:
+            cancel.attach(self.process)
+        timed_out = False
+        try:
+            try:
+                self.process.stdin.write(script.encode("utf-8"))
+                self.process.stdin.flush()
+            except (OSError, ValueError):
+                self.kill()
+                return (1, b"", b"The bash session has stopped", False, False, {"stdout": 0, "stderr": 0})
+            deadline = time.time() + timeout if timeout else None
+            while not (outputs["stdout"].done and outputs["stderr"].done):
+                try:
+                    name, chunk = self.output.get(timeout=max(0.0, deadline - time.time()) if deadline else None)
+                except queue.Empty:
+                    timed_out = True
+                    self.kill()
+                    break
+                if chunk is None:
+                    # The session died : killed by a cancellation or by the command ('exec', ...)
+                    outputs[name].done = True
+                    self.kill()
+                    continue
+                outputs[name].feed(chunk)
+        finally:
+            if cancel is not None:
+                cancel.detach(self.process)
+        returncode = outputs["stdout"].returncode
+        if returncode is None:
+            returncode = CondaProcessResult.TIMEOUT_RETURNCODE if timed_out else (self.process.returncode or 1)
+        return (returncode, outputs["stdout"].getvalue(), outputs["stderr"].getvalue(), timed_out,
+                outputs["stdout"].truncated or outputs["stderr"].truncated, {name: output.total for name, output in outputs.items()})
+
+    def kill(self):
+        if self.process.poll() is None:
+            CondaCancelToken.killProcessTree(self.process)
+            try:
+                self.process.wait(5)
+            except subprocess.TimeoutExpired:
+                pass
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+
+    def close(self):
+        if self.process.poll() is None:
+            try:
+                self.process.stdin.write(b"exit\n")
+                self.process.stdin.flush()
+                self.process.wait(2)
+            except (OSError, ValueError, subprocess.TimeoutExpired):
+                self.kill()
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+
+
+class CondaSessionOutput():
+    '''
+    Output of one command of a CondaBashSession on one stream : the bytes before the line of its marker, bounded to the last max_bytes.
+    '''
+    def __init__(self, marker:str, max_bytes:int=0) -> None:
+        self.marker = ("\n" + marker).encode("ascii")
+        self.max_bytes = max_bytes
+        self.data = bytearray()
+        self.total = 0
+        self.truncated = False
+        self.done = False
+        self.returncode = None
+        self.end = None
+
+    def feed(self, chunk:bytes):
+        if self.done:
+            return
+        start = max(0, len(self.data) - len(self.marker))
+        self.data += chunk
+        if self.end is None:
+            index = self.data.find(self.marker, start)
+            if index >= 0:
+                self.end = index
+        if self.end is not None:
+            line_end = self.data.find(b"\n", self.end + len(self.marker))
+            if line_end >= 0:
+                status = self.data[self.end + len(self.marker):line_end].strip()
+                self.returncode = int(status) if status.lstrip(b"-").isdigit() else None
+                self.done = True
+            return
+        # Keep the end of the output, with enough bytes to find a marker cut between two chunks
+        if self.max_bytes and len(self.data) > 2 * (self.max_bytes + len(self.marker)):
+            drop = len(self.data) - self.max_bytes - len(self.marker)
+            del self.data[:drop]
+            self.total += drop
+            self.truncated = True
+
+    def getvalue(self)->bytes:
+        data = bytes(self.data[:self.end] if self.end is not None else self.data)
+        self.total += len(data)
+        if self.max_bytes and len(data) > self.max_bytes:
+            self.truncated = True
+            data = data[-self.max_bytes:]
+        return data
+
+
+class CondaBashSessionBackend(CondaExecutionBackend):
+    '''
+    Runs the commands in long-lived bash sessions : no shell or launcher (wsl.exe) startup per command.
+    Up to max_sessions commands run at the same time, each one in its own session. launcher is the command starting a session
+    (["wsl", "--user", user, "--", "bash", ...] for WSL) ; env is forwarded to the commands only if forward_env is True (local sessions).
+    '''
+    def __init__(self, launcher:list=None, max_sessions:int=2, forward_env:bool=True) -> None:
+        self.launcher = launcher or ["bash", "--norc", "--noprofile"]
+        self.max_sessions = max(1, max_sessions)
+        self.forward_env = forward_env
+        self.idle = []
+        self.count = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, cancel=None, deadline=None):
+        '''
+        Returns an idle session, or a new one if less than max_sessions are running. Waits for one to be released,
+        and returns None if cancel is cancelled or the deadline (time.time()) is reached before.
+        '''
+        with self.condition:
+            while True:
+                while self.idle:
+                    session = self.idle.pop()
+                    if session.isAlive():
+                        return session
+                    self.count -= 1
+                if self.count < self.max_sessions:
+                    self.count += 1
+                    break
+                if cancel is not None and cancel.isCancelled():
+                    return None
+                wait = 0.1 if cancel is not None else None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    wait = min(wait, remaining) if wait is not None else remaining
+                self.condition.wait(wait)
+        try:
+            return CondaBashSession(self.launcher, slicer.util.startupEnvironment())
+        except OSError:
+            with self.condition:
+                self.count -= 1
+                self.condition.notify()
+            raise
+
+    def release(self, session:CondaBashSession):
+        with self.condition:
+            if session.isAlive():
+                self.idle.append(session)
+            else:
+                self.count -= 1
+            self.condition.notify()
+
+    def run(self, command, cancel=None, timeout=None, env=None, max_output=None)->CondaProcessResult:
+        '''
+        Runs a command in an idle session. The run is recorded as a "process" span of CondaTracer, like the ones of runProcess.
+        '''
+        if max_output is None:
+            max_output = int(float(QSettings("SlicerConda").value("process/maxOutput", 4096))) * 1024
+        with CondaTracer.span(CondaTracer.commandName(command), "process", argv=command if isinstance(command, str) else [str(word) for word in command],
+                              backend="session") as span:
+            if cancel is not None and cancel.isCancelled():
+                result = CondaProcessResult(command, CondaCancelToken.CANCELLED_RETURNCODE, "", "Cancelled", cancelled=True)
+            else:
+                start = time.time()
+                # The timeout includes the wait for a session
+                deadline = start + timeout if timeout else None
+                session = self.acquire(cancel, deadline)
+                if session is None:
+                    returncode, stdout, stderr, timed_out, truncated, output_bytes = (1, b"", b"", not (cancel is not None and cancel.isCancelled()),
+                                                                                      False, {"stdout": 0, "stderr": 0})
+                else:
+                    try:
+                        returncode, stdout, stderr, timed_out, truncated, output_bytes = session.run(self.toShell(command), cancel,
+                                                                                                      max(0.001, deadline - time.time()) if deadline else None,
+                                                                                                      env if self.forward_env else None, max_output)
+                    finally:
+                        self.release(session)
+                cancelled = cancel is not None and cancel.isCancelled()
+                stdout = stdout.decode("utf-8", "replace")
+                stderr = stderr.decode("utf-8", "replace")
+                if cancelled:
+                    returncode = CondaCancelToken.CANCELLED_RETURNCODE
+                elif timed_out:
+                    returncode = CondaProcessResult.TIMEOUT_RETURNCODE
+                    stderr += f"\nTimeout : the command has been stopped after {timeout}s\n"
+                result = CondaProcessResult(command, returncode, stdout, stderr, duration=time.time() - start, timed_out=timed_out, cancelled=cancelled,
+                                            truncated=truncated, stdout_bytes=output_bytes["stdout"], stderr_bytes=output_bytes["stderr"])
+            span.set(returncode=result.returncode, stdout_bytes=result.stdout_bytes, stderr_bytes=result.stderr_bytes,
+                     timed_out=result.timed_out, cancelled=result.cancelled)
+            return result
+
+    def close(self):
+        with self.condition:
+            sessions = self.idle
+            self.idle = []
+            self.count -= len(sessions)
+        for session in sessions:
+            session.close()
+
+
+class CondaJob():
+    '''
+    A conda operation submitted to a CondaJobManager. It wraps the future of the operation and its CondaCancelToken.
+    '''
+    def __init__(self, name:str) -> None:
+        self.name = name
+        self.future = None
+        self.token = CondaCancelToken()
+        self.callbacks = []
+        self.delivered = False
+
+    def cancel(self)->bool:
+        '''
+        Cancels the job : a pending job is never started, a running one has its processes killed.
+        '''
+        if self.future is not None and self.future.cancel():
+            return True
+        self.token.cancel()
+        return True
+
+    def cancelled(self)->bool:
+        return self.token.isCancelled() or (self.future is not None and self.future.cancelled())
+
+    def done(self)->bool:
+        return self.future is not None and self.future.done()
+
+    def running(self)->bool:
+        return self.future is not None and self.future.running()
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+    def exception(self, timeout=None):
+        return self.future.exception(timeout)
+
+    def addDoneCallback(self, callback):
+        '''
+        Adds a function called with the job on the Qt main thread when it is finished (immediately if it is already delivered).
+        '''
+        if self.delivered:
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+    def __repr__(self) -> str:
+        state = "cancelled" if self.cancelled() else "done" if self.done() else "running" if self.running() else "pending"
+        return f"CondaJob({self.name}, {state})"
+
+
+class CondaJobManager():
+    '''
+    Runs conda operations (create, install, run, delete) in background threads and returns CondaJob objects instead of blocking.
+    The number of jobs running at the same time is limited (QSettings jobs/maxConcurrent, the number of CPUs by default).
+    The onFinished callbacks are called on the Qt main thread by a QTimer : the manager must be created and used from the main thread.
+    '''
+    def __init__(self, conda=None, max_jobs:int=0) -> None:
+        self.conda = conda if conda is not None else CondaSetUpCall()
+        if max_jobs <= 0:
+            max_jobs = int(QSettings("SlicerConda").value("jobs/maxConcurrent", 0) or 0)
+        if max_jobs <= 0:
+            max_jobs = os.cpu_count() or 1
+        self.max_jobs = max_jobs
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix="CondaJob")
+        self.jobs = set()
+        self.finished = queue.Queue()
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.deliverFinished)
+
+    def submit(self, name:str, function, *args, onFinished=None, **kwargs)->CondaJob:
+        '''
+        Runs function(*args, cancel=token, **kwargs) in the pool and returns its CondaJob.
+        '''
+        job = CondaJob(name)
+        if onFinished is not None:
+            job.callbacks.append(onFinished)
+        kwargs["cancel"] = job.token
+        self.jobs.add(job)
+        job.future = self.executor.submit(function, *args, **kwargs)
+        job.future.add_done_callback(lambda future: self.finished.put(job))
+        if not self.timer.isActive():
+            self.timer.start(50)
+        return job
+
+    def deliverFinished(self):
+        '''
+        Called by the timer on the main thread : calls the callbacks of the finished jobs.
+        '''
+        while True:
+            try:
+                job = self.finished.get_nowait()
+            except queue.Empty:
+                break
+            self.jobs.discard(job)
+            job.delivered = True
+            callbacks, job.callbacks = job.callbacks, []
+            for callback in callbacks:
+                try:
+                    callback(job)
+                except Exception:
+                    logging.exception(f"Error in the callback of {job}")
+        if not self.jobs:
+            self.timer.stop()
+
+    def createEnv(self, name:str, python_version:str, list_lib=[], onFinished=None, **kwargs)->CondaJob:
+        return self.submit(f"create {name}", self.conda.condaCreateEnv, name, python_version, list_lib, onFinished=onFinished, **kwargs)
+
+    def installLibEnv(self, name:str, requirements:list[str], onFinished=None)->CondaJob:
+        return self.submit(f"install {name}", self.conda.condaInstallLibEnv, name, requirements, onFinished=onFinished)
+
+    def syncEnv(self, name:str, requirements:list[str], onFinished=None)->CondaJob:
+        return self.submit(f"sync {name}", self.conda.condaSyncEnv, name, requirements, onFinished=onFinished)
+
+    def runFilePython(self, file_path:str, args=[], env_name="None", onFinished=None, **kwargs)->CondaJob:
+        '''
+        Runs condaRunFilePython in the pool. The other keyword arguments (warm, direct, callback) are given to it,
+        note that a streaming callback is called in the thread of the job.
+        '''
+        return self.submit(f"run {os.path.basename(file_path)}", self.conda.condaRunFilePython, file_path, args=args, env_name=env_name, onFinished=onFinished, **kwargs)
+
+    def runFilePythonBatch(self, file_path:str, args_list:list, env_name="None", onFinished=None, **kwargs)->CondaJob:
+        '''
+        Runs condaRunFilePythonBatch in the pool, the result of the job is the list of CondaBatchResult.
+        The processes of the batch aren't counted in the limit of jobs, use max_workers to limit them.
+        '''
+        return self.submit(f"batch {os.path.basename(file_path)}", self.conda.condaRunFilePythonBatch, file_path, args_list, env_name=env_name, onFinished=onFinished, **kwargs)
+
+    def runCommand(self, command:list[str], env_name="None", onFinished=None, **kwargs)->CondaJob:
+        return self.submit(f"command {' '.join(command)}", self.conda.condaRunCommand, command, env_name=env_name, onFinished=onFinished, **kwargs)
+
+    def deleteEnv(self, name:str, onFinished=None)->CondaJob:
+        return self.submit(f"delete {name}", self.conda.condaDeleteEnv, name, onFinished=onFinished)
+
+    def activeJobs(self)->list:
+        return [job for job in self.jobs if not job.done()]
+
+    def cancelAll(self):
+        for job in list(self.jobs):
+            job.cancel()
+
+    def shutdown(self, wait:bool=False):
+        '''
+        Cancels every job and stops the pool.
+        '''
+        self.cancelAll()
+        self.executor.shutdown(wait=wait)
+        self.timer.stop()
+
+
+class CondaEnvRegistry():
+    '''
+    In-process index of the environments of a Conda installation : name -> prefix, python version and mtime of conda-meta.
+    It is built by scanning the envs directories and rebuilt only when the mtime of one of them changes,
+    so testing the existence of an environment is a dictionary lookup instead of a call to 'conda info --envs'.
+    An mtime less than RACY_SECONDS old isn't trusted : a second change in the same tick of the file system clock keeps the same mtime.
+    '''
+    RACY_SECONDS = 2
+    _registries = {}
+    _registriesLock = threading.Lock()
+
+    def __init__(self, conda_path:str) -> None:
+        self.conda_path = conda_path
+        self.envs = {}
+        self.stamps = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def getRegistry(cls, conda_path:str):
+        '''
+        Returns the registry of the Conda installation conda_path, or None if this folder can't be scanned.
+        '''
+        if not conda_path or conda_path == "None" or not os.path.isdir(conda_path):
+            return None
+        conda_path = os.path.normpath(conda_path)
+        with cls._registriesLock:
+            registry = cls._registries.get(conda_path)
+            if registry is None:
+                registry = CondaEnvRegistry(conda_path)
+                cls._registries[conda_path] = registry
+            return registry
+
+    @classmethod
+    def invalidateAll(cls):
+        '''
+        Forces every registry to be rebuilt on its next use.
+        '''
+        with cls._registriesLock:
+            for registry in cls._registries.values():
+                registry.invalidate()
+
+    def envsDirs(self)->list[str]:
+        '''
+        Folders containing the environments : the envs folder of the installation and the one of the user.
+        '''
+        return [os.path.join(self.conda_path, "envs"), os.path.join(os.path.expanduser("~"), ".conda", "envs")]
+
+    def computeStamps(self):
+        stamps = []
+        for envs_dir in self.envsDirs():
+            try:
+                stamps.append((envs_dir, os.stat(envs_dir).st_mtime_ns))
+            except OSError:
+                stamps.append((envs_dir, None))
+        return tuple(stamps)
+
+    @staticmethod
+    def readEnv(prefix:str):
+        '''
+        Returns the information of the environment installed in prefix, or None if it isn't a Conda environment.
+        '''
+        conda_meta = os.path.join(prefix, "conda-meta")
+        try:
+            mtime = os.stat(conda_meta).st_mtime
+        except OSError:
+            return None
+        python_version = None
+        try:
+            for file_name in os.listdir(conda_meta):
+                # e.g. python-3.9.18-h955ad1f_0.json
+                if file_name.startswith("python-") and file_name.endswith(".json"):
+                    version = file_name[len("python-"):].split("-")[0]
+                    if version[:1].isdigit():
+                        python_version = version
+                        break
+        except OSError:
+            pass
+        return {"prefix": prefix, "python_version": python_version, "mtime": mtime}
+
+    def refresh(self, force:bool=False):
+        '''
+        Rescans the envs folders if one of them changed since the last scan (or if force is True).
+        '''
+        with self.lock:
+            stamps = self.computeStamps()
+            if not force and stamps == self.stamps:
+                return
+            envs = {}
+            base = self.readEnv(self.conda_path)
+            if base is not None:
+                envs["base"] = base
+            for envs_dir, mtime in stamps:
+                if mtime is None:
+                    continue
+                try:
+                    names = sorted(os.listdir(envs_dir))
+                except OSError:
+                    continue
+                for name in names:
+                    if name in envs:
+                        continue
+                    info = self.readEnv(os.path.join(envs_dir, name))
+                    if info is not None:
+                        envs[name] = info
+            self.envs = envs
+            racy = time.time_ns() - CondaEnvRegistry.RACY_SECONDS * 10**9
+            self.stamps = None if any(mtime is not None and mtime > racy for _, mtime in stamps) else stamps
+
+    def invalidate(self):
+        '''
+        Forces the next lookup to rescan the envs folders, used after the creation or deletion of an environment.
+        '''
+        with self.lock:
+            self.stamps = None
+
+    def getEnv(self, name:str):
+        '''
+        Returns the information of the environment name, or None if it doesn't exist.
+        An environment whose conda-meta has been removed without changing the envs folder (interrupted removal) is looked up again.
+        '''
+        self.refresh()
+        info = self.envs.get(name)
+        if info is not None and not os.path.isdir(os.path.join(info["prefix"], "conda-meta")):
+            self.refresh(force=True)
+            info = self.envs.get(name)
+        return dict(info) if info is not None else None
+
+    def hasEnv(self, name:str)->bool:
+        return self.getEnv(name) is not None
+
+    def listEnvs(self)->dict:
+        self.refresh()
+        return {name: dict(info) for name, info in self.envs.items()}
+
+
+class CondaPackageList():
+    '''
+    Packages installed in an environment, read from conda-meta/*.json (conda packages) and site-packages/*.dist-info (python distributions)
+    without starting conda. The lists are cached per prefix until the mtime of these folders changes.
+    '''
+    _cache = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def normalizeName(name:str)->str:
+        return re.sub(r"[-_.]+", "-", name).lower()
+
+    @staticmethod
+    def computeStamps(prefix:str)->tuple:
+        '''
+        Returns the mtimes of conda-meta and site-packages, changed by every installation or removal of a package.
+        '''
+        folders = [os.path.join(prefix, "conda-meta")]
+        if platform.system()=="Windows":
+            folders.append(os.path.join(prefix, "Lib", "site-packages"))
+        else:
+            folders += sorted(glob.glob(os.path.join(prefix, "lib", "python*", "site-packages")))
+        stamps = []
+        for folder in folders:
+            try:
+                stamps.append((folder, os.stat(folder).st_mtime_ns))
+            except OSError:
+                pass
+        return tuple(stamps)
+
+    @staticmethod
+    def readPackages(prefix:str)->dict:
+        '''
+        Returns normalized name -> {"name", "version", "source"} ("conda" or "pip"). The version of a python distribution wins over the conda one.
+        '''
+        packages = {}
+        conda_meta = os.path.join(prefix, "conda-meta")
+        if os.path.isdir(conda_meta):
+            for file_name in os.listdir(conda_meta):
+                if not file_name.endswith(".json"):
+                    continue
+                try:
+                    with open(os.path.join(conda_meta, file_name)) as file:
+                        record = json.load(file)
+                    packages[CondaPackageList.normalizeName(record["name"])] = {"name": record["name"], "version": record["version"], "source": "conda"}
+                except (OSError, ValueError, KeyError):
+                    # conda-meta/<name>-<version>-<build>.json
+                    parts = file_name[:-len(".json")].rsplit("-", 2)
+                    if len(parts) == 3:
+                        packages[CondaPackageList.normalizeName(parts[0])] = {"name": parts[0], "version": parts[1], "source": "conda"}
+
+        for dist_info in CondaPackageCache.listDistInfo(prefix):
+            metadata = {}
+            try:
+                with open(os.path.join(dist_info, "METADATA"), encoding="utf-8", errors="replace") as file:
+                    for line in file:
+                        if not line.strip():
+                            break
+                        if line.startswith(("Name: ", "Version: ")):
+                            key, value = line.rstrip("\n").split(": ", 1)
+                            metadata[key] = value.strip()
+            except OSError:
+                pass
+            if "Name" not in metadata or "Version" not in metadata:
+                name, _, version = os.path.basename(dist_info)[:-len(".dist-info")].partition("-")
+                metadata = {"Name": name, "Version": version}
+            try:
+                with open(os.path.join(dist_info, "INSTALLER")) as file:
+                    source = "conda" if file.read().strip() == "conda" else "pip"
+            except OSError:
+                source = "pip"
+            packages[CondaPackageList.normalizeName(metadata["Name"])] = {"name": metadata["Name"], "version": metadata["Version"], "source": source}
+        return packages
+
+    @classmethod
+    def get(cls, prefix:str)->dict:
+        '''
+        Returns the packages of an environment, read again only if one of its package folders has changed.
+        '''
+        stamps = cls.computeStamps(prefix)
+        with cls._lock:
+            entry = cls._cache.get(prefix)
+            if entry is not None and entry[0] == stamps:
+                return entry[1]
+        packages = cls.readPackages(prefix)
+        with cls._lock:
+            cls._cache[prefix] = (stamps, packages)
+        return packages
+
+    @staticmethod
+    def versionKey(version:str):
+        '''
+        Key to compare two versions without the packaging module : release numbers (trailing zeros ignored),
+        then dev releases < pre-releases (a, b, rc) < final release < post releases. An unknown suffix (conda versions like 1.1.1w)
+        sorts after the release without it.
+        '''
+        match = re.match(r"^v?(\d+(?:\.\d+)*)(.*)$", version.split("+")[0].strip().lower())
+        if not match:
+            return ((), (0, 0, version))
+        release = [int(part) for part in match.group(1).split(".")]
+        while len(release) > 1 and release[-1] == 0:
+            release.pop()
+        suffix = re.match(r"^[._-]?(dev|a|alpha|b|beta|c|rc|pre|preview|post|rev|r)?[._-]?(\d*)", match.group(2))
+        label, number = (suffix.group(1), int(suffix.group(2) or 0)) if suffix else (None, 0)
+        rest = match.group(2)[suffix.end():] if suffix else match.group(2)
+        order = {"dev": 0, "a": 1, "alpha": 1, "b": 2, "beta": 2, "c": 3, "rc": 3, "pre": 3, "preview": 3, "post": 5, "rev": 5, "r": 5}
+        return (tuple(release), (order.get(label, 4), number, rest))
+
+    @staticmethod
+    def matchSpecifier(version:str, operator:str, expected:str)->bool:
+        key = CondaPackageList.versionKey
+        if expected.endswith(".*") and operator in ("==", "!="):
+            expected_release = [int(part) for part in re.findall(r"\d+", expected[:-2])]
+            release = [int(part) for part in re.findall(r"\d+", version.split("+")[0])][:len(expected_release)]
+            release += [0] * (len(expected_release) - len(release))
+            matches = release == expected_release
+            return matches if operator == "==" else not matches
+        if operator == "===":
+            return version == expected
+        if operator == "==":
+            return key(version) == key(expected)
+        if operator == "!=":
+            return key(version) != key(expected)
+        if operator == ">=":
+            return key(version) >= key(expected)
+        if operator == "<=":
+            return key(version) <= key(expected)
+        if operator == ">":
+            # Like PEP 440 : >1.0 doesn't match the post releases of 1.0
+            if key(version)[0] == key(expected)[0] and key(version)[1][0] == 5 and key(expected)[1][0] != 5:
+                return False
+            return key(version) > key(expected)
+        if operator == "<":
+            # Like PEP 440 : <1.0 doesn't match the dev and pre-releases of 1.0
+            if key(version)[0] == key(expected)[0] and key(version)[1][0] < 4 and key(expected)[1][0] >= 4:
+                return False
+            return key(version) < key(expected)
+        if operator == "~=":
+            parts = [int(part) for part in re.findall(r"\d+", expected)]
+            release = [int(part) for part in re.findall(r"\d+", version.split("+")[0])][:len(parts) - 1]
+            release += [0] * (len(parts) - 1 - len(release))
+            return key(version) >= key(expected) and release == parts[:-1]
+        return False
+
+    @staticmethod
+    def parseRequirement(requirement:str):
+        '''
+        Returns (normalized name, check) where check(version) tells if an installed version satisfies the requirement,
+        or None if the requirement can't be understood (URL, path, option...).
+        A version which isn't a PEP 440 version (conda versions like 1.1.1w) is compared with matchSpecifier even when packaging is available.
+        '''
+        requirement = requirement.split("#")[0].strip()
+        try:
+            from packaging.requirements import Requirement, InvalidRequirement
+            from packaging.version import Version, InvalidVersion
+            try:
+                parsed = Requirement(requirement)
+            except InvalidRequirement:
+                return None
+            if parsed.url:
+                return (CondaPackageList.normalizeName(parsed.name), lambda version: True)
+            def check(version):
+                try:
+                    Version(version)
+                except InvalidVersion:
+                    return all(CondaPackageList.matchSpecifier(version, specifier.operator, specifier.version) for specifier in parsed.specifier)
+                return parsed.specifier.contains(version, prereleases=True)
+            return (CondaPackageList.normalizeName(parsed.name), check)
+        except ImportError:
+            pass
+        match = re.match(r"^([A-Za-z0-9][A-Za-z0-9._-]*)\s*(\[[^\]]*\])?\s*(.*)$", requirement.split(";")[0].strip())
+        if not match:
+            return None
+        if match.group(3).startswith("@"):
+            return (CondaPackageList.normalizeName(match.group(1)), lambda version: True)
+        specifiers = []
+        for specifier in filter(None, (part.strip() for part in match.group(3).strip("() ").split(","))):
+            specifier_match = re.match(r"^(===|==|!=|~=|>=|<=|>|<)\s*(\S+)$", specifier)
+            if not specifier_match:
+                return None
+            specifiers.append(specifier_match.groups())
+        return (CondaPackageList.normalizeName(match.group(1)),
+                lambda version: all(CondaPackageList.matchSpecifier(version, operator, expected) for operator, expected in specifiers))
+
+    @staticmethod
+    def missing(packages:dict, requirements:list[str])->list[str]:
+        '''
+        Returns the requirements not satisfied by packages (requirements that can't be understood are considered missing).
+        '''
+        missing = []
+        for requirement in requirements:
+            parsed = CondaPackageList.parseRequirement(requirement)
+            if parsed is None:
+                missing.append(requirement)
+                continue
+            name, check = parsed
+            package = packages.get(name)
+            try:
+                satisfied = package is not None and check(package["version"])
+            except Exception:
+                satisfied = False
+            if not satisfied:
+                missing.append(requirement)
+        return missing
+
+    @classmethod
+    def invalidate(cls, prefix=None):
+        with cls._lock:
+            if prefix is None:
+                cls._cache.clear()
+            else:
+                cls._cache.pop(prefix, None)
+
+
+class CondaActivatedEnv():
+    '''
+    Cache of the environment variables of activated Conda environments (PATH, CONDA_PREFIX, variables exported by the activate.d scripts, ...).
+    They are captured once per environment with 'conda run', then the interpreter of the environment can be executed directly with them.
+    An entry is captured again when the conda-meta folder of the environment changes.
+    '''
+    _cache = {}
+    _lock = threading.Lock()
+    _marker = "__SLICERCONDA_ENVIRON__"
+
+    @classmethod
+    def capture(cls, path_condaexe:str, prefix:str):
+        '''
+        Runs the python of the environment through 'conda run' and returns its environment variables, or None if it failed.
+        '''
+        code = f"import os, json; print({cls._marker!r} + json.dumps(dict(os.environ)))"
+        command = [path_condaexe, "run", "-p", prefix, "python", "-c", code]
+        print("command in CondaActivatedEnv : ", command)
+        try:
+            result = runProcess(command, timeout=readTimeout(QSettings("SlicerConda"), "query"), stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8', errors='replace', env=slicer.util.startupEnvironment())
+        except OSError as e:
+            print(f"Can't capture the activation of {prefix} : {e}")
+            return None
+        if result.returncode != 0:
+            print(f"Can't capture the activation of {prefix} : {result.stderr}")
+            return None
+        for line in result.stdout.splitlines():
+            if line.startswith(cls._marker):
+                try:
+                    return json.loads(line[len(cls._marker):])
+                except ValueError:
+                    break
+        print(f"Can't capture the activation of {prefix} : unexpected output")
+        return None
+
+    @classmethod
+    def get(cls, path_condaexe:str, prefix:str, mtime=None):
+        '''
+        Returns the cached variables of the activated environment prefix, capturing them if needed. Returns None if they can't be captured.
+        '''
+        with cls._lock:
+            entry = cls._cache.get(prefix)
+            if entry is not None and entry[0] == mtime:
+                return dict(entry[1])
+        environ = cls.capture(path_condaexe, prefix)
+        if environ is None:
+            return None
+        with cls._lock:
+            cls._cache[prefix] = (mtime, environ)
+        return dict(environ)
+
+    @classmethod
+    def invalidate(cls, prefix=None):
+        '''
+        Forgets the captured variables of prefix, or of every environment if prefix is None.
+        '''
+        with cls._lock:
+            if prefix is None:
+                cls._cache.clear()
+            else:
+                cls._cache.pop(prefix, None)
+
+
+class CondaWorker():
+    '''
+    Long-lived python process running utils/conda_worker.py inside a Conda environment.
+    Python files are sent to it through a pipe, so conda startup and the imports of the scripts are only paid once.
+    '''
+    _workers = {}
+    _workersLock = threading.Lock()
+
+    def __init__(self, command:list[str], env=None, idle_timeout:float=600) -> None:
+        '''
+        command is the command launching a python interpreter of the environment, without the worker script.
+        '''
+        self.command = command
+        self.env = env
+        self.idle_timeout = idle_timeout
+        self.process = None
+        self.job_id = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def getWorker(cls, key, command:list[str], env=None, idle_timeout:float=600):
+        '''
+        Returns the worker registered for key (usually the environment name), creating it if needed.
+        '''
+        with cls._workersLock:
+            worker = cls._workers.get(key)
+            if worker is None or worker.command != command:
+                if worker is not None:
+                    worker.stop()
+                worker = CondaWorker(command, env, idle_timeout)
+                cls._workers[key] = worker
+            return worker
+
+    @classmethod
+    def stopWorker(cls, key):
+        '''
+        Stops and forgets the worker registered for key.
+        '''
+        with cls._workersLock:
+            worker = cls._workers.pop(key, None)
+        if worker is not None:
+            worker.stop()
+
+    @classmethod
+    def stopAll(cls):
+        '''
+        Stops every running worker.
+        '''
+        with cls._workersLock:
+            workers = list(cls._workers.values())
+            cls._workers.clear()
+        for worker in workers:
+            worker.stop()
+
+    def isAlive(self)->bool:
+        return self.process is not None and self.process.poll() is None
+
+    def start(self)->bool:
+        '''
+        Starts the worker process and waits for its ready message.
+        '''
+        self.stop()
+        path_worker = os.path.join(os.path.dirname(os.path.realpath(__file__)), "utils", "conda_worker.py")
+        command = self.command + ["-u", path_worker, "--idle-timeout", str(self.idle_timeout)]
+        print("command in CondaWorker : ", command)
+        env = dict(self.env if self.env is not None else slicer.util.startupEnvironment())
+        env["PYTHONUNBUFFERED"] = "1"
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                        text=True, encoding="utf-8", errors="replace", env=env, start_new_session=platform.system()!="Windows")
+        line = self.process.stdout.readline()
+        try:
+            if json.loads(line).get("ready"):
+                return True
+        except ValueError:
+            pass
+        print(f"Error : the conda worker didn't start ({line})")
+        self.stop()
+        return False
+
+    def stop(self):
+        '''
+        Stops the worker process.
+        '''
+        process = self.process
+        self.process = None
+        if process is None:
+            return
+        try:
+            if process.poll() is None:
+                process.stdin.write(json.dumps({"command": "stop"}) + "\n")
+                process.stdin.flush()
+                process.wait(timeout=5)
+        except (OSError, ValueError, subprocess.TimeoutExpired):
+            # conda run doesn't forward the kill to the python process it started
+            CondaCancelToken.killProcessTree(process)
+            process.wait()
+        finally:
+            for pipe in (process.stdin, process.stdout):
+                try:
+                    pipe.close()
+                except (OSError, ValueError):
+                    pass
+
+    def run(self, file_path:str, args=[], cancel=None, timeout=None):
+        '''
+        Runs a python file in the worker and returns (returncode, stdout, stderr).
+        The worker is (re)started if it is not running, e.g. after an idle timeout or a crash, and a job sent while the worker was exiting
+        on its idle timeout is sent again once to a new worker.
+        If cancel (a CondaCancelToken) is cancelled or the job lasts more than timeout seconds, the worker is killed and restarted by the next job.
+        '''
+        with self.lock:
+            if cancel is not None and cancel.isCancelled():
+                return (CondaCancelToken.CANCELLED_RETURNCODE, "", "Cancelled")
+            self.job_id += 1
+            job = json.dumps({"id": self.job_id, "file": file_path, "args": [str(arg) for arg in args]}) + "\n"
+
+            for attempt in range(2):
+                sent = False
+                for _ in range(2):
+                    if not self.isAlive() and not self.start():
+                        return (1, "", "The conda worker couldn't be started")
+                    try:
+                        self.process.stdin.write(job)
+                        self.process.stdin.flush()
+                        sent = True
+                        break
+                    except (OSError, ValueError):
+                        # The worker died between two jobs, the job hasn't been received : restart and send it again
+                        self.stop()
+                if not sent:
+                    return (1, "", "The job couldn't be sent to the conda worker")
+
+                process = self.process
+                if cancel is not None:
+                    cancel.attach(process)
+                expired = threading.Event()
+                def expire():
+                    expired.set()
+                    CondaCancelToken.killProcessTree(process)
+                timer = threading.Timer(timeout, expire) if timeout else None
+                if timer is not None:
+                    timer.start()
+                try:
+                    line = process.stdout.readline()
+                finally:
+                    if timer is not None:
+                        timer.cancel()
+                    if cancel is not None:
+                        cancel.detach(process)
+                if not line:
+                    try:
+                        idle_exit = process.wait(timeout=5) == 0
+                    except subprocess.TimeoutExpired:
+                        idle_exit = False
+                    self.stop()
+                    if cancel is not None and cancel.isCancelled():
+                        return (CondaCancelToken.CANCELLED_RETURNCODE, "", "Cancelled")
+                    if expired.is_set():
+                        return (CondaProcessResult.TIMEOUT_RETURNCODE, "", f"Timeout : the conda worker has been stopped after {timeout}s")
+                    if idle_exit and attempt == 0:
+                        # The worker exited on its idle timeout before reading the job : start a new one and send it again
+                        continue
+                    return (1, "", "The conda worker crashed during the execution")
+                try:
+                    answer = json.loads(line)
+                except ValueError:
+                    self.stop()
+                    return (1, "", f"Unexpected answer from the conda worker : {line}")
+                return (answer["returncode"], answer["stdout"], answer["stderr"])
+
+
+class CondaSharedVolume():
+    '''
+    Voxels and geometry of a volume in a multiprocessing.shared_memory block, read and written by a script of a conda environment
+    with utils/conda_shared_volume.py : the volume doesn't go through an image file.
+    The shape is the one of slicer.util.arrayFromVolume (k, j, i[, components]), the geometry is in LPS like SimpleITK.
+    '''
+    def __init__(self, shape, dtype, spacing=(1.0, 1.0, 1.0), origin=(0.0, 0.0, 0.0), direction=(1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0)) -> None:
+        '''
+        Allocates an empty shared volume, e.g. for the output of a script.
+        '''
+        import numpy as np
+        from multiprocessing import shared_memory
+        self.shape = tuple(int(size) for size in shape)
+        self.dtype = np.dtype(dtype)
+        self.spacing = tuple(float(value) for value in spacing)
+        self.origin = tuple(float(value) for value in origin)
+        self.direction = tuple(float(value) for value in direction)
+        size = max(1, int(np.prod(self.shape)) * self.dtype.itemsize)
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+        self.descriptor_path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def getGeometry(volumeNode):
+        '''
+        Returns the (spacing, origin, direction) of a volume node in LPS.
+        '''
+        matrix = vtk.vtkMatrix4x4()
+        volumeNode.GetIJKToRASDirectionMatrix(matrix)
+        flip = (-1.0, -1.0, 1.0)
+        direction = tuple(flip[row] * matrix.GetElement(row, column) for row in range(3) for column in range(3))
+        origin = tuple(flip[row] * value for row, value in enumerate(volumeNode.GetOrigin()))
+        return (tuple(volumeNode.GetSpacing()), origin, direction)
+
+    @staticmethod
+    def setGeometry(volumeNode, spacing, origin, direction):
+        '''
+        Sets the geometry of a volume node from a spacing, an origin and a direction in LPS.
+        '''
+        flip = (-1.0, -1.0, 1.0)
+        matrix = vtk.vtkMatrix4x4()
+        for row in range(3):
+            for column in range(3):
+                matrix.SetElement(row, column, flip[row] * direction[3 * row + column])
+        volumeNode.SetIJKToRASDirectionMatrix(matrix)
+        volumeNode.SetSpacing(spacing)
+        volumeNode.SetOrigin([flip[row] * value for row, value in enumerate(origin)])
+        volumeNode.Modified()
+
+    @staticmethod
+    def fromVolume(volumeNode):
+        '''
+        Returns a shared volume holding a copy of the voxels and the geometry of a vtkMRMLScalarVolumeNode.
+        '''
+        array = slicer.util.arrayFromVolume(volumeNode)
+        spacing, origin, direction = CondaSharedVolume.getGeometry(volumeNode)
+        shared = CondaSharedVolume(array.shape, array.dtype, spacing, origin, direction)
+        shared.array[...] = array
+        return shared
+
+    @staticmethod
+    def like(volumeNode, dtype=None):
+        '''
+        Allocates an empty shared volume with the shape and the geometry of a volume node, for the output of a script.
+        '''
+        array = slicer.util.arrayFromVolume(volumeNode)
+        spacing, origin, direction = CondaSharedVolume.getGeometry(volumeNode)
+        return CondaSharedVolume(array.shape, dtype if dtype is not None else array.dtype, spacing, origin, direction)
+
+    @staticmethod
+    def helperDirectory()->str:
+        '''
+        Returns the folder of conda_shared_volume.py, to add to the sys.path of the script.
+        '''
+        return os.path.join(os.path.dirname(os.path.realpath(__file__)), "utils")
+
+    def descriptor(self)->dict:
+        return {"name": self.shm.name, "shape": list(self.shape), "dtype": self.dtype.str,
+                "spacing": list(self.spacing), "origin": list(self.origin), "direction": list(self.direction)}
+
+    def descriptorArgument(self)->str:
+        '''
+        Returns the argument to give to the script : the path of a JSON file holding the descriptor.
+        A file avoids the quoting of JSON on the command lines of conda run and Windows.
+        '''
+        if self.descriptor_path is None:
+            descriptor_file = tempfile.NamedTemporaryFile("w", suffix=".json", prefix="slicerconda_volume_", delete=False)
+            with descriptor_file:
+                json.dump(self.descriptor(), descriptor_file)
+            self.descriptor_path = descriptor_file.name
+        return self.descriptor_path
+
+    def updateVolume(self, volumeNode, copy:bool=False):
+        '''
+        Shows the shared voxels and the geometry in a volume node.
+        Without copy, the image data of the node uses the shared memory directly : the memory stays allocated as long as the node uses it,
+        even after close().
+        '''
+        if copy:
+            slicer.util.updateVolumeFromArray(volumeNode, self.array)
+        else:
+            from vtk.util import numpy_support
+            components = self.shape[3] if len(self.shape) == 4 else 1
+            imageData = vtk.vtkImageData()
+            imageData.SetDimensions(self.shape[2], self.shape[1], self.shape[0])
+            scalars = numpy_support.numpy_to_vtk(self.array.reshape(-1, components), deep=False)
+            imageData.GetPointData().SetScalars(scalars)
+            volumeNode.SetAndObserveImageData(imageData)
+
+        CondaSharedVolume.setGeometry(volumeNode, self.spacing, self.origin, self.direction)
+
+    def close(self):
+        '''
+        Releases the shared memory and the descriptor file. Views still used by a volume node keep their memory until the node releases it.
+        '''
+        self.array = None
+        if self.descriptor_path is not None:
+            try:
+                os.remove(self.descriptor_path)
+            except OSError:
+                pass
+            self.descriptor_path = None
+        if self.shm is None:
+            return
+        try:
+            self.shm.close()
+        except BufferError:
+            # A volume node still uses the memory (updateVolume without copy) : drop our references,
+            # the mapping is released with the last view of the node
+            self.shm._buf = None
+            self.shm._mmap = None
+            self.shm.close()
+        try:
+            self.shm.unlink()
+        except (FileNotFoundError, OSError):
+            pass
+        self.shm = None
+
+
+class CondaImageExchange():
+    '''
+    Intermediate image files exchanged with the scripts of a conda environment, read and written by the scripts with utils/conda_image_exchange.py.
+    They are never compressed : "nrrd" (uncompressed NRRD) or "raw" (raw voxels with a JSON header), chosen by the QSettings "transfer/format",
+    in a temporary folder on /dev/shm when it exists (QSettings "transfer/directory" to choose another one).
+    '''
+    FORMATS = {"nrrd": ".nrrd", "raw": ".json"}
+
+    def __init__(self, format:str=None, directory:str=None) -> None:
+        self.settings = QSettings("SlicerConda")
+        self.format = format if format is not None else self.getFormat()
+        if self.format not in CondaImageExchange.FORMATS:
+            print(f"Unknown transfer format {self.format}, nrrd is used")
+            self.format = "nrrd"
+        self.directory = directory if directory is not None else self.getDirectory()
+
+    def getFormat(self)->str:
+        return self.settings.value("transfer/format", "nrrd")
+
+    def setFormat(self, format:str):
+        self.settings.setValue("transfer/format", format)
+        self.format = format
+
+    def getDirectory(self)->str:
+        '''
+        Returns the folder of the intermediate files : the QSettings "transfer/directory", else /dev/shm (in memory), else the temporary folder.
+        '''
+        directory = self.settings.value("transfer/directory", "")
+        if not directory:
+            if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+                directory = "/dev/shm"
+            else:
+                directory = tempfile.gettempdir()
+        directory = os.path.join(directory, "SlicerConda")
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def helperDirectory(self)->str:
+        '''
+        Returns the folder of conda_image_exchange.py, to add to the sys.path of the script.
+        '''
+        return os.path.join(os.path.dirname(os.path.realpath(__file__)), "utils")
+
+    def newPath(self, name:str="image")->str:
+        '''
+        Returns the path of a new intermediate file, e.g. for the output of a script.
+        '''
+        file, path = tempfile.mkstemp(prefix=f"{name}_", suffix=CondaImageExchange.FORMATS[self.format], dir=self.directory)
+        os.close(file)
+        return path
+
+    def exportVolume(self, volumeNode, path:str=None)->str:
+        '''
+        Writes a volume node in an intermediate file and returns its path, to give to the script.
+        '''
+        if path is None:
+            path = self.newPath(volumeNode.GetName() if volumeNode.GetName() else "image")
+        if path.lower().endswith(".json"):
+            array = slicer.util.arrayFromVolume(volumeNode)
+            spacing, origin, direction = CondaSharedVolume.getGeometry(volumeNode)
+            array.tofile(os.path.splitext(path)[0] + ".raw")
+            with open(path, "w") as file:
+                json.dump({"shape": list(array.shape), "dtype": array.dtype.str, "spacing": list(spacing),
+                           "origin": list(origin), "direction": list(direction)}, file)
+        elif not slicer.util.saveNode(volumeNode, path, {"useCompression": 0}):
+            raise RuntimeError(f"The volume couldn't be written in {path}")
+        return path
+
+    def importVolume(self, path:str, volumeNode=None):
+        '''
+        Reads an intermediate file written by a script in volumeNode (a new scalar volume node if None) and returns the node.
+        '''
+        if path.lower().endswith(".json"):
+            import numpy as np
+            with open(path) as file:
+                header = json.load(file)
+            array = np.fromfile(os.path.splitext(path)[0] + ".raw", dtype=np.dtype(header["dtype"])).reshape(header["shape"])
+            if volumeNode is None:
+                volumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+            slicer.util.updateVolumeFromArray(volumeNode, array)
+            CondaSharedVolume.setGeometry(volumeNode, header["spacing"], header["origin"], header["direction"])
+            return volumeNode
+
+        loaded = slicer.util.loadVolume(path, {"show": False})
+        if volumeNode is None:
+            return loaded
+        matrix = vtk.vtkMatrix4x4()
+        loaded.GetIJKToRASMatrix(matrix)
+        volumeNode.SetAndObserveImageData(loaded.GetImageData())
+        volumeNode.SetIJKToRASMatrix(matrix)
+        slicer.mrmlScene.RemoveNode(loaded)
+        return volumeNode
+
+    def remove(self, path:str):
+        '''
+        Deletes an intermediate file (and its raw voxels).
+        '''
+        for file_path in (path, os.path.splitext(path)[0] + ".raw"):
+            if file_path.lower().endswith((".json", ".raw", ".nrrd")) and os.path.isfile(file_path):
+                os.remove(file_path)
+
+
+class CondaPackageCache():
+    '''
+    Folder of conda packages (pkgs) and pip wheels (wheels) shared by every environment, configured by the QSettings of SlicerConda :
+    "cache/enabled" (false by default), "cache/directory", "cache/maxSize" (in MB, 10240 by default), "cache/evictInterval" (in minutes, 60 by default)
+    and "cache/offline". Conda uses it as its first package folder and pip as a --find-links folder, so a package already fetched is copied instead of downloaded.
+    It is off by default : conda hard-links its packages into the environments, which fails when the cache is on another filesystem than the environments.
+    The least recently used packages are deleted when the cache is bigger than its maximum size, checked at most once per eviction interval.
+    '''
+    IGNORED = ("cache", "urls", "urls.txt", ".trash", "usage.json")
+    _lock = threading.Lock()
+
+    def __init__(self) -> None:
+        self.settings = QSettings("SlicerConda")
+
+    def isEnabled(self)->bool:
+        return str(self.settings.value("cache/enabled", "false")).lower() == "true"
+
+    def isOffline(self)->bool:
+        return str(self.settings.value("cache/offline", "false")).lower() == "true"
+
+    def setOffline(self, offline:bool):
+        self.settings.setValue("cache/offline", "true" if offline else "false")
+
+    def getMaxSize(self)->int:
+        '''
+        Returns the maximum size of the cache in bytes.
+        '''
+        return int(float(self.settings.value("cache/maxSize", 10240))) * 1024 * 1024
+
+    def getDirectory(self)->str:
+        directory = self.settings.value("cache/directory", "")
+        if not directory:
+            directory = os.path.join(os.path.expanduser("~"), ".slicerconda", "cache")
+        return directory
+
+    def setDirectory(self, directory:str):
+        self.settings.setValue("cache/directory", directory)
+
+    def condaDirectory(self)->str:
+        directory = os.path.join(self.getDirectory(), "pkgs")
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def wheelDirectory(self)->str:
+        directory = os.path.join(self.getDirectory(), "wheels")
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def condaEnvironment(self, env=None, conda_root:str=None)->dict:
+        '''
+        Returns the environment variables for a conda command using the cache (CONDA_PKGS_DIRS, CONDA_OFFLINE).
+        The package folder of the conda installation stays readable after the cache.
+        '''
+        env = dict(env if env is not None else slicer.util.startupEnvironment())
+        if not self.isEnabled():
+            return env
+        pkgs_dirs = [self.condaDirectory()]
+        if conda_root:
+            pkgs_dirs.append(os.path.join(conda_root, "pkgs"))
+        env["CONDA_PKGS_DIRS"] = ",".join(pkgs_dirs)
+        if self.isOffline():
+            env["CONDA_OFFLINE"] = "true"
+        return env
+
+    def pipArguments(self)->list[str]:
+        '''
+        Returns the arguments of pip install using the wheels of the cache (only them when offline).
+        '''
+        if not self.isEnabled():
+            return []
+        arguments = ["--find-links", self.wheelDirectory()]
+        if self.isOffline():
+            arguments.append("--no-index")
+        return arguments
+
+    @staticmethod
+    def entryKey(name:str)->str:
+        '''
+        Returns the key of a cache entry : name-version-build for conda packages (folder or archive), name-version for wheels and sdists.
+        '''
+        for extension in (".tar.bz2", ".conda", ".whl", ".tar.gz", ".zip"):
+            if name.endswith(extension):
+                name = name[:-len(extension)]
+                if extension in (".whl", ".tar.gz", ".zip"):
+                    match = re.match(r"^(.+?)-(\d[^-]*)", name)
+                    if match:
+                        return re.sub(r"[-_.]+", "_", match.group(1)).lower() + "-" + match.group(2)
+                break
+        return name
+
+    def readUsage(self)->dict:
+        try:
+            with open(os.path.join(self.getDirectory(), "usage.json")) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def markUsed(self, keys):
+        '''
+        Records that the entries of keys have just been used.
+        '''
+        with CondaPackageCache._lock:
+            usage = self.readUsage()
+            now = time.time()
+            for key in keys:
+                usage[key] = now
+            os.makedirs(self.getDirectory(), exist_ok=True)
+            with open(os.path.join(self.getDirectory(), "usage.json"), "w") as file:
+                json.dump(usage, file)
+
+    def markEnvUsed(self, prefix:str):
+        '''
+        Records the conda packages and the pip distributions installed in an environment as used.
+        '''
+        keys = []
+        conda_meta = os.path.join(prefix, "conda-meta")
+        if os.path.isdir(conda_meta):
+            keys += [name[:-len(".json")] for name in os.listdir(conda_meta) if name.endswith(".json")]
+        for dist_info in CondaPackageCache.listDistInfo(prefix):
+            name, _, version = os.path.basename(dist_info)[:-len(".dist-info")].partition("-")
+            keys.append(re.sub(r"[-_.]+", "_", name).lower() + "-" + version)
+        if keys:
+            self.markUsed(keys)
+
+    @staticmethod
+    def listDistInfo(prefix:str)->list[str]:
+        '''
+        Returns the .dist-info folders of the pip distributions of an environment.
+        '''
+        if platform.system()=="Windows":
+            pattern = os.path.join(prefix, "Lib", "site-packages", "*.dist-info")
+        else:
+            pattern = os.path.join(prefix, "lib", "python*", "site-packages", "*.dist-info")
+        return glob.glob(pattern)
+
+    @staticmethod
+    def entrySize(path:str)->int:
+        if os.path.isfile(path):
+            return os.path.getsize(path)
+        size = 0
+        for root, _, files in os.walk(path):
+            for name in files:
+                try:
+                    size += os.lstat(os.path.join(root, name)).st_size
+                except OSError:
+                    pass
+        return size
+
+    def listEntries(self)->list[dict]:
+        '''
+        Returns the entries of the cache grouped by key : {key, paths, size, used}.
+        '''
+        usage = self.readUsage()
+        entries = {}
+        for directory in (os.path.join(self.getDirectory(), "pkgs"), os.path.join(self.getDirectory(), "wheels")):
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if name in CondaPackageCache.IGNORED:
+                    continue
+                path = os.path.join(directory, name)
+                key = CondaPackageCache.entryKey(name)
+                entry = entries.setdefault(key, {"key": key, "paths": [], "size": 0, "used": 0})
+                entry["paths"].append(path)
+                entry["size"] += CondaPackageCache.entrySize(path)
+                entry["used"] = max(entry["used"], usage.get(key, 0), os.path.getmtime(path))
+        return list(entries.values())
+
+    def size(self)->int:
+        return sum(entry["size"] for entry in self.listEntries())
+
+    def evict(self, max_size:int=None)->int:
+        '''
+        Deletes the least recently used entries until the cache is smaller than max_size (the maximum size of the settings by default).
+        Returns the number of bytes freed.
+        '''
+        if max_size is None:
+            max_size = self.getMaxSize()
+        with CondaPackageCache._lock:
+            entries = sorted(self.listEntries(), key=lambda entry: entry["used"])
+            total = sum(entry["size"] for entry in entries)
+            freed = 0
+            for entry in entries:
+                if total - freed <= max_size:
+                    break
+                for path in entry["paths"]:
+                    if os.path.isdir(path):
+                        shutil.rmtree(path, ignore_errors=True)
+                    elif os.path.exists(path):
+                        os.remove(path)
+                freed += entry["size"]
+        if freed:
+            print(f"Package cache : {freed/(1024*1024):.1f} MB freed")
+        return freed
+
+    def evictIfDue(self)->int:
+        '''
+        Calls evict if the last eviction is older than the eviction interval, so the cache isn't walked after every operation.
+        Returns the number of bytes freed.
+        '''
+        stamp = os.path.join(self.getDirectory(), "evicted")
+        interval = float(self.settings.value("cache/evictInterval", 60)) * 60
+        if os.path.exists(stamp) and time.time() - os.path.getmtime(stamp) < interval:
+            return 0
+        freed = self.evict()
+        os.makedirs(self.getDirectory(), exist_ok=True)
+        with open(stamp, "w"):
+            pass
+        return freed
+
+
+class CondaEnvArchive():
+    '''
+    Relocatable archive of an environment : a tar file (gzip compressed if its name ends with .gz or .tgz) whose last member is a manifest
+    with the sha256 of every file and the files containing the prefix of the environment, fixed up after the extraction in another folder.
+    '''
+    MANIFEST = "slicerconda-manifest.json"
+    CHUNK = 1024 * 1024
+
+    class FileScanner():
+        '''
+        File read by tarfile while computing its sha256 and looking for the prefix of the environment, so the file is read once.
+        '''
+        def __init__(self, file, prefix:bytes) -> None:
+            self.file = file
+            self.prefix = prefix
+            self.digest = hashlib.sha256()
+            self.found = False
+            self.binary = False
+            self.tail = b""
+
+        def read(self, size=-1):
+            chunk = self.file.read(size)
+            if chunk:
+                self.digest.update(chunk)
+                if not self.binary and b"\0" in chunk:
+                    self.binary = True
+                if not self.found and self.prefix in self.tail + chunk:
+                    self.found = True
+                self.tail = chunk[-(len(self.prefix) - 1):] if len(self.prefix) > 1 else b""
+            return chunk
+
+        def mode(self):
+            if not self.found:
+                return None
+            return "binary" if self.binary else "text"
+
+    @staticmethod
+    def reportProgress(progress, done, total):
+        if progress is not None and total > 0:
+            progress.put(str(min(99, int(100 * done / total))))
+
+    @staticmethod
+    def isInside(path:str, folder:str)->bool:
+        '''
+        Returns True if path is folder or is inside folder (not only a path starting with the same characters).
+        '''
+        path = os.path.normpath(path)
+        folder = os.path.normpath(folder)
+        return path == folder or path.startswith(folder.rstrip(os.sep) + os.sep)
+
+    @staticmethod
+    def isCompiled(name:str)->bool:
+        '''
+        The compiled python files aren't archived (like conda-pack) : their paths are marshal strings which can't be fixed up,
+        and python writes them again when the modules are imported.
+        '''
+        return name.endswith(".pyc") or "__pycache__" in name.replace(os.sep, "/").split("/")
+
+    @staticmethod
+    def export(prefix:str, archive_path:str, progress=None, cancel=None)->bool:
+        '''
+        Writes the environment of prefix in archive_path. Returns False if it failed or has been cancelled.
+        '''
+        prefix = os.path.abspath(prefix)
+        prefix_bytes = prefix.encode("utf-8")
+        paths = []
+        for root, dirs, names in os.walk(prefix):
+            dirs[:] = sorted(directory for directory in dirs if directory != "__pycache__")
+            for name in sorted(names) + [directory for directory in dirs if os.path.islink(os.path.join(root, directory))]:
+                if not CondaEnvArchive.isCompiled(name):
+                    paths.append(os.path.join(root, name))
+        total = sum(os.path.getsize(path) for path in paths if os.path.isfile(path) and not os.path.islink(path))
+
+        manifest = {"format": 1, "prefix": prefix, "platform": platform.system(), "machine": platform.machine(), "files": {}, "links": []}
+        done = 0
+        mode = "w|gz" if archive_path.endswith((".gz", ".tgz")) else "w|"
+        try:
+            with tarfile.open(archive_path, mode) as tar:
+                for path in paths:
+                    if cancel is not None and cancel.isCancelled():
+                        raise InterruptedError("Cancelled")
+                    arcname = os.path.relpath(path, prefix).replace(os.sep, "/")
+                    info = tar.gettarinfo(path, arcname=arcname)
+                    if info.issym():
+                        if os.path.isabs(info.linkname) and CondaEnvArchive.isInside(info.linkname, prefix):
+                            manifest["links"].append(arcname)
+                        tar.addfile(info)
+                    elif os.path.isfile(path):
+                        # Hard links inside the environment are stored as regular files
+                        info.type = tarfile.REGTYPE
+                        info.linkname = ""
+                        info.size = os.path.getsize(path)
+                        with open(path, "rb") as file:
+                            scanner = CondaEnvArchive.FileScanner(file, prefix_bytes)
+                            tar.addfile(info, scanner)
+                        manifest["files"][arcname] = {"sha256": scanner.digest.hexdigest(), "size": info.size, "prefix": scanner.mode()}
+                        done += info.size
+                        CondaEnvArchive.reportProgress(progress, done, total)
+
+                data = json.dumps(manifest, indent=1).encode("utf-8")
+                info = tarfile.TarInfo(CondaEnvArchive.MANIFEST)
+                info.size = len(data)
+                info.mtime = time.time()
+                tar.addfile(info, io.BytesIO(data))
+        except (OSError, tarfile.TarError, InterruptedError) as e:
+            print(f"Error : the archive {archive_path} couldn't be written ({e})")
+            if os.path.exists(archive_path):
+                os.remove(archive_path)
+            return False
+        return True
+
+    @staticmethod
+    def replaceBinaryPrefix(data:bytes, old:bytes, new:bytes)->bytes:
+        '''
+        Replaces a prefix in the C strings of a binary file, keeping their length with null bytes so the offsets don't change.
+        conda pads these strings up to the length of its build prefix, so a longer prefix usually fits in the padding.
+        Only the prefixes followed by printable bytes up to a null byte are replaced, the other ones aren't in a C string.
+        '''
+        pattern = re.compile(re.escape(old) + b"([^\0-\x1f]*)(\0+)")
+        def replace(match):
+            length = match.end() - match.start()
+            string = (old + match.group(1)).replace(old, new)
+            if len(string) + 1 > length:
+                raise ValueError(f"the new prefix is too long for a binary file of the archive ({len(old)} characters at most)")
+            return string + b"\0" * (length - len(string))
+        return pattern.sub(replace, data)
+
+    @staticmethod
+    def fixPrefix(path:str, old:str, new:str, mode:str):
+        with open(path, "rb") as file:
+            data = file.read()
+        replacements = [(old, new)]
+        if platform.system()=="Windows":
+            replacements.append((old.replace("\\", "/"), new.replace("\\", "/")))
+        for old_prefix, new_prefix in replacements:
+            if mode == "binary":
+                data = CondaEnvArchive.replaceBinaryPrefix(data, old_prefix.encode("utf-8"), new_prefix.encode("utf-8"))
+            else:
+                data = data.replace(old_prefix.encode("utf-8"), new_prefix.encode("utf-8"))
+        file_mode = os.stat(path).st_mode
+        with open(path, "wb") as file:
+            file.write(data)
+        os.chmod(path, file_mode)
+
+    @staticmethod
+    def extract(archive_path:str, prefix:str, progress=None, cancel=None)->bool:
+        '''
+        Extracts an archive written by export in the folder prefix, which must not exist.
+        The files are streamed in a temporary folder, checked against the manifest and fixed up, then the folder is renamed.
+        '''
+        prefix = os.path.abspath(prefix)
+        if os.path.exists(prefix):
+            print(f"Error : {prefix} already exists")
+            return False
+        staging = prefix + ".importing"
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+
+        hashes = {}
+        links = []
+        manifest = None
+        total = os.path.getsize(archive_path)
+        try:
+            with open(archive_path, "rb") as raw, tarfile.open(fileobj=raw, mode="r|*") as tar:
+                for member in tar:
+                    if cancel is not None and cancel.isCancelled():
+                        raise InterruptedError("Cancelled")
+                    name = member.name
+                    if name == CondaEnvArchive.MANIFEST:
+                        manifest = json.load(tar.extractfile(member))
+                        continue
+                    parts = name.split("/")
+                    if name.startswith("/") or ".." in parts or ":" in parts[0]:
+                        raise ValueError(f"unsafe path in the archive : {name}")
+                    if CondaEnvArchive.isCompiled(name):
+                        continue
+                    target = os.path.join(staging, *parts)
+                    if member.isdir():
+                        os.makedirs(target, exist_ok=True)
+                    elif member.issym():
+                        links.append((name, target, member.linkname))
+                    elif member.isfile():
+                        os.makedirs(os.path.dirname(target), exist_ok=True)
+                        digest = hashlib.sha256()
+                        source = tar.extractfile(member)
+                        with open(target, "wb") as file:
+                            while True:
+                                chunk = source.read(CondaEnvArchive.CHUNK)
+                                if not chunk:
+                                    break
+                                digest.update(chunk)
+                                file.write(chunk)
+                        os.chmod(target, member.mode & 0o7777)
+                        hashes[name] = digest.hexdigest()
+                        CondaEnvArchive.reportProgress(progress, raw.tell(), total)
+
+            if manifest is None:
+                raise ValueError("the archive has no manifest")
+            if manifest.get("platform") != platform.system() or manifest.get("machine") != platform.machine():
+                raise ValueError(f"the archive has been made on {manifest.get('platform')} {manifest.get('machine')}")
+            # The compiled files of the archives written before they were skipped are dropped
+            files = {name: info for name, info in manifest["files"].items() if not CondaEnvArchive.isCompiled(name)}
+            for name, info in files.items():
+                if hashes.get(name) != info["sha256"]:
+                    raise ValueError(f"{name} is missing or corrupted")
+            unexpected = set(hashes) - set(manifest["files"])
+            if unexpected:
+                raise ValueError(f"{len(unexpected)} files of the archive aren't in the manifest")
+
+            old_prefix = manifest["prefix"]
+            for name, target, linkname in links:
+                if os.path.isabs(linkname):
+                    if name not in manifest["links"] or not CondaEnvArchive.isInside(linkname, old_prefix):
+                        raise ValueError(f"the link {name} points outside of the environment")
+                    linkname = prefix + linkname[len(old_prefix.rstrip(os.sep)):]
+                elif not CondaEnvArchive.isInside(os.path.join(os.path.dirname(target), linkname), staging):
+                    raise ValueError(f"the link {name} points outside of the environment")
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.symlink(linkname, target)
+
+            for name, info in files.items():
+                if info["prefix"]:
+                    CondaEnvArchive.fixPrefix(os.path.join(staging, *name.split("/")), old_prefix, prefix, info["prefix"])
+            os.rename(staging, prefix)
+        except (OSError, ValueError, tarfile.TarError, InterruptedError) as e:
+            print(f"Error : the archive {archive_path} couldn't be extracted ({e})")
+            shutil.rmtree(staging, ignore_errors=True)
+            return False
+        return True
+
+
+class DummyFile(io.IOBase):
+        def close(self):
             pass
 #
 # CondaSetUpLogic
@@ -1657,38 +5183,26 @@ class CondaSetUpTest(ScriptedLoadableModuleTest):
         self.test_CondaSetUp1()
 
     def test_CondaSetUp1(self):
-        """Ideally you should have several levels of tests.  At the lowest level
-        tests should exercise the functionality of the logic with different inputs
-        (both valid and invalid).  At higher levels your tests should emulate the
-        way the user would interact with your code and confirm that it still works
-        the way you intended.
-        One of the most important features of the tests is that it should alert other
-        developers when their changes will have an impact on the behavior of your
-        module.  For example, if a developer removes a feature that you depend on,
-        your test should break so they know that the feature is needed.
+        """Runs the benchmark of the CondaSetUpCall operations (Testing/Python/CondaSetUpBenchmark.py)
+        for a few iterations against the fake conda, so no conda installation and no network are needed.
         """
 
-        # self.delayDisplay("Starting the test")
-
-        # # Get/create input data
-
-        # import SampleData
-
-        # registerSampleData()
-        # inputVolume = SampleData.downloadSample("CondaSetUp1")
-        # self.delayDisplay("Loaded test data set")
-
-        # inputScalarRange = inputVolume.GetImageData().GetScalarRange()
-        # self.assertEqual(inputScalarRange[0], 0)
-        # self.assertEqual(inputScalarRange[1], 695)
-
-        # threshold = 100
-
-        # # Test the module logic
-
-        # logic = CondaSetUpLogic()
-
-        # Test algorithm with non-inverted threshold
-
+        self.delayDisplay("Starting the test")
+
+        testing_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Testing", "Python")
+        if not os.path.isfile(os.path.join(testing_path, "CondaSetUpBenchmark.py")):
+            self.delayDisplay("Testing/Python is not next to the module, test skipped")
+            return
+        if testing_path not in sys.path:
+            sys.path.insert(0, testing_path)
+        import CondaSetUpBenchmark
+
+        delays = {kind: 0.0 for kind in ("startup", "run", "create", "clone", "remove", "install", "query")}
+        report = CondaSetUpBenchmark.runFakeBenchmark(iterations=2, delays=delays)
+        print(CondaSetUpBenchmark.formatReport(report))
+        for name, summary in report["results"].items():
+            self.assertEqual(summary["errors"], 0, f"{name} : {summary['first_error']}")
+        # The existence of an environment is read from the registry, without starting conda
+        self.assertEqual(report["results"]["testEnv"]["spawns_max"], 0)
 
         self.delayDisplay("Test passed")
@@ -0,0 +1,125 @@
+import os
+import sys
+import time
+import shutil
+import threading
+import unittest
+
+# Sentinel protocol of the persistent bash sessions (CondaSessionOutput, CondaBashSession, CondaBashSessionBackend) : markers cut
+# between chunks, output without a final newline, truncation, exit codes, and sessions replaced after a timeout or a cancellation.
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+try:
+    import CondaSetUp
+except ImportError:
+    # Source tree : the module is two folders up
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    import CondaSetUp
+
+CondaSessionOutput = CondaSetUp.CondaSessionOutput
+MARKER = "__SLICERCONDA_test_1__"
+
+
+class CondaSessionOutputTest(unittest.TestCase):
+    def feed(self, output:CondaSessionOutput, data:bytes, size:int):
+        for index in range(0, len(data), size):
+            output.feed(data[index:index + size])
+
+    def test_MarkerSplit(self):
+        data = b"line 1\nline 2\n" + f"\n{MARKER} 7\n".encode("ascii")
+        for size in (1, 2, 3, 5, 8, len(data)):
+            with self.subTest(size=size):
+                output = CondaSessionOutput(MARKER)
+                self.feed(output, data, size)
+                self.assertTrue(output.done)
+                self.assertEqual(output.returncode, 7)
+                self.assertEqual(output.getvalue(), b"line 1\nline 2\n")
+
+    def test_Unfinished(self):
+        # The status line isn't complete yet : the command isn't finished
+        output = CondaSessionOutput(MARKER)
+        output.feed(f"out\n{MARKER} 1".encode("ascii"))
+        self.assertFalse(output.done)
+        output.feed(b"2\n")
+        self.assertTrue(output.done)
+        self.assertEqual(output.returncode, 12)
+
+    def test_NoFinalNewline(self):
+        output = CondaSessionOutput(MARKER)
+        output.feed(f"no newline\n{MARKER} 0\n".encode("ascii"))
+        self.assertEqual(output.getvalue(), b"no newline")
+
+    def test_Truncation(self):
+        data = b"".join(b"%05d\n" % index for index in range(2000))
+        output = CondaSessionOutput(MARKER, max_bytes=100)
+        self.feed(output, data + f"\n{MARKER} 0\n".encode("ascii"), 7)
+        self.assertTrue(output.done)
+        self.assertEqual(output.getvalue(), data[-100:])
+        self.assertTrue(output.truncated)
+        self.assertEqual(output.total, len(data))
+        self.assertLess(len(output.data), 4 * (100 + len(MARKER)))
+
+
+@unittest.skipIf(shutil.which("bash") is None, "bash isn't available")
+class CondaBashSessionTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = CondaSetUp.CondaBashSessionBackend(max_sessions=1)
+
+    def tearDown(self):
+        self.backend.close()
+
+    def runCommand(self, command, **kwargs):
+        return self.backend.run(command, env=dict(os.environ), **kwargs)
+
+    def test_Output(self):
+        result = self.runCommand("printf 'out'; printf 'err' >&2")
+        self.assertEqual((result.returncode, result.stdout, result.stderr), (0, "out", "err"))
+        result = self.runCommand(["printf", "%s\\n", "it's", "a (test)"])
+        self.assertEqual(result.stdout, "it's\na (test)\n")
+
+    def test_ReturnCodes(self):
+        self.assertEqual(self.runCommand("exit 3").returncode, 3)
+        self.assertEqual(self.runCommand("false").returncode, 1)
+        result = self.runCommand("echo 'unbalanced")
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn("unexpected", result.stderr)
+        result = self.runCommand("echo )")
+        self.assertNotEqual(result.returncode, 0)
+        # The errors stayed in their subshell : the session is still used
+        self.assertEqual(self.backend.count, 1)
+        self.assertEqual(self.runCommand("cd /; echo ok").stdout, "ok\n")
+        self.assertEqual(self.runCommand("pwd").stdout.strip(), os.getcwd())
+
+    def test_Truncation(self):
+        result = self.runCommand("seq 1 100000", max_output=1024)
+        self.assertEqual(result.returncode, 0)
+        self.assertTrue(result.truncated)
+        self.assertEqual(len(result.stdout), 1024)
+        self.assertTrue(result.stdout.endswith("99999\n100000\n"))
+        self.assertEqual(result.stdout_bytes, len("".join(f"{index}\n" for index in range(1, 100001))))
+
+    def test_Timeout(self):
+        session = self.backend.acquire()
+        self.backend.release(session)
+        start = time.time()
+        result = self.runCommand("sleep 30", timeout=0.5)
+        self.assertLess(time.time() - start, 10)
+        self.assertTrue(result.timed_out)
+        self.assertEqual(result.returncode, CondaSetUp.CondaProcessResult.TIMEOUT_RETURNCODE)
+        self.assertFalse(session.isAlive())
+        # A new session runs the next command
+        self.assertEqual(self.runCommand("echo again").stdout, "again\n")
+
+    def test_Cancel(self):
+        token = CondaSetUp.CondaCancelToken()
+        threading.Timer(0.5, token.cancel).start()
+        start = time.time()
+        result = self.runCommand("sleep 30", cancel=token)
+        self.assertLess(time.time() - start, 10)
+        self.assertTrue(result.cancelled)
+        self.assertEqual(result.returncode, CondaSetUp.CondaCancelToken.CANCELLED_RETURNCODE)
+        self.assertEqual(self.runCommand("echo again").stdout, "again\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+import io
+import os
+import sys
+import json
+import tarfile
+import tempfile
+import unittest
+import py_compile
+import subprocess
+
+# Export and import of environment archives (CondaEnvArchive) on a small handmade environment : prefix fix-up of the text and
+# binary files, compiled modules and checks of the symbolic links. No conda is needed.
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+try:
+    import CondaSetUp
+except ImportError:
+    # Source tree : the module is two folders up
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    import CondaSetUp
+
+CondaEnvArchive = CondaSetUp.CondaEnvArchive
+SITE_PACKAGES = os.path.join("lib", "python3", "site-packages")
+
+
+def buildEnv(prefix:str):
+    '''
+    A fake environment in prefix : a module with its compiled file, a C-like binary file and links inside the environment.
+    '''
+    os.makedirs(os.path.join(prefix, "conda-meta"))
+    os.makedirs(os.path.join(prefix, SITE_PACKAGES))
+    os.makedirs(os.path.join(prefix, "bin"))
+    module = os.path.join(prefix, SITE_PACKAGES, "archived.py")
+    with open(module, "w") as file:
+        file.write(f"PREFIX = {prefix!r}\n")
+    py_compile.compile(module, doraise=True)
+    with open(os.path.join(prefix, "bin", "tool"), "wb") as file:
+        file.write(b"\x7fELF\0" + prefix.encode("utf-8") + b"/lib\0" + b"\0" * 64 + b"end\0")
+    os.symlink("tool", os.path.join(prefix, "bin", "tool-relative"))
+    os.symlink(os.path.join(prefix, "bin", "tool"), os.path.join(prefix, "bin", "tool-absolute"))
+
+
+def addLink(archive_path:str, name:str, linkname:str, manifest_link:bool=True):
+    '''
+    Rewrites an archive with one more symbolic link, listed in the manifest as a link to the environment if manifest_link.
+    '''
+    with tarfile.open(archive_path) as tar:
+        members = [(member, tar.extractfile(member).read() if member.isfile() else None) for member in tar.getmembers()]
+    with tarfile.open(archive_path, "w") as tar:
+        for member, data in members:
+            if member.name == CondaEnvArchive.MANIFEST:
+                link = tarfile.TarInfo(name)
+                link.type = tarfile.SYMTYPE
+                link.linkname = linkname
+                tar.addfile(link)
+                manifest = json.loads(data)
+                if manifest_link:
+                    manifest["links"].append(name)
+                data = json.dumps(manifest).encode("utf-8")
+                member.size = len(data)
+            tar.addfile(member, io.BytesIO(data) if data is not None else None)
+
+
+class CondaEnvArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory(prefix="slicerconda-archive-")
+        self.root = os.path.realpath(self.directory.name)
+        self.source = os.path.join(self.root, "envAAAAAAAA")
+        buildEnv(self.source)
+        self.archive = os.path.join(self.root, "env.tar")
+        self.assertTrue(CondaEnvArchive.export(self.source, self.archive))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def checkImport(self, prefix:str):
+        self.assertTrue(CondaEnvArchive.extract(self.archive, prefix))
+        names = [os.path.join(root, name) for root, dirs, files in os.walk(prefix) for name in files + dirs]
+        self.assertFalse([name for name in names if name.endswith(".pyc") or name.endswith("__pycache__")])
+        output = subprocess.run([sys.executable, "-c", "import archived; print(archived.PREFIX)"], cwd=self.root, capture_output=True, text=True,
+                                env=dict(os.environ, PYTHONPATH=os.path.join(prefix, SITE_PACKAGES)))
+        self.assertEqual(output.returncode, 0, output.stderr)
+        self.assertEqual(output.stdout.strip(), prefix)
+        with open(os.path.join(prefix, "bin", "tool"), "rb") as file:
+            data = file.read()
+        self.assertIn(prefix.encode("utf-8") + b"/lib\0", data)
+        self.assertTrue(data.endswith(b"end\0"))
+        self.assertEqual(os.readlink(os.path.join(prefix, "bin", "tool-relative")), "tool")
+        self.assertEqual(os.readlink(os.path.join(prefix, "bin", "tool-absolute")), os.path.join(prefix, "bin", "tool"))
+
+    def test_ShorterPrefix(self):
+        self.checkImport(os.path.join(self.root, "envB"))
+
+    def test_LongerPrefix(self):
+        self.checkImport(os.path.join(self.root, "envBBBBBBBBBBBB"))
+
+    def test_UnsafeLinks(self):
+        for name, linkname, manifest_link in [("bin/outside", "/etc/passwd", False),
+                                              ("bin/outside-listed", "/etc/passwd", True),
+                                              ("bin/sibling", self.source + "2/bin/tool", True),
+                                              ("bin/relative", "../../envAAAAAAAAx/bin/tool", False)]:
+            with self.subTest(name=name):
+                addLink(self.archive, name, linkname, manifest_link)
+                prefix = os.path.join(self.root, "imported")
+                self.assertFalse(CondaEnvArchive.extract(self.archive, prefix))
+                self.assertFalse(os.path.exists(prefix))
+                self.assertTrue(CondaEnvArchive.export(self.source, self.archive))
+
+
+if __name__ == "__main__":
+    unittest.main()
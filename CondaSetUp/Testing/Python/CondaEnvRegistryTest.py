@@ -0,0 +1,93 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+# Index of the environments (CondaEnvRegistry) used by condaTestEnv, against the scripted conda of fake_conda.py : environments
+# created or removed outside of the module, recent changes of the envs folder and invalidation by condaCreateEnv/condaDeleteEnv.
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+try:
+    import CondaSetUp
+except ImportError:
+    # Source tree : the module is two folders up
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    import CondaSetUp
+from fake_conda import FakeConda
+
+SETTINGS = ("condaPath", "conda/executable", "activate/executable")
+
+
+class CondaEnvRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory(prefix="slicerconda-registry-")
+        delays = {kind: 0.0 for kind in ("startup", "run", "create", "clone", "remove", "install", "query")}
+        self.fake = FakeConda.build(os.path.join(self.directory.name, "conda"), delays)
+        self.conda = CondaSetUp.CondaSetUpCall()
+        self.saved = {key: self.conda.settings.value(key, "") for key in SETTINGS}
+        self.conda.setConda(self.fake.root)
+        self.envs = os.path.join(self.fake.root, "envs")
+        self.python_version = f"{sys.version_info[0]}.{sys.version_info[1]}"
+
+    def tearDown(self):
+        for key, value in self.saved.items():
+            self.conda.settings.setValue(key, value)
+        self.directory.cleanup()
+
+    def setEnvsTime(self, seconds:float):
+        os.utime(self.envs, (seconds, seconds))
+
+    def test_ExternalChanges(self):
+        # Environments created and removed by another conda (a terminal) are seen without invalidation
+        self.assertFalse(self.conda.condaTestEnv("external"))
+        self.fake.createEnv("external", self.python_version)
+        self.assertTrue(self.conda.condaTestEnv("external"))
+        self.assertEqual(self.conda.condaListEnvs()["external"]["python_version"], self.python_version)
+        shutil.rmtree(os.path.join(self.envs, "external"))
+        self.assertFalse(self.conda.condaTestEnv("external"))
+        self.assertNotIn("external", self.conda.condaListEnvs())
+
+    def test_RemovedConda(self):
+        # An environment whose conda-meta is gone (interrupted removal) doesn't exist anymore, even if the envs folder is unchanged
+        self.fake.createEnv("partial", self.python_version)
+        old = time.time() - 100
+        self.setEnvsTime(old)
+        self.assertTrue(self.conda.condaTestEnv("partial"))
+        shutil.rmtree(os.path.join(self.envs, "partial", "conda-meta"))
+        self.setEnvsTime(old)
+        self.assertFalse(self.conda.condaTestEnv("partial"))
+
+    def test_UnchangedFolder(self):
+        # An envs folder unchanged for a while isn't scanned again : a folder added with the same mtime isn't seen
+        old = time.time() - 100
+        self.setEnvsTime(old)
+        self.assertFalse(self.conda.condaTestEnv("hidden"))
+        self.fake.createEnv("hidden", self.python_version)
+        self.setEnvsTime(old)
+        self.assertFalse(self.conda.condaTestEnv("hidden"))
+        self.conda.invalidateEnvs()
+        self.assertTrue(self.conda.condaTestEnv("hidden"))
+
+    def test_RecentChange(self):
+        # Two changes in the same tick of the file system clock give the same mtime : a recent mtime is never trusted
+        recent = time.time()
+        self.setEnvsTime(recent)
+        self.assertFalse(self.conda.condaTestEnv("racy"))
+        self.fake.createEnv("racy", self.python_version)
+        self.setEnvsTime(recent)
+        self.assertTrue(self.conda.condaTestEnv("racy"))
+
+    def test_CreateDelete(self):
+        self.assertFalse(self.conda.condaTestEnv("created"))
+        self.assertTrue(self.conda.condaCreateEnv("created", self.python_version, [], use_template=False))
+        self.assertTrue(self.conda.condaTestEnv("created"))
+        self.assertEqual(self.conda.getEnvPrefix("created"), os.path.join(self.envs, "created"))
+        self.assertEqual(self.conda.condaDeleteEnv("created"), "Delete")
+        self.assertFalse(self.conda.condaTestEnv("created"))
+        self.assertNotIn("created", self.conda.condaListEnvs())
+
+
+if __name__ == "__main__":
+    unittest.main()
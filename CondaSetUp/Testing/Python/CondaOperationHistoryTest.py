@@ -0,0 +1,122 @@
+import os
+import sys
+import time
+import sqlite3
+import types
+import tempfile
+import unittest
+
+# History of the conda operations (CondaOperationHistory) in a temporary SQLite file : migration of the version 1 schema,
+# runs too short to be saved, pruning of the oldest operations and the order of the estimates. No conda is needed.
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+try:
+    import CondaSetUp
+except ImportError:
+    # Source tree : the module is two folders up
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    import CondaSetUp
+
+from qt import QSettings
+
+CondaOperationHistory = CondaSetUp.CondaOperationHistory
+SETTINGS = ("history/path", "history/enabled", "history/minDuration", "history/maxRows")
+CREATE = "CondaSetUpCall.condaCreateEnv"
+RUN = "CondaSetUpCall.condaRunFilePython"
+
+
+def span(name:str, duration:float, **attributes):
+    '''
+    A finished "call" span of CondaTracer, as given to the listeners.
+    '''
+    return types.SimpleNamespace(name=name, category="call", duration=duration, start=time.time() - duration, error=None, attributes=attributes)
+
+
+class CondaOperationHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory(prefix="slicerconda-history-")
+        self.path = os.path.join(self.directory.name, "history.sqlite")
+        # The user's settings are restored at the end, the history of the user isn't touched
+        self.settings = QSettings("SlicerConda")
+        self.saved = {key: self.settings.value(key) for key in SETTINGS if self.settings.contains(key)}
+        for key in SETTINGS:
+            self.settings.remove(key)
+        self.settings.setValue("history/path", self.path)
+        self.history = CondaOperationHistory()
+
+    def tearDown(self):
+        for key in SETTINGS:
+            if key in self.saved:
+                self.settings.setValue(key, self.saved[key])
+            else:
+                self.settings.remove(key)
+        self.directory.cleanup()
+
+    def test_Path(self):
+        self.assertEqual(self.history.path, self.path)
+
+    def test_MigrationFromVersion1(self):
+        # The version 1 had no file column and stored the script of the runs in requirements
+        connection = sqlite3.connect(self.path)
+        connection.executescript('''
+            CREATE TABLE operations (id INTEGER PRIMARY KEY AUTOINCREMENT, operation TEXT NOT NULL, env TEXT, requirements TEXT,
+                machine TEXT NOT NULL, conda_version TEXT, start REAL NOT NULL, duration REAL NOT NULL, success INTEGER NOT NULL, status TEXT);
+            PRAGMA user_version = 1;
+        ''')
+        rows = [(RUN, "env", "/scripts/segment.py", 1.0), (CREATE, "env", "python=3.11 numpy", 5.0)]
+        connection.executemany("INSERT INTO operations (operation, env, requirements, machine, start, duration, success) VALUES (?, ?, ?, ?, ?, ?, 1)",
+                               [(operation, env, requirements, self.history.machine, start, 1.0) for operation, env, requirements, start in rows])
+        connection.commit()
+        connection.close()
+
+        run, create = (self.history.query(operation)[0] for operation in (RUN, CREATE))
+        self.assertEqual((run["file"], run["requirements"]), ("/scripts/segment.py", None))
+        self.assertEqual((create["file"], create["requirements"]), (None, "python=3.11 numpy"))
+        connection = sqlite3.connect(self.path)
+        self.assertEqual(connection.execute("PRAGMA user_version").fetchone()[0], CondaOperationHistory.SCHEMA_VERSION)
+        connection.close()
+        self.history.record(RUN, 2.0, True, env="env", file="/scripts/other.py")
+        self.assertEqual(len(self.history.query(RUN)), 2)
+
+    def test_MinDuration(self):
+        CondaOperationHistory.onSpan("end", span(RUN, 0.5, env="env", file="short.py"))
+        CondaOperationHistory.onSpan("end", span(RUN, 2.0, env="env", file="long.py"))
+        CondaOperationHistory.onSpan("end", span(CREATE, 0.5, env="env"))
+        CondaOperationHistory.onSpan("end", span("CondaSetUpCall.condaTestEnv", 5.0, env="env"))
+        CondaOperationHistory.onSpan("start", span(CREATE, 5.0, env="env"))
+        self.assertEqual([row["file"] for row in self.history.query(RUN)], ["long.py"])
+        self.assertEqual(len(self.history.query(CREATE)), 1)
+        self.assertEqual(len(self.history.query()), 2)
+        self.settings.setValue("history/minDuration", 0)
+        CondaOperationHistory.onSpan("end", span(RUN, 0.01, env="env", file="short.py"))
+        self.assertEqual(len(self.history.query(RUN)), 2)
+        self.settings.setValue("history/enabled", "false")
+        CondaOperationHistory.onSpan("end", span(CREATE, 5.0, env="env"))
+        self.assertEqual(len(self.history.query(CREATE)), 1)
+
+    def test_MaxRows(self):
+        self.settings.setValue("history/maxRows", 5)
+        for index in range(8):
+            self.history.record(CREATE, float(index), True, env=f"env{index}", start=1000.0 + index)
+        self.assertEqual([row["env"] for row in self.history.query()], [f"env{index}" for index in range(7, 2, -1)])
+        self.settings.setValue("history/maxRows", 0)
+        for index in range(8, 10):
+            self.history.record(CREATE, float(index), True, env=f"env{index}", start=1000.0 + index)
+        self.assertEqual(len(self.history.query()), 7)
+
+    def test_Estimate(self):
+        self.assertIsNone(self.history.estimate(CREATE))
+        for env, requirements, duration, success in [("a", "r1", 10.0, True), ("b", "r2", 20.0, True), ("a", "r3", 40.0, True),
+                                                     ("a", "r1", 1000.0, False), ("c", "r4", 2000.0, False)]:
+            self.history.record(CREATE, duration, success, env=env, requirements=requirements)
+        # Same requirement set, then same environment, then any successful run of the operation
+        self.assertEqual(self.history.estimate(CREATE, env="a", requirements="r1"), 10.0)
+        self.assertEqual(self.history.estimate(CREATE, env="a", requirements="other"), 25.0)
+        self.assertEqual(self.history.estimate(CREATE, env="c", requirements="r4"), 20.0)
+        self.assertEqual(self.history.estimate(CREATE), 20.0)
+        self.assertIsNone(self.history.estimate(RUN, env="a"))
+        self.assertEqual(self.history.remaining(CREATE, 15.0, env="a", requirements="r1"), 0.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
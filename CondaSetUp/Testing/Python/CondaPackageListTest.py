@@ -0,0 +1,100 @@
+import os
+import sys
+import unittest
+import unittest.mock
+
+# Version comparisons of CondaPackageList, used by missingRequirements and condaSyncEnv : the regex comparison used without
+# packaging, and the requirements checked with and without packaging. No conda is needed.
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+try:
+    import CondaSetUp
+except ImportError:
+    # Source tree : the module is two folders up
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    import CondaSetUp
+
+CondaPackageList = CondaSetUp.CondaPackageList
+
+PACKAGES = {CondaPackageList.normalizeName(name): {"name": name, "version": version, "source": "conda"} for name, version in
+            [("SimpleITK", "2.3.1"), ("numpy", "1.26.4"), ("openssl", "1.1.1w"), ("torch", "2.1.0rc1"), ("scipy", "1.11.4.post1")]}
+
+# (requirement, satisfied by PACKAGES)
+REQUIREMENTS = [
+    ("numpy", True),
+    ("numpy==1.26.4", True),
+    ("numpy==1.26.4.0", True),
+    ("numpy==1.26", False),
+    ("numpy==1.26.*", True),
+    ("numpy!=1.26.*", False),
+    ("numpy~=1.26.0", True),
+    ("numpy~=1.25", True),
+    ("numpy~=1.27.0", False),
+    ("numpy>=1.24,<2", True),
+    ("numpy<1.26.4", False),
+    ("torch>=2.1.0rc0", True),
+    ("torch>=2.1.0", False),
+    ("torch<2.1.0", False),
+    ("torch<2.1.0rc2", True),
+    ("scipy>1.11.4", False),
+    ("scipy>=1.11.4", True),
+    ("scipy>1.11.3", True),
+    ("scipy==1.11.4", False),
+    ("openssl>=1.1", True),
+    ("openssl<1.1.1", False),
+    ("openssl==1.1.*", True),
+    ("openssl==1.1.1", False),
+    ("simple-itk", False),
+    ("simpleitk>=2.3", True),
+    ("itk", False),
+    ("ITK>=5", False),
+]
+
+
+class CondaPackageListTest(unittest.TestCase):
+    def test_VersionKey(self):
+        key = CondaPackageList.versionKey
+        self.assertEqual(key("1.2.0"), key("1.2"))
+        self.assertEqual(key("v1.2"), key("1.2+cpu"))
+        self.assertLess(key("1.2.dev1"), key("1.2a1"))
+        self.assertLess(key("1.2a1"), key("1.2b2"))
+        self.assertLess(key("1.2b2"), key("1.2rc1"))
+        self.assertLess(key("1.2rc1"), key("1.2"))
+        self.assertLess(key("1.2"), key("1.2.post1"))
+        self.assertLess(key("1.9"), key("1.10"))
+        self.assertLess(key("1.1.1"), key("1.1.1w"))
+
+    def test_MatchSpecifier(self):
+        match = CondaPackageList.matchSpecifier
+        self.assertTrue(match("1.26.4", "==", "1.26.*"))
+        self.assertFalse(match("1.27.0", "==", "1.26.*"))
+        self.assertTrue(match("1.27.0", "!=", "1.26.*"))
+        self.assertTrue(match("2.2.1", "~=", "2.2"))
+        self.assertFalse(match("3.0", "~=", "2.2"))
+        self.assertTrue(match("1.4.2", "~=", "1.4.1"))
+        self.assertFalse(match("1.5.0", "~=", "1.4.1"))
+        self.assertTrue(match("1.1.1w", ">=", "1.1"))
+        self.assertTrue(match("1.0+local", "===", "1.0+local"))
+        self.assertFalse(match("1.0", "===", "1.0.0"))
+
+    def checkMissing(self):
+        for requirement, satisfied in REQUIREMENTS:
+            with self.subTest(requirement=requirement):
+                self.assertEqual(CondaPackageList.missing(PACKAGES, [requirement]), [] if satisfied else [requirement])
+        self.assertEqual(CondaPackageList.missing(PACKAGES, ["not a requirement !"]), ["not a requirement !"])
+
+    def test_MissingWithPackaging(self):
+        try:
+            import packaging.requirements
+        except ImportError:
+            self.skipTest("packaging isn't installed")
+        self.checkMissing()
+
+    def test_MissingWithoutPackaging(self):
+        # An import of a module set to None in sys.modules raises ImportError
+        with unittest.mock.patch.dict(sys.modules, {"packaging": None, "packaging.requirements": None, "packaging.version": None}):
+            self.checkMissing()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,322 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import unittest
+
+# Benchmark of the CondaSetUpCall operations : each operation is run several times and its latency (p50, p95, max)
+# and the number of processes it starts are reported. It runs against a real local conda or against the scripted
+# stand-in of fake_conda.py (configurable delays, no network), whose numbers show the overhead of the module itself.
+# Run it in Slicer :
+#   Slicer --no-main-window --python-script CondaSetUpBenchmark.py --conda fake --iterations 20 --json fake.json
+#   Slicer --no-main-window --python-script CondaSetUpBenchmark.py --conda ~/miniconda3 --env myenv --operations testEnv runFilePython
+# With --conda fake, '--delay startup=0 --delay run=0' measures only the time spent in CondaSetUp and in process spawning.
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+try:
+    import CondaSetUp
+except ImportError:
+    # Source tree : the module is two folders up
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    import CondaSetUp
+from fake_conda import FakeConda
+
+OPERATIONS = ["testEnv", "runCommand", "runFilePython", "runFilePythonDirect", "runFilePythonWarm", "createEnv", "deleteEnv"]
+BENCHMARK_ENV = "slicerconda-benchmark"
+BENCHMARK_SCRIPT = "import sys\nprint('ok', *sys.argv[1:])\n"
+
+
+def percentile(values:list, q:float)->float:
+    '''
+    Percentile q (0-100) of values with linear interpolation between the closest ranks.
+    '''
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = (len(values) - 1) * q / 100.0
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+class SpawnCounter():
+    '''
+    Counts the processes started through subprocess.Popen (every conda command of CondaSetUp) while it is active.
+    '''
+    def __init__(self) -> None:
+        self.count = 0
+        self.lock = threading.Lock()
+        self.original = None
+
+    def __enter__(self):
+        counter = self
+        self.original = subprocess.Popen
+        class CountingPopen(self.original):
+            def __init__(self, *args, **kwargs):
+                with counter.lock:
+                    counter.count += 1
+                super().__init__(*args, **kwargs)
+        subprocess.Popen = CountingPopen
+        return self
+
+    def __exit__(self, *exc):
+        subprocess.Popen = self.original
+        return False
+
+
+class OperationResult():
+    '''
+    Durations (seconds), spawn counts and errors of the iterations of one operation.
+    '''
+    def __init__(self, name:str) -> None:
+        self.name = name
+        self.durations = []
+        self.spawns = []
+        self.conda_calls = []
+        self.errors = []
+
+    def summary(self)->dict:
+        return {
+            "count": len(self.durations),
+            "errors": len(self.errors),
+            "p50": percentile(self.durations, 50),
+            "p95": percentile(self.durations, 95),
+            "max": max(self.durations, default=0.0),
+            "mean": sum(self.durations) / len(self.durations) if self.durations else 0.0,
+            "spawns_p50": percentile(self.spawns, 50),
+            "spawns_max": max(self.spawns, default=0),
+            "conda_calls_p50": percentile(self.conda_calls, 50) if self.conda_calls else None,
+            "first_error": self.errors[0] if self.errors else None,
+        }
+
+
+class CondaBenchmark():
+    '''
+    Runs the operations of CondaSetUpCall on an installation (a real one or a FakeConda) and collects their OperationResult.
+    The conda settings of QSettings("SlicerConda") are restored at the end. While it runs, the operation history and the package cache
+    are kept in its temporary folder, so the benchmark doesn't change the estimates and the cache of the user.
+    backend is the execution backend to measure ("process" or "session", see CondaSetUpCall.getBackend), the current one if None.
+    '''
+    def __init__(self, conda_path:str, env_name:str=BENCHMARK_ENV, python_version:str=None, fake:FakeConda=None, backend:str=None) -> None:
+        self.conda_path = conda_path
+        self.backend = backend
+        self.env_name = env_name
+        self.python_version = python_version or f"{sys.version_info[0]}.{sys.version_info[1]}"
+        self.fake = fake
+        self.conda = CondaSetUp.CondaSetUpCall()
+        self.script = None
+
+    def isError(self, value)->bool:
+        if value is False or value is None:
+            return True
+        if isinstance(value, str):
+            return value.startswith(("Error", "Path to conda", "Env doesn't exist", "Not exist"))
+        return False
+
+    def operation(self, name:str):
+        '''
+        Returns (setup, function, teardown) of an operation : only function(i) is timed, it returns True or an error message.
+        '''
+        conda = self.conda
+        def check(value):
+            return value if self.isError(value) else True
+        def tempName(i):
+            return f"{self.env_name}-tmp-{i}"
+        if name == "testEnv":
+            return None, lambda i: check(conda.condaTestEnv(self.env_name)), None
+        if name == "runCommand":
+            return None, lambda i: check(conda.condaRunCommand(["python3", "-c", "pass"], env_name=self.env_name)), None
+        if name == "runFilePython":
+            return None, lambda i: check(conda.condaRunFilePython(self.script, [i], env_name=self.env_name)), None
+        if name == "runFilePythonDirect":
+            return None, lambda i: check(conda.condaRunFilePython(self.script, [i], env_name=self.env_name, direct=True)), None
+        if name == "runFilePythonWarm":
+            return None, lambda i: check(conda.condaRunFilePython(self.script, [i], env_name=self.env_name, warm=True)), None
+        if name == "createEnv":
+            return (None, lambda i: check(conda.condaCreateEnv(tempName(i), self.python_version, [], use_template=False)),
+                    lambda i: conda.condaDeleteEnv(tempName(i)))
+        if name == "deleteEnv":
+            def setup(i):
+                if self.fake is not None:
+                    self.fake.createEnv(tempName(i), self.python_version)
+                    conda.invalidateEnvs()
+                else:
+                    conda.condaCreateEnv(tempName(i), self.python_version, [], use_template=False)
+            return setup, lambda i: True if conda.condaDeleteEnv(tempName(i)) == "Delete" else "Error : the environment hasn't been deleted", None
+        raise ValueError(f"Unknown operation {name}, expected one of {', '.join(OPERATIONS)}")
+
+    def run(self, operations:list=None, iterations:int=10, warmup:int=1, callback=None)->dict:
+        '''
+        Runs every operation warmup + iterations times (only the last iterations are measured) and returns the report.
+        callback, if given, is called with (operation, iteration, duration) after each measured iteration.
+        '''
+        operations = operations or OPERATIONS
+        for name in operations:
+            self.operation(name)
+        saved = {key: self.conda.settings.value(key, "") for key in ("condaPath", "conda/executable", "activate/executable", "history/path", "cache/directory")}
+        saved["backend/type"] = self.conda.settings.value("backend/type", "process")
+        results = {}
+        with tempfile.TemporaryDirectory(prefix="slicerconda-benchmark-") as directory:
+            self.script = os.path.join(directory, "benchmark_script.py")
+            with open(self.script, "w") as file:
+                file.write(BENCHMARK_SCRIPT)
+            try:
+                self.conda.settings.setValue("history/path", os.path.join(directory, "history.sqlite"))
+                self.conda.settings.setValue("cache/directory", os.path.join(directory, "cache"))
+                if self.backend is not None:
+                    self.conda.settings.setValue("backend/type", self.backend)
+                backend = type(self.conda.getBackend()).__name__
+                self.conda.setConda(self.conda_path)
+                self.conda.invalidateEnvs()
+                if not self.conda.condaTestEnv(self.env_name):
+                    if self.fake is not None:
+                        self.fake.createEnv(self.env_name, self.python_version)
+                        self.conda.invalidateEnvs()
+                    elif not self.conda.condaCreateEnv(self.env_name, self.python_version, [], use_template=False):
+                        raise RuntimeError(f"The environment {self.env_name} can't be created in {self.conda_path}")
+                for name in operations:
+                    results[name] = self.runOperation(name, iterations, warmup, callback)
+            finally:
+                CondaSetUp.CondaWorker.stopAll()
+                CondaSetUp.CondaExecutionBackend.closeAll()
+                for key, value in saved.items():
+                    self.conda.settings.setValue(key, value)
+                self.conda.invalidateEnvs()
+        return {
+            "conda": "fake" if self.fake is not None else self.conda_path,
+            "delays": self.fake.readDelays() if self.fake is not None else None,
+            "backend": backend,
+            "iterations": iterations,
+            "platform": f"{platform.system()} {platform.machine()}",
+            "python": self.python_version,
+            "results": {name: result.summary() for name, result in results.items()},
+        }
+
+    def runOperation(self, name:str, iterations:int, warmup:int, callback=None)->OperationResult:
+        setup, function, teardown = self.operation(name)
+        result = OperationResult(name)
+        for i in range(warmup + iterations):
+            if setup is not None:
+                setup(i)
+            if self.fake is not None:
+                self.fake.clearLog()
+            with SpawnCounter() as counter:
+                start = time.perf_counter()
+                try:
+                    status = function(i)
+                except Exception as e:
+                    status = f"Error : {e}"
+                duration = time.perf_counter() - start
+            conda_calls = self.fake.spawnCount() if self.fake is not None else None
+            if teardown is not None:
+                teardown(i)
+            if i < warmup:
+                continue
+            result.durations.append(duration)
+            result.spawns.append(counter.count)
+            if conda_calls is not None:
+                result.conda_calls.append(conda_calls)
+            if status is not True:
+                result.errors.append(str(status)[:500])
+            if callback is not None:
+                callback(name, i - warmup, duration)
+        return result
+
+
+def runFakeBenchmark(iterations:int=10, delays:dict=None, operations:list=None, warmup:int=1, backend:str=None)->dict:
+    '''
+    Runs the benchmark against a temporary FakeConda and returns the report.
+    '''
+    with tempfile.TemporaryDirectory(prefix="slicerconda-fakeconda-") as root:
+        fake = FakeConda.build(root, delays)
+        return CondaBenchmark(fake.root, fake=fake, backend=backend).run(operations, iterations, warmup)
+
+
+def formatReport(report:dict)->str:
+    lines = [f"conda : {report['conda']}   backend : {report['backend']}   iterations : {report['iterations']}   python : {report['python']}   {report['platform']}"]
+    if report["delays"]:
+        lines.append("delays : " + ", ".join(f"{kind}={seconds}s" for kind, seconds in report["delays"].items()))
+    lines.append(f"{'operation':<22}{'p50 (ms)':>10}{'p95 (ms)':>10}{'max (ms)':>10}{'spawns':>8}{'conda':>7}{'errors':>8}")
+    for name, summary in report["results"].items():
+        conda_calls = "" if summary["conda_calls_p50"] is None else f"{summary['conda_calls_p50']:g}"
+        lines.append(f"{name:<22}{summary['p50']*1000:>10.1f}{summary['p95']*1000:>10.1f}{summary['max']*1000:>10.1f}"
+                     f"{summary['spawns_p50']:>8g}{conda_calls:>7}{summary['errors']:>8}")
+        if summary["first_error"]:
+            lines.append(f"    first error : {summary['first_error'].strip().splitlines()[-1] if summary['first_error'].strip() else ''}")
+    return "\n".join(lines)
+
+
+def main(argv:list)->int:
+    parser = argparse.ArgumentParser(description="Benchmark of the CondaSetUpCall operations")
+    parser.add_argument("--conda", default="fake", help="'fake' for the scripted conda, or the folder of a conda installation")
+    parser.add_argument("--env", default=BENCHMARK_ENV, help="environment used by the run operations (created if it doesn't exist)")
+    parser.add_argument("--python-version", default=None, help="python version of the created environments")
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=1, help="iterations run before measuring")
+    parser.add_argument("--operations", nargs="+", choices=OPERATIONS, default=None)
+    parser.add_argument("--delay", action="append", default=[], metavar="KIND=SECONDS", help="delay of the fake conda (startup, run, create, clone, remove, install, query)")
+    parser.add_argument("--backend", choices=["process", "session"], default=None, help="execution backend of the commands (the one of the settings by default)")
+    parser.add_argument("--json", default=None, help="path of the JSON report")
+    args = parser.parse_args(argv)
+
+    if args.conda == "fake":
+        delays = {}
+        for item in args.delay:
+            kind, _, seconds = item.partition("=")
+            delays[kind] = float(seconds)
+        with tempfile.TemporaryDirectory(prefix="slicerconda-fakeconda-") as root:
+            fake = FakeConda.build(root, delays)
+            report = CondaBenchmark(fake.root, args.env, args.python_version, fake, args.backend).run(args.operations, args.iterations, args.warmup)
+    else:
+        report = CondaBenchmark(os.path.abspath(os.path.expanduser(args.conda)), args.env, args.python_version,
+                                backend=args.backend).run(args.operations, args.iterations, args.warmup)
+
+    print(formatReport(report))
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(report, file, indent=2)
+    return 1 if any(summary["errors"] for summary in report["results"].values()) else 0
+
+
+class CondaSetUpBenchmarkTest(unittest.TestCase):
+    '''
+    Short run against the fake conda without delays : every operation succeeds and the cached paths don't start processes.
+    '''
+    def test_FakeConda(self):
+        delays = {kind: 0.0 for kind in ("startup", "run", "create", "clone", "remove", "install", "query")}
+        report = runFakeBenchmark(iterations=3, delays=delays, backend="process")
+        print(formatReport(report))
+        results = report["results"]
+        for name, summary in results.items():
+            self.assertEqual(summary["errors"], 0, f"{name} : {summary['first_error']}")
+        self.assertEqual(results["testEnv"]["spawns_max"], 0)
+        self.assertEqual(results["runFilePython"]["spawns_p50"], 1)
+        self.assertEqual(results["runFilePythonDirect"]["conda_calls_p50"], 0)
+        self.assertEqual(results["runFilePythonWarm"]["spawns_p50"], 0)
+
+    def test_FakeCondaSession(self):
+        # The commands go to the bash sessions : no process is started by the module, conda itself is still called
+        delays = {kind: 0.0 for kind in ("startup", "run", "create", "clone", "remove", "install", "query")}
+        report = runFakeBenchmark(iterations=3, delays=delays, backend="session")
+        print(formatReport(report))
+        results = report["results"]
+        for name, summary in results.items():
+            self.assertEqual(summary["errors"], 0, f"{name} : {summary['first_error']}")
+        self.assertEqual(report["backend"], "CondaBashSessionBackend")
+        self.assertEqual(results["runFilePython"]["spawns_max"], 0)
+        self.assertEqual(results["runFilePython"]["conda_calls_p50"], 1)
+        self.assertEqual(results["createEnv"]["spawns_max"], 0)
+
+
+if __name__ == "__main__":
+    status = main(sys.argv[1:])
+    try:
+        import slicer
+        slicer.util.exit(status)
+    except (ImportError, AttributeError):
+        sys.exit(status)
@@ -0,0 +1,69 @@
+import os
+import sys
+import time
+import tempfile
+import unittest
+import warnings
+
+# Jobs of the long-lived python worker (CondaWorker, utils/conda_worker.py) run with the python of the tests : idle timeout
+# racing a new job, and stop. No conda is needed.
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+try:
+    import CondaSetUp
+except ImportError:
+    # Source tree : the module is two folders up
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    import CondaSetUp
+
+CondaWorker = CondaSetUp.CondaWorker
+
+
+class CondaWorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory(prefix="slicerconda-worker-")
+        self.script = os.path.join(self.directory.name, "job.py")
+        with open(self.script, "w") as file:
+            file.write("import sys\nprint('ok', *sys.argv[1:])\n")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_IdleTimeout(self):
+        # Jobs sent around the idle timeout : the worker either runs them or exits before reading them, and they are sent again
+        worker = CondaWorker([sys.executable], env=dict(os.environ), idle_timeout=0.2)
+        try:
+            for i in range(30):
+                returncode, stdout, stderr = worker.run(self.script, [i])
+                self.assertEqual((returncode, stdout), (0, f"ok {i}\n"), stderr)
+                time.sleep(0.15 + 0.1 * (i % 3) / 2)
+        finally:
+            worker.stop()
+
+    def test_Crash(self):
+        # A worker dying during a job isn't an idle exit : the job isn't run twice
+        with open(self.script, "w") as file:
+            file.write("import os\nos._exit(3)\n")
+        worker = CondaWorker([sys.executable], env=dict(os.environ), idle_timeout=0)
+        try:
+            returncode, stdout, stderr = worker.run(self.script)
+            self.assertEqual(returncode, 1)
+            self.assertIn("crashed", stderr)
+        finally:
+            worker.stop()
+
+    def test_Stop(self):
+        worker = CondaWorker([sys.executable], env=dict(os.environ), idle_timeout=0)
+        self.assertEqual(worker.run(self.script)[0], 0)
+        process = worker.process
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            worker.stop()
+            del worker
+        self.assertIsNotNone(process.poll())
+        self.assertTrue(process.stdin.closed and process.stdout.closed)
+        self.assertFalse([warning for warning in caught if issubclass(warning.category, ResourceWarning)])
+
+
+if __name__ == "__main__":
+    unittest.main()
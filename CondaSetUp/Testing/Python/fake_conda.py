@@ -0,0 +1,318 @@
+import os
+import sys
+import json
+import time
+import shlex
+import shutil
+
+# Scripted stand-in for the conda executable, used by CondaSetUpBenchmark.py to measure the overhead of CondaSetUp itself
+# on a Linux box without network. FakeConda.build(root) lays out a Miniconda-like folder :
+#   root/bin/conda            bash wrapper running this file with FAKE_CONDA_ROOT=root
+#   root/bin/activate
+#   root/bin/python, python3  wrappers of the python running the benchmark
+#   root/envs/<name>          environments created by 'conda create' (conda-meta records, bin/python3, site-packages)
+#   root/fake_conda.json      delays in seconds of each kind of command (see DEFAULT_DELAYS)
+#   root/fake_conda.log       one line per invocation (spawn counting)
+# Supported commands : run, create (with --clone), env remove / remove, install, info --envs, list, tos, init, clean, config.
+
+DEFAULT_DELAYS = {
+    "startup": 0.2,   # every invocation, like the import time of conda
+    "run": 0.0,
+    "create": 1.0,
+    "clone": 0.3,
+    "remove": 0.2,
+    "install": 0.5,   # conda install and 'python -m pip install' through conda run
+    "query": 0.0,     # info, list, tos, init, clean, config
+}
+
+CONFIG_NAME = "fake_conda.json"
+LOG_NAME = "fake_conda.log"
+
+
+class FakeConda():
+    '''
+    A fake Miniconda installation in root, whose conda executable sleeps for configurable delays instead of solving and downloading.
+    '''
+    def __init__(self, root:str) -> None:
+        self.root = os.path.abspath(root)
+
+    @staticmethod
+    def build(root:str, delays:dict=None, python:str=None):
+        '''
+        Creates (or updates the delays of) the fake installation in root and returns its FakeConda.
+        '''
+        fake = FakeConda(root)
+        python = python or sys.executable
+        for folder in ("bin", "envs", "pkgs", "conda-meta"):
+            os.makedirs(os.path.join(fake.root, folder), exist_ok=True)
+        fake.writeScript(os.path.join(fake.root, "bin", "conda"),
+                         f"FAKE_CONDA_ROOT={shlex.quote(fake.root)} exec {shlex.quote(python)} {shlex.quote(os.path.abspath(__file__))} \"$@\"\n")
+        fake.writeScript(os.path.join(fake.root, "bin", "activate"), ":\n")
+        fake.setDelays(delays, python)
+        writePythonWrappers(fake.root, python)
+        writeRecord(fake.root, "python", f"{sys.version_info[0]}.{sys.version_info[1]}.{sys.version_info[2]}")
+        return fake
+
+    @staticmethod
+    def writeScript(path:str, body:str):
+        with open(path, "w") as file:
+            file.write("#!/bin/bash\n" + body)
+        os.chmod(path, 0o755)
+
+    def setDelays(self, delays:dict=None, python:str=None):
+        config = {"delays": dict(DEFAULT_DELAYS, **(delays or {})), "python": python or readConfig(self.root).get("python", sys.executable)}
+        with open(os.path.join(self.root, CONFIG_NAME), "w") as file:
+            json.dump(config, file, indent=2)
+
+    def readDelays(self)->dict:
+        return dict(DEFAULT_DELAYS, **readConfig(self.root).get("delays", {}))
+
+    def spawnCount(self)->int:
+        '''
+        Number of invocations of the fake conda since the installation was built or the log was cleared.
+        '''
+        try:
+            with open(os.path.join(self.root, LOG_NAME)) as file:
+                return sum(1 for _ in file)
+        except OSError:
+            return 0
+
+    def clearLog(self):
+        try:
+            os.remove(os.path.join(self.root, LOG_NAME))
+        except OSError:
+            pass
+
+    def createEnv(self, name:str, python_version:str=None):
+        '''
+        Creates an environment directly, without going through the fake executable (no delay, no log).
+        '''
+        prefix = os.path.join(self.root, "envs", name)
+        makeEnv(self.root, prefix, python_version)
+        return prefix
+
+    def remove(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def readConfig(root:str)->dict:
+    try:
+        with open(os.path.join(root, CONFIG_NAME)) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def writePythonWrappers(prefix:str, python:str):
+    for name in ("python", "python3"):
+        FakeConda.writeScript(os.path.join(prefix, "bin", name), f"exec {shlex.quote(python)} \"$@\"\n")
+
+
+def writeRecord(prefix:str, name:str, version:str):
+    conda_meta = os.path.join(prefix, "conda-meta")
+    os.makedirs(conda_meta, exist_ok=True)
+    with open(os.path.join(conda_meta, f"{name}-{version}-0.json"), "w") as file:
+        json.dump({"name": name, "version": version, "build": "0"}, file)
+
+
+def sitePackages(prefix:str, python_version:str)->str:
+    return os.path.join(prefix, "lib", "python" + ".".join(python_version.split(".")[:2]), "site-packages")
+
+
+def makeEnv(root:str, prefix:str, python_version:str=None, packages=()):
+    python_version = python_version or f"{sys.version_info[0]}.{sys.version_info[1]}"
+    os.makedirs(os.path.join(prefix, "bin"), exist_ok=True)
+    os.makedirs(sitePackages(prefix, python_version), exist_ok=True)
+    writePythonWrappers(prefix, readConfig(root).get("python", sys.executable))
+    writeRecord(prefix, "python", python_version)
+    for name, version in packages:
+        writeRecord(prefix, name, version)
+
+
+def splitSpec(spec:str):
+    for separator in ("==", "=", ">=", "<=", "~=", ">", "<"):
+        if separator in spec:
+            name, version = spec.split(separator, 1)
+            return name.strip(), version.split(",")[0].strip("= ") or "0"
+    return spec.strip(), "0"
+
+
+def delay(config:dict, kind:str):
+    seconds = float(config.get("delays", {}).get(kind, DEFAULT_DELAYS.get(kind, 0.0)))
+    if seconds > 0:
+        time.sleep(seconds)
+
+
+class Arguments():
+    '''
+    The few options of conda the module uses : -n/--name, -p/--prefix, --clone and flags, the other words are positional.
+    '''
+    def __init__(self, argv:list) -> None:
+        self.options = {}
+        self.positional = []
+        index = 0
+        while index < len(argv):
+            arg = argv[index]
+            if arg in ("-n", "--name", "-p", "--prefix", "--clone", "--channel", "-c") and index + 1 < len(argv):
+                self.options[arg.lstrip("-")[:1] if arg in ("-n", "--name", "-p", "--prefix") else arg.lstrip("-")] = argv[index+1]
+                index += 2
+                continue
+            if not arg.startswith("-"):
+                self.positional.append(arg)
+            index += 1
+
+    def prefix(self, root:str):
+        if "p" in self.options:
+            return os.path.abspath(self.options["p"])
+        if "n" in self.options:
+            return os.path.join(root, "envs", self.options["n"])
+        return root
+
+
+def commandRun(root:str, config:dict, argv:list)->int:
+    # conda run [-n NAME | -p PREFIX] [--no-capture-output] command... : the options end at the first word of the command
+    index = 0
+    prefix = root
+    while index < len(argv) and argv[index].startswith("-"):
+        if argv[index] in ("-n", "--name"):
+            prefix = os.path.join(root, "envs", argv[index+1])
+            index += 2
+        elif argv[index] in ("-p", "--prefix"):
+            prefix = os.path.abspath(argv[index+1])
+            index += 2
+        else:
+            index += 1
+    command = argv[index:]
+    if not command:
+        print("fake conda run : no command", file=sys.stderr)
+        return 1
+    if not os.path.isdir(os.path.join(prefix, "conda-meta")):
+        print(f"fake conda run : environment {prefix} doesn't exist", file=sys.stderr)
+        return 1
+    delay(config, "run")
+    if os.path.basename(command[0]).startswith("python") and command[1:4] == ["-m", "pip", "install"]:
+        delay(config, "install")
+        python_version = readPythonVersion(prefix)
+        for spec in command[4:]:
+            if spec.startswith("-"):
+                continue
+            name, version = splitSpec(spec)
+            dist_info = os.path.join(sitePackages(prefix, python_version), f"{name}-{version}.dist-info")
+            os.makedirs(dist_info, exist_ok=True)
+            with open(os.path.join(dist_info, "METADATA"), "w") as file:
+                file.write(f"Metadata-Version: 2.1\nName: {name}\nVersion: {version}\n\n")
+        return 0
+    env = dict(os.environ)
+    env.pop("FAKE_CONDA_ROOT", None)
+    env["PATH"] = os.path.join(prefix, "bin") + os.pathsep + env.get("PATH", "")
+    env["CONDA_PREFIX"] = prefix
+    env["CONDA_DEFAULT_ENV"] = os.path.basename(prefix)
+    sys.stdout.flush()
+    try:
+        os.execvpe(command[0], command, env)
+    except OSError as e:
+        print(f"fake conda run : {e}", file=sys.stderr)
+        return 1
+
+
+def readPythonVersion(prefix:str)->str:
+    try:
+        for file_name in os.listdir(os.path.join(prefix, "conda-meta")):
+            if file_name.startswith("python-") and file_name.endswith(".json"):
+                return file_name[len("python-"):].split("-")[0]
+    except OSError:
+        pass
+    return f"{sys.version_info[0]}.{sys.version_info[1]}"
+
+
+def commandCreate(root:str, config:dict, argv:list)->int:
+    args = Arguments(argv)
+    prefix = args.prefix(root)
+    if prefix == root:
+        print("fake conda create : -n or -p is required", file=sys.stderr)
+        return 1
+    if "clone" in args.options:
+        source = args.options["clone"]
+        if not os.path.isdir(source):
+            source = os.path.join(root, "envs", source)
+        if not os.path.isdir(os.path.join(source, "conda-meta")):
+            print(f"fake conda create : can't clone {source}", file=sys.stderr)
+            return 1
+        delay(config, "clone")
+        shutil.rmtree(prefix, ignore_errors=True)
+        shutil.copytree(source, prefix, symlinks=True)
+        return 0
+    delay(config, "create")
+    python_version = None
+    packages = []
+    for spec in args.positional:
+        name, version = splitSpec(spec)
+        if name == "python":
+            python_version = version
+        else:
+            packages.append((name, version))
+    shutil.rmtree(prefix, ignore_errors=True)
+    makeEnv(root, prefix, python_version, packages)
+    return 0
+
+
+def commandRemove(root:str, config:dict, argv:list)->int:
+    prefix = Arguments(argv).prefix(root)
+    if prefix == root or not os.path.isdir(prefix):
+        print(f"fake conda remove : environment {prefix} doesn't exist", file=sys.stderr)
+        return 1
+    delay(config, "remove")
+    shutil.rmtree(prefix)
+    return 0
+
+
+def commandInstall(root:str, config:dict, argv:list)->int:
+    args = Arguments(argv)
+    prefix = args.prefix(root)
+    delay(config, "install")
+    for spec in args.positional:
+        writeRecord(prefix, *splitSpec(spec))
+    return 0
+
+
+def commandInfo(root:str, config:dict, argv:list)->int:
+    delay(config, "query")
+    print("# conda environments:\n#")
+    print(f"base                     {root}")
+    envs = os.path.join(root, "envs")
+    for name in sorted(os.listdir(envs)) if os.path.isdir(envs) else []:
+        print(f"{name:<24} {os.path.join(envs, name)}")
+    return 0
+
+
+def main(argv:list)->int:
+    root = os.environ.get("FAKE_CONDA_ROOT")
+    if not root:
+        print("FAKE_CONDA_ROOT is not set, use the bin/conda of a FakeConda installation", file=sys.stderr)
+        return 1
+    config = readConfig(root)
+    with open(os.path.join(root, LOG_NAME), "a") as file:
+        file.write(json.dumps({"time": time.time(), "argv": argv}) + "\n")
+    delay(config, "startup")
+    command = argv[0] if argv else ""
+    if command == "run":
+        return commandRun(root, config, argv[1:])
+    if command == "create":
+        return commandCreate(root, config, argv[1:])
+    if command == "remove" or argv[:2] == ["env", "remove"]:
+        return commandRemove(root, config, argv[2:] if command == "env" else argv[1:])
+    if command == "install":
+        return commandInstall(root, config, argv[1:])
+    if command == "info" or argv[:2] == ["env", "list"]:
+        return commandInfo(root, config, argv[1:])
+    if command in ("list", "tos", "init", "clean", "config", "--version"):
+        delay(config, "query")
+        if command == "--version":
+            print("conda 0.0.0 (fake)")
+        return 0
+    print(f"fake conda : unsupported command {' '.join(argv)}", file=sys.stderr)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
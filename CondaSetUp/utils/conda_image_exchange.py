@@ -0,0 +1,55 @@
+import os
+import json
+
+# Child side of CondaSetUp.CondaImageExchange : reads and writes the intermediate images exchanged with Slicer.
+# The format is chosen from the extension of the path given by Slicer :
+#   .json         raw voxels in the file next to it (same name, .raw) described by the JSON header
+#                 (shape (k, j, i[, components]), dtype, spacing, origin and direction in LPS)
+#   .nrrd, .nhdr  NRRD written without compression
+#   other         written by SimpleITK with its default compression, for the final outputs of the user
+#
+#   image = readImage(sys.argv[1])
+#   ...
+#   writeImage(result, sys.argv[2])
+
+
+def rawPath(header_path):
+    return os.path.splitext(header_path)[0] + ".raw"
+
+
+def readImage(path):
+    '''
+    Returns the SimpleITK image of a file written by Slicer.
+    '''
+    import SimpleITK as sitk
+    if not path.lower().endswith(".json"):
+        return sitk.ReadImage(path)
+
+    import numpy as np
+    with open(path) as file:
+        header = json.load(file)
+    array = np.fromfile(rawPath(path), dtype=np.dtype(header["dtype"])).reshape(header["shape"])
+    image = sitk.GetImageFromArray(array, isVector=len(header["shape"]) == 4)
+    image.SetSpacing(header["spacing"])
+    image.SetOrigin(header["origin"])
+    image.SetDirection(header["direction"])
+    return image
+
+
+def writeImage(image, path):
+    '''
+    Writes a SimpleITK image for Slicer, without compression for the intermediate formats.
+    '''
+    import SimpleITK as sitk
+    lower = path.lower()
+    if lower.endswith(".json"):
+        array = sitk.GetArrayViewFromImage(image)
+        array.tofile(rawPath(path))
+        header = {"shape": list(array.shape), "dtype": array.dtype.str, "spacing": list(image.GetSpacing()),
+                  "origin": list(image.GetOrigin()), "direction": list(image.GetDirection())}
+        with open(path, "w") as file:
+            json.dump(header, file)
+    elif lower.endswith((".nrrd", ".nhdr")):
+        sitk.WriteImage(image, path, useCompression=False)
+    else:
+        sitk.WriteImage(image, path)
@@ -0,0 +1,16 @@
+import sys
+
+# Progress protocol understood by CondaSetUpCall.condaStreamFilePython / condaRunFilePython(..., callback=...).
+# A script running in a conda environment reports its progress by printing a line :
+#   [SlicerConda:progress] <percent> <message>
+# This file has no dependency, it can be imported or copied next to the script.
+
+PROGRESS_TAG = "[SlicerConda:progress]"
+
+
+def reportProgress(percent, message=""):
+    '''
+    Prints a progress line (percent between 0 and 100) and flushes it so Slicer receives it immediately.
+    '''
+    sys.stdout.write(f"{PROGRESS_TAG} {float(percent):g} {message}\n")
+    sys.stdout.flush()
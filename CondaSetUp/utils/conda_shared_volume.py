@@ -0,0 +1,94 @@
+import sys
+import os
+import json
+import numpy as np
+from multiprocessing import shared_memory
+
+# Child side of CondaSetUp.CondaSharedVolume : a volume shared by Slicer through multiprocessing.shared_memory.
+# The descriptor given by Slicer (a JSON string or the path of a JSON file) contains :
+#   name, shape (k, j, i[, components]), dtype, spacing (i, j, k), origin and direction (3x3, row-major) in LPS.
+#
+#   volume = attach(sys.argv[1])
+#   image = toSimpleITK(volume)         # or work directly on volume.array (numpy, no copy)
+#   ...
+#   output = attach(sys.argv[2])
+#   output.array[:] = result
+#   volume.close(); output.close()
+
+
+class SharedVolume():
+    '''
+    A volume shared by Slicer : array is a numpy view on the shared memory, writing in it writes in the memory read back by Slicer.
+    '''
+    def __init__(self, descriptor):
+        self.descriptor = descriptor
+        self.shm = openSharedMemory(descriptor["name"])
+        self.array = np.ndarray(tuple(descriptor["shape"]), dtype=np.dtype(descriptor["dtype"]), buffer=self.shm.buf)
+        self.spacing = tuple(descriptor.get("spacing", (1.0, 1.0, 1.0)))
+        self.origin = tuple(descriptor.get("origin", (0.0, 0.0, 0.0)))
+        self.direction = tuple(descriptor.get("direction", (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0)))
+
+    def components(self):
+        return self.array.shape[3] if self.array.ndim == 4 else 1
+
+    def close(self):
+        '''
+        Releases the view on the shared memory. The memory itself belongs to Slicer, it is never unlinked here.
+        '''
+        self.array = None
+        self.shm.close()
+
+
+def openSharedMemory(name):
+    '''
+    Attaches to an existing shared memory without registering it in the resource tracker of this process :
+    otherwise the tracker would destroy the memory of Slicer when this script exits (Python < 3.13).
+    '''
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+    return shm
+
+
+def readDescriptor(descriptor):
+    if isinstance(descriptor, dict):
+        return descriptor
+    if os.path.isfile(descriptor):
+        with open(descriptor) as file:
+            return json.load(file)
+    return json.loads(descriptor)
+
+
+def attach(descriptor):
+    '''
+    Returns the SharedVolume of a descriptor : a dict, a JSON string or the path of a JSON file.
+    '''
+    return SharedVolume(readDescriptor(descriptor))
+
+
+def toSimpleITK(volume):
+    '''
+    Returns a SimpleITK image of the shared volume with its geometry. The voxels are copied once by SimpleITK.
+    '''
+    import SimpleITK as sitk
+    image = sitk.GetImageFromArray(volume.array, isVector=volume.components() > 1)
+    image.SetSpacing(volume.spacing)
+    image.SetOrigin(volume.origin)
+    image.SetDirection(volume.direction)
+    return image
+
+
+def fromSimpleITK(image, volume):
+    '''
+    Writes the voxels of a SimpleITK image in a shared volume allocated by Slicer with the same shape.
+    '''
+    import SimpleITK as sitk
+    array = sitk.GetArrayViewFromImage(image)
+    if array.shape != volume.array.shape:
+        raise ValueError(f"The image has the shape {array.shape}, the shared volume {volume.array.shape}")
+    volume.array[...] = array
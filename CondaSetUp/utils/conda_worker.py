@@ -0,0 +1,111 @@
+import sys
+import os
+import io
+import json
+import queue
+import runpy
+import threading
+import traceback
+import contextlib
+
+# Long-lived worker started by CondaSetUpCall inside a conda environment.
+# It reads one JSON job per line on stdin : {"id": 1, "file": "/path/script.py", "args": ["a", "b"]}
+# and answers one JSON line per job : {"id": 1, "returncode": 0, "stdout": "...", "stderr": "..."}
+# Modules imported by a job (SimpleITK, torch, ...) stay loaded for the next ones.
+
+
+def readJobs(jobs):
+    '''
+    Reads the jobs sent by Slicer and puts them in the queue. None is put when stdin is closed.
+    '''
+    for line in sys.stdin:
+        line = line.strip()
+        if line:
+            jobs.put(line)
+    jobs.put(None)
+
+
+def runJob(job):
+    '''
+    Runs a python file as __main__ with the given arguments and returns its return code, stdout and stderr.
+    '''
+    file_path = job["file"]
+    args = [str(arg) for arg in job.get("args", [])]
+
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    returncode = 0
+
+    old_argv = sys.argv
+    old_path = list(sys.path)
+    old_cwd = os.getcwd()
+    sys.argv = [file_path] + args
+    sys.path.insert(0, os.path.dirname(os.path.abspath(file_path)))
+    try:
+        if job.get("cwd"):
+            os.chdir(job["cwd"])
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            try:
+                runpy.run_path(file_path, run_name="__main__")
+            except SystemExit as e:
+                if e.code is None:
+                    returncode = 0
+                elif isinstance(e.code, int):
+                    returncode = e.code
+                else:
+                    print(e.code, file=sys.stderr)
+                    returncode = 1
+            except BaseException:
+                traceback.print_exc()
+                returncode = 1
+    finally:
+        sys.argv = old_argv
+        sys.path[:] = old_path
+        os.chdir(old_cwd)
+
+    return {"id": job.get("id"), "returncode": returncode, "stdout": stdout.getvalue(), "stderr": stderr.getvalue()}
+
+
+def main(idle_timeout):
+    # Keep a private copy of stdout for the protocol and send everything written directly
+    # on the file descriptor 1 (C extensions, subprocesses) to stderr instead.
+    protocol = os.fdopen(os.dup(sys.stdout.fileno()), "w", encoding="utf-8")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    jobs = queue.Queue()
+    reader = threading.Thread(target=readJobs, args=(jobs,), daemon=True)
+    reader.start()
+
+    protocol.write(json.dumps({"ready": True, "pid": os.getpid()}) + "\n")
+    protocol.flush()
+
+    while True:
+        try:
+            line = jobs.get(timeout=idle_timeout if idle_timeout > 0 else None)
+        except queue.Empty:
+            # Idle : stdin is drained before exiting, a job sent while the timeout fired is still run
+            try:
+                line = jobs.get(timeout=0.1)
+            except queue.Empty:
+                break
+        if line is None:
+            break
+
+        try:
+            job = json.loads(line)
+        except ValueError as e:
+            answer = {"id": None, "returncode": 1, "stdout": "", "stderr": f"Invalid job : {e}"}
+        else:
+            if job.get("command") == "stop":
+                break
+            answer = runJob(job)
+
+        protocol.write(json.dumps(answer) + "\n")
+        protocol.flush()
+
+
+if __name__ == "__main__":
+    idle_timeout = 0
+    if len(sys.argv) > 2 and sys.argv[1] == "--idle-timeout":
+        idle_timeout = float(sys.argv[2])
+    main(idle_timeout)
@@ -15,10 +15,9 @@ from slicer.parameterNodeWrapper import (
 )
 
 from slicer import vtkMRMLScalarVolumeNode
-from qt import QFileDialog,QMessageBox
+from qt import QFileDialog,QMessageBox,QTimer
 import time
-from CondaSetUp import  CondaSetUpCall # Calling CondaSetUpCall
-import threading
+from CondaSetUp import  CondaSetUpCall, CondaJobManager # Calling CondaSetUpCall
 
 from functools import partial
 #
@@ -145,6 +144,7 @@ class ExampleWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.logic = None
         self._parameterNode = None
         self._parameterNodeGuiTag = None
+        self.jobManager = None
 
     def setup(self) -> None:
         """Called when the user opens the module the first time and the widget is initialized."""
@@ -178,9 +178,12 @@ class ExampleWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
         self.ui.pushButtonOutput.connect("clicked(bool)",partial(self.openFinder,"folder"))
         self.ui.pushButtonInput.connect("clicked(bool)",partial(self.openFinder,"file"))
+        self.ui.checkBoxBatch.connect("toggled(bool)",self.onBatchToggled)
 
 
         self.ui.labelInformation.setHidden(True)
+        self.informationTimer = QTimer()
+        self.informationTimer.timeout.connect(self.updateInformation)
 
 
         # Make sure parameter node is initialized (needed for module reload)
@@ -190,15 +193,27 @@ class ExampleWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         if type == "folder":
             surface_folder = QFileDialog.getExistingDirectory(self.parent, "Select a scan folder")
             self.ui.lineEditOutput.setText(surface_folder)
+        elif self.ui.checkBoxBatch.isChecked():
+            surface_folder = QFileDialog.getExistingDirectory(self.parent, "Select a folder of images")
+            self.ui.lineEditInput.setText(surface_folder)
         else :
             surface_folder = QFileDialog.getOpenFileName(self.parent, 'Open a file', '', 'Image files (*.png *.jpeg *.jpg)')
             self.ui.lineEditInput.setText(surface_folder)
 
+    def onBatchToggled(self, checked:bool):
+        """In batch mode, every image of the input folder is thresholded by a single process, the name of the output files is used as a prefix."""
+        self.ui.pushButtonInput.setText("Select folder" if checked else "Select file")
+        self.ui.label.setText("Path folder :" if checked else "Path image :")
+        self.ui.label_4.setText("Prefix output files :" if checked else "Name output file :")
+        self.ui.lineEditInput.setText("")
+
 
 
     def cleanup(self) -> None:
         """Called when the application closes and the module widget is destroyed."""
         self.removeObservers()
+        if self.jobManager is not None:
+            self.jobManager.shutdown()
 
     def enter(self) -> None:
         """Called each time the user opens this module."""
@@ -263,89 +278,118 @@ class ExampleWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             self.ui.applyButton.enabled = False
 
     def onApplyButton(self) -> None:
-        """Run processing when user clicks "Apply" button. This particular module is designed for thresholding an image within a specific Conda environment. """
-        conda = CondaSetUpCall() # Creation of the object
-        path_conda = conda.getCondaPath() # Get the conda path to find out if the user has entered it
+        """Run processing when user clicks "Apply" button. This particular module is designed for thresholding an image within a specific Conda environment.
+        The conda operations are submitted to a CondaJobManager : each step starts the next one from its onFinished callback, so the UI is never blocked."""
+        self.conda = CondaSetUpCall() # Creation of the object
+        path_conda = self.conda.getCondaPath() # Get the conda path to find out if the user has entered it
         print("path_conda : ",path_conda)
         if path_conda == "None":
           slicer.util.infoDisplay("Path to conda is no set up. Open the module SlicerConda to do it",windowTitle="Can't found conda path")
+          return
+
+        if self.jobManager is None:
+          self.jobManager = CondaJobManager(self.conda) # Runs the conda operations in background threads
+        self.name_env = "example"
+        self.libs = ["SimpleITK"]
+
+        self.ui.applyButton.enabled = False
+        self.ui.labelInformation.setHidden(False)
+        self.statusText = "Image in process"
+        self.start_time = time.time()
+        self.updateInformation()
+        self.informationTimer.start(300)
+
+        print(self.conda.condaRunCommand(["conda info --envs"])) # Example of a conda commande to print all the existing environnement
+        if not self.conda.condaTestEnv(self.name_env): # Example of a conda command to test the existence of a specific environment
+          userResponse = slicer.util.confirmYesNoDisplay(f"The environnement {self.name_env} doesn't exist, do you want to create it ? \nThe libraries {' '.join(lib for lib in self.libs)} will be installed. ", windowTitle="Env doesn't exist")
+          if userResponse :
+            self.statusText = f"Creation of the new environment. \nThis task may take a few minutes. The libraries {' '.join(lib for lib in self.libs)} will be installed."
+            self.jobManager.createEnv(self.name_env,"3.9",self.libs,onFinished=lambda job: self.continueApply(job,"The creation of the environment",self.checkLibraries)) # Example of the creation of a new environment with the installation of a library
+          else :
+            self.finishApply()
         else :
-          self.ui.labelInformation.setHidden(False)
-          self.ui.labelInformation.setText("Image in process \ntime : 0s")
-          start_time = time.time()
-          previous_time = start_time
-          current_time = time.time()
-          elapsed_time = current_time - start_time
-          name_env = "example"
-          flag = True
-          libs = ["SimpleITK"]
-          print(conda.condaRunCommand(["conda info --envs"])) # Example of a conda commande to print all the existing environnement
-          if not conda.condaTestEnv(name_env): # Example of a conda command to test the existence of a specific environment
-
-            userResponse = slicer.util.confirmYesNoDisplay(f"The environnement {name_env} doesn't exist, do you want to create it ? \nThe libraries {' '.join(lib for lib in libs)} will be installed. ", windowTitle="Env doesn't exist")
-            if userResponse :
-              process = threading.Thread(target=conda.condaCreateEnv, args=(name_env,"3.9",libs,)) # Example of the creation of a new environment with the installation of a library
-              process.start()
-
-              while process.is_alive():
-                  slicer.app.processEvents()
-                  current_time = time.time()
-                  gap=current_time-previous_time
-                  if gap>0.3:
-                      previous_time = current_time
-                      elapsed_time = current_time - start_time
-                      self.ui.labelInformation.setText(f"Creation of the new environment. \nThis task may take a few minutes. The libraries {' '.join(lib for lib in libs)} will be installed.\ntime: {elapsed_time:.1f}s")
+          self.checkLibraries()
+
+    def updateInformation(self) -> None:
+        """Displays the current step and the elapsed time, called by a timer while the process runs."""
+        elapsed_time = time.time() - self.start_time
+        self.ui.labelInformation.setText(f"{self.statusText}\ntime: {elapsed_time:.1f}s")
 
+    def checkLibraries(self) -> None:
+        """Checks the libraries of the environment (read from its files, without starting conda), then installs the missing ones or runs the threshold."""
+        self.statusText = "Checking the libraries of the environment"
+        missing_lib = self.conda.missingRequirements(self.name_env,self.libs) # Example of a check of the libraries installed in the 'example' environment
+        print(f"The libraries missing in {self.name_env} are : {missing_lib}")
+
+        if len(missing_lib) != 0:
+            userResponse = slicer.util.confirmYesNoDisplay(f"The environnement {self.name_env} exist but the libraries : {' '.join(lib for lib in missing_lib)} are missing, do you want to install them ? ", windowTitle="Env doesn't exist")
+            if userResponse :
+                self.statusText = f"The libraries {' '.join(lib for lib in missing_lib)} is being installed in the environment {self.name_env}. \nThis task may take few minutes"
+                self.jobManager.syncEnv(self.name_env,self.libs,onFinished=lambda job: self.continueApply(job,"The installation of the libraries",self.runThreshold)) # Example of installing in a specific environment only the libraries it misses
             else :
-                flag = False
-                self.ui.labelInformation.setText(f"The process is finished\ntime: {elapsed_time:.1f}s")
-
-          if flag :
-            lis_lib_install = conda.condaRunCommand(['conda','list'],name_env) # Example of a command running in a specific environment (here, return the list of libraries installed in the 'example' environment)
-            print(f"The list of librairies in {name_env} is : {lis_lib_install}")
-            missing_lib = []
-            for lib in libs:
-                if lib.lower() not in lis_lib_install:
-                    missing_lib.append(lib)
-
-            if len(missing_lib) != 0:
-                userResponse = slicer.util.confirmYesNoDisplay(f"The environnement {name_env} exist but the libraries : {' '.join(lib for lib in missing_lib)} are missing, do you want to install them ? ", windowTitle="Env doesn't exist")
-                if userResponse :
-                    process = threading.Thread(target=conda.condaInstallLibEnv, args=(name_env,missing_lib)) # Example of installing certain libraries in a specific environment
-                    process.start()
-
-                    while process.is_alive():
-                        slicer.app.processEvents()
-                        current_time = time.time()
-                        gap=current_time-previous_time
-                        if gap>0.3:
-                            previous_time = current_time
-                            elapsed_time = current_time - start_time
-                            self.ui.labelInformation.setText(f"The libraries {' '.join(lib for lib in missing_lib)} is being installed in the environment {name_env}. \nThis task may take few minutes\ntime: {elapsed_time:.1f}s")
-
-                else :
-                    flag = False
-          if flag :
-            file_path = os.path.dirname(os.path.abspath(__file__))
-            file_to_run = os.path.join(file_path,"utils","threshold.py")
+                self.finishApply()
+        else :
+            self.runThreshold()
+
+    def runThreshold(self) -> None:
+        """Runs utils/threshold.py in the environment, its progress lines are displayed while it runs.
+        In batch mode, the whole folder is given to a single execution of the script (see threshold.py --batch)."""
+        file_path = os.path.dirname(os.path.abspath(__file__))
+        file_to_run = os.path.join(file_path,"utils","threshold.py")
+        if self.ui.checkBoxBatch.isChecked():
+            arguments = ["--batch",self.ui.lineEditInput.text,str(self.ui.horizontalSlider.value),self.ui.lineEditOutput.text,"--prefix",self.ui.lineEditSuffix.text]
+        else :
             _, file_extension = os.path.splitext(self.ui.lineEditInput.text)
             arguments = [self.ui.lineEditInput.text,str(self.ui.horizontalSlider.value),os.path.join(self.ui.lineEditOutput.text,(self.ui.lineEditSuffix.text+file_extension))]
-            print("args : ",arguments)
-
-            process = threading.Thread(target=conda.condaRunFilePython, args=(file_to_run,arguments,name_env)) # Example of running a python file with input arguments in a specific environment
-            process.start()
-            while process.is_alive():
-                slicer.app.processEvents()
-                current_time = time.time()
-                gap=current_time-previous_time
-                if gap>0.3:
-                    previous_time = current_time
-                    elapsed_time = current_time - start_time
-                    self.ui.labelInformation.setText(f"File in process\ntime: {elapsed_time:.1f}s")
-
-
-        self.ui.labelInformation.setText(f"The process is finished\ntime: {elapsed_time:.1f}s")
-        print(f"The process is finished\ntime: {elapsed_time:.1f}s")
+        print("args : ",arguments)
+
+        self.statusText = "File in process"
+        def onEvent(event):
+            # Called in the thread of the job, the label is updated by the timer
+            if event.kind == "progress":
+                self.statusText = f"File in process : {event.percent:.0f}% {event.message}"
+            elif event.kind == "stdout" and "Summary" in event.text:
+                print(event.text)
+
+        self.jobManager.runFilePython(file_to_run,arguments,self.name_env,onFinished=lambda job: self.continueApply(job,"The threshold",self.finishApply),callback=onEvent) # Example of running a python file with input arguments in a specific environment, with its progress streamed
+
+    @staticmethod
+    def jobError(job, description:str):
+        """Returns why a job of the CondaJobManager failed, or None if it succeeded : cancellation, exception,
+        or error returned by the conda operation (False, "Error...", or a condaSyncEnv report with an error status)."""
+        if job.cancelled():
+            return "The process has been cancelled"
+        exception = job.exception()
+        if exception is not None:
+            return f"{description} has failed : {exception}"
+        result = job.result()
+        if isinstance(result, dict):
+            result = result.get("status")
+        if result is False or (isinstance(result, str) and not result.startswith(("Result", "Unchanged", "Synced"))):
+            lines = str(result).strip().splitlines() if result is not False else []
+            return f"{description} has failed" + (f" : {lines[-1]}" if lines else "")
+        return None
+
+    def continueApply(self, job, description:str, nextStep) -> None:
+        """Called when a job is finished : goes on with the next step if it succeeded, else ends the process with the error.
+        An exception of the next step also ends the process, so the Apply button is always enabled again."""
+        error = self.jobError(job, description)
+        if error is not None:
+            self.finishApply(error)
+            return
+        try:
+            nextStep()
+        except Exception as e:
+            logging.exception("Error in the Example module")
+            self.finishApply(f"The process has failed : {e}")
+
+    def finishApply(self, error=None) -> None:
+        self.informationTimer.stop()
+        elapsed_time = time.time() - self.start_time
+        message = error or "The process is finished"
+        self.ui.labelInformation.setText(f"{message}\ntime: {elapsed_time:.1f}s")
+        print(f"{message}\ntime: {elapsed_time:.1f}s")
+        self.ui.applyButton.enabled = True
 
 
 
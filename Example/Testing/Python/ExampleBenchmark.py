@@ -0,0 +1,210 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import numpy as np
+
+from CondaSetUp import CondaSetUpCall
+
+# End-to-end benchmark of the data path of the Example module : synthetic volumes are written as NRRD files and thresholded
+# by utils/threshold.py through condaRunFilePython, like an Apply of ExampleWidget. threshold.py is run with --timings,
+# so the time of each execution is split in stages :
+#   spawn   launch of the process until the first line of threshold.py (conda run, interpreter startup)
+#   import  imports of threshold.py (SimpleITK)
+#   read, filter, write
+#   exit    end of threshold.py until condaRunFilePython returns (exit of the processes, transfer of the output)
+# Run it in Slicer, with an environment containing SimpleITK (the "example" environment created by the module by default) :
+#   Slicer --no-main-window --python-script Example/Testing/Python/ExampleBenchmark.py --sizes 64 128 --json example.json
+
+SIZES = [64, 128, 256, 512]
+DTYPES = ["uint8", "int16", "float32"]
+COMPONENTS = [1, 3]
+STAGES = ["spawn", "import", "read", "filter", "write", "exit", "total"]
+MODES = ["conda", "direct", "warm"]
+TIMINGS_TAG = "[SlicerConda:timings]"
+NRRD_TYPES = {"uint8": "uint8", "int16": "short", "float32": "float"}
+
+
+def syntheticVolume(size:int, dtype:str, components:int=1, seed:int=0):
+    '''
+    Returns a (size, size, size[, components]) array : a sphere over a noisy ramp, so the threshold keeps part of the voxels.
+    '''
+    rng = np.random.default_rng(seed)
+    axis = np.linspace(-1.0, 1.0, size, dtype=np.float32)
+    z, y, x = np.meshgrid(axis, axis, axis, indexing="ij", sparse=True)
+    volume = np.where(x*x + y*y + z*z < 0.5, 200.0, 100.0 * (x + 1.0)).astype(np.float32)
+    volume += rng.normal(0.0, 10.0, volume.shape).astype(np.float32)
+    if components > 1:
+        volume = np.stack([volume * (1.0 - 0.1 * c) for c in range(components)], axis=-1)
+    if dtype == "uint8":
+        volume = np.clip(volume, 0, 255)
+    return volume.astype(dtype)
+
+
+def writeNrrd(array, path:str, spacing=(1.0, 1.0, 1.0)):
+    '''
+    Writes an array (k, j, i[, components]) as an uncompressed NRRD file.
+    '''
+    components = array.shape[3] if array.ndim == 4 else 1
+    sizes = list(reversed(array.shape[:3]))
+    directions = " ".join(f"({','.join(str(spacing[axis] if axis == index else 0.0) for axis in range(3))})" for index in range(3))
+    header = ["NRRD0004", f"type: {NRRD_TYPES[array.dtype.name]}"]
+    if components > 1:
+        header += ["dimension: 4", f"sizes: {components} {' '.join(map(str, sizes))}", "kinds: vector domain domain domain",
+                   f"space directions: none {directions}"]
+    else:
+        header += ["dimension: 3", f"sizes: {' '.join(map(str, sizes))}", "kinds: domain domain domain", f"space directions: {directions}"]
+    header += ["space: left-posterior-superior", "space origin: (0,0,0)", "endian: little", "encoding: raw"]
+    with open(path, "wb") as file:
+        file.write(("\n".join(header) + "\n\n").encode("ascii"))
+        np.ascontiguousarray(array, dtype=array.dtype.newbyteorder("<")).tofile(file)
+
+
+def readTimings(output:str):
+    for line in output.splitlines():
+        if line.startswith(TIMINGS_TAG):
+            return json.loads(line[len(TIMINGS_TAG):])
+    return None
+
+
+def summarize(values:list)->dict:
+    values = sorted(values)
+    if not values:
+        return {"p50": None, "min": None, "max": None}
+    middle = len(values) // 2
+    p50 = values[middle] if len(values) % 2 else (values[middle-1] + values[middle]) / 2
+    return {"p50": p50, "min": values[0], "max": values[-1]}
+
+
+class ExampleBenchmark():
+    '''
+    Runs threshold.py on the synthetic volumes and collects the duration of each stage.
+    '''
+    def __init__(self, env_name:str="example", mode:str="conda", threshold:int=128, directory:str=None) -> None:
+        self.conda = CondaSetUpCall()
+        self.env_name = env_name
+        self.mode = mode
+        self.threshold = threshold
+        self.directory = directory
+        self.script = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "utils", "threshold.py")
+
+    def runOnce(self, input_path:str, output_path:str)->dict:
+        '''
+        Runs threshold.py once and returns the duration in seconds of each stage, or {"error": message}.
+        '''
+        launch = time.time()
+        result = self.conda.condaRunFilePython(self.script, [input_path, str(self.threshold), output_path, "--timings"], env_name=self.env_name,
+                                               warm=self.mode == "warm", direct=self.mode == "direct")
+        end = time.time()
+        timings = readTimings(result) if result.startswith("Result") else None
+        if timings is None:
+            return {"error": result[-500:]}
+        return {"spawn": timings["start"] - launch, "import": timings["import"], "read": timings["read"], "filter": timings["filter"],
+                "write": timings["write"], "exit": end - timings["end"], "total": end - launch}
+
+    def runCase(self, size:int, dtype:str, components:int, repeats:int)->dict:
+        directory = self.directory or tempfile.gettempdir()
+        name = f"slicerconda-benchmark-{size}-{dtype}-{components}"
+        input_path = os.path.join(directory, name + ".nrrd")
+        output_path = os.path.join(directory, name + "-threshold.nrrd")
+        volume = syntheticVolume(size, dtype, components)
+        case = {"size": size, "dtype": dtype, "components": components, "bytes": int(volume.nbytes), "repeats": repeats}
+        try:
+            start = time.time()
+            writeNrrd(volume, input_path)
+            case["generate"] = time.time() - start
+            del volume
+            runs = [self.runOnce(input_path, output_path) for _ in range(repeats)]
+        finally:
+            for path in (input_path, output_path):
+                if os.path.exists(path):
+                    os.remove(path)
+        errors = [run["error"] for run in runs if "error" in run]
+        runs = [run for run in runs if "error" not in run]
+        case["errors"] = len(errors)
+        if errors:
+            case["first_error"] = errors[0]
+        case["stages"] = {stage: summarize([run[stage] for run in runs]) for stage in STAGES}
+        return case
+
+    def run(self, sizes:list=SIZES, dtypes:list=DTYPES, components:list=COMPONENTS, repeats:int=3, callback=None)->dict:
+        '''
+        Runs every combination of sizes, dtypes and components repeats times, after one untimed run warming the caches of the disk and of conda.
+        '''
+        if self.conda.getCondaPath() == "None":
+            raise RuntimeError("The path to conda is not set up, open the module SlicerConda to do it")
+        if not self.conda.condaTestEnv(self.env_name):
+            raise RuntimeError(f"The environment {self.env_name} doesn't exist, create it with SimpleITK (Apply of the Example module)")
+        self.runCase(min(sizes), dtypes[0], 1, 1)
+        cases = []
+        for size in sizes:
+            for dtype in dtypes:
+                for component in components:
+                    case = self.runCase(size, dtype, component, repeats)
+                    cases.append(case)
+                    if callback is not None:
+                        callback(case)
+        return {
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "machine": {"system": platform.system(), "release": platform.release(), "machine": platform.machine(),
+                        "processor": platform.processor(), "cpu_count": os.cpu_count()},
+            "slicer": slicerVersion(),
+            "env": self.env_name,
+            "mode": self.mode,
+            "threshold": self.threshold,
+            "cases": cases,
+        }
+
+
+def slicerVersion():
+    try:
+        import slicer
+        return slicer.app.applicationVersion
+    except Exception:
+        return None
+
+
+def formatCase(case:dict)->str:
+    stages = case["stages"]
+    text = f"{case['size']:>4}^3 {case['dtype']:<8}{case['components']:>2}c {case['bytes']/2**20:>8.1f} MB"
+    for stage in STAGES:
+        p50 = stages[stage]["p50"]
+        text += f"{'-' if p50 is None else f'{p50*1000:.0f}':>9}"
+    if case["errors"]:
+        text += f"   {case['errors']} errors : {case['first_error'].strip().splitlines()[-1] if case['first_error'].strip() else ''}"
+    return text
+
+
+def main(argv:list)->int:
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the threshold pipeline of the Example module")
+    parser.add_argument("--env", default="example", help="environment containing SimpleITK")
+    parser.add_argument("--mode", choices=MODES, default="conda", help="conda run, direct execution of the interpreter or warm worker")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--dtypes", nargs="+", choices=DTYPES, default=DTYPES)
+    parser.add_argument("--components", type=int, nargs="+", default=COMPONENTS)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--threshold", type=int, default=128)
+    parser.add_argument("--directory", default=None, help="folder of the input and output files (temporary folder by default)")
+    parser.add_argument("--json", default=None, help="path of the JSON report")
+    args = parser.parse_args(argv)
+
+    benchmark = ExampleBenchmark(args.env, args.mode, args.threshold, args.directory)
+    print(f"{'volume':<30}" + "".join(f"{stage + ' ms':>9}" for stage in STAGES))
+    report = benchmark.run(args.sizes, args.dtypes, args.components, args.repeats, callback=lambda case: print(formatCase(case), flush=True))
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"Report : {args.json}")
+    return 1 if any(case["errors"] for case in report["cases"]) else 0
+
+
+if __name__ == "__main__":
+    status = main(sys.argv[1:])
+    try:
+        import slicer
+        slicer.util.exit(status)
+    except (ImportError, AttributeError):
+        sys.exit(status)
@@ -1,31 +1,143 @@
+import time
+SCRIPT_START = time.time() # Before the imports, for the timings of --timings
 import sys
+import os
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import SimpleITK as sitk
+IMPORT_END = time.time()
 
-def main(input, threshold, output):
+PROGRESS_TAG = "[SlicerConda:progress]" # Lines starting with this tag are read as progress by SlicerConda
+TIMINGS_TAG = "[SlicerConda:timings]" # Followed by the JSON of the stage timestamps, printed with --timings
 
+IMAGE_EXTENSIONS = (".nrrd", ".nhdr", ".nii", ".nii.gz", ".mha", ".mhd", ".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+
+def progress(percent, message):
+    print(f"{PROGRESS_TAG} {percent} {message}", flush=True)
+
+def threshold_image(input, threshold, output, report=None, timings=None):
+    '''
+    Thresholds one image. report, if given, is called with (percent, message) at each step.
+    timings, if given, is a dict filled with the duration in seconds of the read, filter and write stages.
+    '''
+    if report : report(0, "Reading the image")
+    stage_start = time.time()
     reader = sitk.ImageFileReader()
     reader.SetFileName(input)
     image = reader.Execute()
+    if timings is not None : timings["read"] = time.time() - stage_start
 
 
     if image.GetNumberOfComponentsPerPixel() > 1:
         image = sitk.VectorMagnitude(image)
 
 
+    if report : report(40, "Thresholding")
+    stage_start = time.time()
     thresholdFilter = sitk.BinaryThresholdImageFilter()
     thresholdFilter.SetLowerThreshold(threshold)
     thresholdFilter.SetUpperThreshold(255)
     thresholdFilter.SetOutsideValue(0)
     thresholdFilter.SetInsideValue(255)
     image = thresholdFilter.Execute(image)
+    if timings is not None : timings["filter"] = time.time() - stage_start
 
 
+    if report : report(70, "Writing the image")
+    stage_start = time.time()
     writer = sitk.ImageFileWriter()
     writer.SetFileName(output)
     writer.Execute(image)
+    if timings is not None : timings["write"] = time.time() - stage_start
+
+def main(input, threshold, output, print_timings=False):
+    timings = {"start": SCRIPT_START, "import": IMPORT_END - SCRIPT_START} if print_timings else None
+    threshold_image(input, threshold, output, report=progress, timings=timings)
+    progress(100, "Done")
+    if timings is not None:
+        timings["end"] = time.time()
+        print(f"{TIMINGS_TAG} {json.dumps(timings)}", flush=True)
+
+def list_inputs(source, output_folder, prefix):
+    '''
+    Returns the (input, output) pairs of a batch.
+    source is a folder (every image inside is processed) or a manifest : a text file with one input per line,
+    optionally followed by a tab and its output path.
+    '''
+    pairs = []
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                pairs.append((os.path.join(source, name), os.path.join(output_folder, prefix + name)))
+    else:
+        with open(source) as manifest:
+            for line in manifest:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                parts = line.split("\t")
+                input = parts[0]
+                output = parts[1] if len(parts) > 1 else os.path.join(output_folder, prefix + os.path.basename(input))
+                pairs.append((input, output))
+    return pairs
+
+def main_batch(source, threshold, output_folder, prefix="", workers=0, summary_path=None):
+    '''
+    Thresholds every image of a folder or a manifest in this process with a thread pool (SimpleITK releases the GIL while filtering),
+    so the interpreter startup and the import of SimpleITK are paid once. A JSON summary is written in the output folder.
+    '''
+    start = time.time()
+    os.makedirs(output_folder, exist_ok=True)
+    pairs = list_inputs(source, output_folder, prefix)
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(pairs)))
+    # Share the cores between the images instead of letting every filter use all of them
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(max(1, (os.cpu_count() or 1) // workers))
+
+    def run(pair):
+        item_start = time.time()
+        try:
+            threshold_image(pair[0], threshold, pair[1])
+            return {"input": pair[0], "output": pair[1], "status": "ok", "duration": time.time() - item_start}
+        except Exception as e:
+            return {"input": pair[0], "output": pair[1], "status": "error", "error": str(e), "duration": time.time() - item_start}
+
+    results = []
+    progress(0, f"{len(pairs)} images to process")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run, pair) for pair in pairs]
+        for future in as_completed(futures):
+            results.append(future.result())
+            progress(round(100 * len(results) / len(pairs)), f"{len(results)}/{len(pairs)} images processed")
+    results.sort(key=lambda result: result["input"])
+
+    failed = [result for result in results if result["status"] != "ok"]
+    summary = {"threshold": threshold, "workers": workers, "processed": len(results) - len(failed), "failed": len(failed),
+               "duration": time.time() - start, "images": results}
+    if summary_path is None:
+        summary_path = os.path.join(output_folder, "threshold_summary.json")
+    with open(summary_path, "w") as file:
+        json.dump(summary, file, indent=2)
+    print(f"{summary['processed']} images processed, {len(failed)} failed in {summary['duration']:.1f}s. Summary : {summary_path}")
+    return 1 if failed else 0
 
 if __name__ == "__main__":
-    if len(sys.argv) < 4:
-        print("Usage: TemplateKey <input> <threshold> <output>")
+    if len(sys.argv) > 1 and sys.argv[1] == "--batch":
+        parser = argparse.ArgumentParser(description="Threshold every image of a folder or of a manifest")
+        parser.add_argument("--batch", required=True, help="folder of images or manifest (one input per line, optionally followed by a tab and its output)")
+        parser.add_argument("threshold", type=int)
+        parser.add_argument("output", help="output folder")
+        parser.add_argument("--prefix", default="", help="prefix added to the name of the output files")
+        parser.add_argument("--workers", type=int, default=0, help="number of images processed at the same time (number of CPUs by default)")
+        parser.add_argument("--summary", default=None, help="path of the JSON summary (output/threshold_summary.json by default)")
+        arguments = parser.parse_args()
+        sys.exit(main_batch(arguments.batch, arguments.threshold, arguments.output, arguments.prefix, arguments.workers, arguments.summary))
+
+    arguments = [arg for arg in sys.argv[1:] if arg != "--timings"]
+    if len(arguments) < 3:
+        print("Usage: TemplateKey <input> <threshold> <output> [--timings]")
+        print("       TemplateKey --batch <folder or manifest> <threshold> <output folder> [--prefix P] [--workers N] [--summary path]")
         sys.exit(1)
-    main(sys.argv[1], int(sys.argv[2]), sys.argv[3])
+    main(arguments[0], int(arguments[1]), arguments[2], print_timings="--timings" in sys.argv[1:])